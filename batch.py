@@ -0,0 +1,277 @@
+"""
+批量生图：从 JSONL 任务文件流式读取任务，分发到对应 provider 并发执行
+
+任务文件每行一个 JSON 对象，例如：
+  {"id": "cat-1", "provider": "seedream4", "prompt": "一只小猫", "size": "2K", "max_images": 1}
+  {"id": "cat-2", "provider": "gpt_image_1", "prompt": "a cat", "size": "1024x1024", "n": 2}
+  {"id": "edit-1", "provider": "gpt_image_1", "prompt": "改成夜景", "image_path": "in.png"}
+
+- provider 缺省时按字段推断：含 max_images / images 视为 seedream4，否则为 gpt_image_1；
+  gpt_image_1 任务的多张参考图用 image_path 列表或 images 给出；
+- id 缺省时使用行号（line-<n>），续跑时依赖 id 稳定，建议显式给出；
+- 任务可带 "shard_size"：n / max_images 超过该值时拆成并行子请求（见 fanout），部分分片失败视为任务失败；
+- 任务可带 "variants"（true 或如 ["jpeg@300", "webp"]），结果记录中附带各输出图的变体路径与字节数；
+- 任务文件逐行读取，不整体载入内存；在途任务数受 workers 限制；
+- 每完成一个任务即追加写入结果 JSONL（含 status / latency / outputs / error），
+  成功的 id 同时追加到检查点文件；进程崩溃后用相同参数重跑会跳过已完成的任务，失败的任务会重试。
+
+用法:
+  python batch.py jobs.jsonl --out results.jsonl --workers 8
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+import postprocess
+from result_cache import ResultCache
+
+logger = logging.getLogger('batch')
+
+DEFAULT_OUTPUT_DIR = "outputs"
+
+
+def _shard_size(job: Dict[str, Any]) -> Optional[int]:
+    return int(job["shard_size"]) if job.get("shard_size") else None
+
+
+def _run_seedream4(job: Dict[str, Any], output_dir: str, cache: Optional[ResultCache] = None) -> List[str]:
+    from seedream import generate_image_with_seedream4
+
+    result = generate_image_with_seedream4(
+        prompt=job["prompt"],
+        images=job.get("images"),
+        max_images=int(job.get("max_images", 1)),
+        size=job.get("size", "2K"),
+        preprocess=bool(job.get("preprocess", False)),
+        cache=cache,
+        output_dir=output_dir,
+        shard_size=_shard_size(job),
+    )
+    if not result["success"]:
+        raise RuntimeError(result.get("error", "SeeDream 4.0 生成失败"))
+    if result.get("partial"):
+        raise RuntimeError(f"部分分片生成失败: {result['failed_shards']}")
+    paths = [img["local_path"] for img in result["images"]]
+    if not all(paths):
+        raise RuntimeError("部分结果图像下载失败")
+    return paths
+
+
+def _run_gpt_image_1(job: Dict[str, Any], output_dir: str, cache: Optional[ResultCache] = None) -> List[str]:
+    import gpt_image_1
+
+    images = gpt_image_1.generate_image(
+        job["prompt"],
+        job.get("image_path") or job.get("images"),
+        size=job.get("size", "1024x1024"),
+        n=int(job.get("n", 1)),
+        quality=job.get("quality", "high"),
+        model=job.get("model"),
+        mask_path=job.get("mask_path"),
+        use_base64=bool(job.get("use_base64", False)),
+        preprocess=bool(job.get("preprocess", False)),
+        cache=cache,
+        shard_size=_shard_size(job),
+    )
+    if len(images) < int(job.get("n", 1)):
+        raise RuntimeError(f"部分分片生成失败: 仅得到 {len(images)}/{job.get('n')} 张")
+    return gpt_image_1.save_images(images, output_dir, prefix=job.get("prefix", "gpt_image_1"))
+
+
+# provider 名 -> 执行函数(job, output_dir, cache) -> 输出文件路径列表
+PROVIDERS: Dict[str, Callable[..., List[str]]] = {
+    "seedream4": _run_seedream4,
+    "gpt_image_1": _run_gpt_image_1,
+}
+
+
+def infer_provider(job: Dict[str, Any]) -> str:
+    provider = job.get("provider")
+    if provider:
+        return provider
+    if "max_images" in job or "images" in job:
+        return "seedream4"
+    return "gpt_image_1"
+
+
+def iter_jobs(path: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """逐行读取任务文件，产出 (job_id, job)；空行与 # 开头的行被忽略，无法解析的行记录为错误任务"""
+    with open(path, "r", encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                yield f"line-{lineno}", {"_error": f"无法解析任务: {e}"}
+                continue
+            if not isinstance(job, dict):
+                yield f"line-{lineno}", {"_error": "任务必须是 JSON 对象"}
+                continue
+            yield str(job.get("id") or f"line-{lineno}"), job
+
+
+def load_checkpoint(path: str) -> Set[str]:
+    """读取已完成的任务 id"""
+    done: Set[str] = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                done.add(line)
+    return done
+
+
+class _Recorder:
+    """串行追加写结果与检查点（多个工作线程共用）"""
+
+    def __init__(self, results_path: str, checkpoint_path: str):
+        for path in (results_path, checkpoint_path):
+            parent = os.path.dirname(path)
+            if parent:
+                os.makedirs(parent, exist_ok=True)
+        self._results = open(results_path, "a", encoding="utf-8")
+        self._checkpoint = open(checkpoint_path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def record(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self._results.write(line + "\n")
+            self._results.flush()
+            if record["status"] == "ok":
+                # 先写结果再写检查点：崩溃时最多重复执行一个任务，不会丢结果
+                self._checkpoint.write(record["id"] + "\n")
+                self._checkpoint.flush()
+                os.fsync(self._checkpoint.fileno())
+
+    def close(self) -> None:
+        self._results.close()
+        self._checkpoint.close()
+
+
+def run_job(
+    job_id: str,
+    job: Dict[str, Any],
+    output_dir: str = DEFAULT_OUTPUT_DIR,
+    cache: Optional[ResultCache] = None,
+) -> Dict[str, Any]:
+    """执行单个任务，返回结果记录（不抛异常）；传入 cache 时已生成过的结果直接取自缓存"""
+    provider = infer_provider(job)
+    started = time.time()
+    record: Dict[str, Any] = {"id": job_id, "provider": provider, "started_at": started}
+    t0 = time.perf_counter()
+    try:
+        if "_error" in job:
+            raise ValueError(job["_error"])
+        if not job.get("prompt"):
+            raise ValueError("任务缺少 prompt")
+        runner = PROVIDERS.get(provider)
+        if runner is None:
+            raise ValueError(f"不支持的 provider: {provider}")
+        # 变体写法有误时在生成前报错，避免白白生成
+        variants = postprocess.parse_variants(job["variants"]) if job.get("variants") else None
+        record["outputs"] = runner(job, job.get("output_dir", output_dir), cache)
+        if variants:
+            mapping = postprocess.process_paths(record["outputs"], variants)
+            record["variants"] = [mapping.get(path, []) for path in record["outputs"]]
+        record["status"] = "ok"
+    except Exception as e:
+        logger.error(f"任务 {job_id} 失败: {e}")
+        record["status"] = "error"
+        record["error"] = str(e)
+    record["latency"] = round(time.perf_counter() - t0, 3)
+    return record
+
+
+def run_batch(
+    jobs_path: str,
+    results_path: str,
+    *,
+    checkpoint_path: Optional[str] = None,
+    workers: int = 4,
+    output_dir: str = DEFAULT_OUTPUT_DIR,
+) -> Dict[str, Any]:
+    """执行整个任务文件，返回汇总统计 {total, ok, failed, skipped, elapsed}"""
+    checkpoint_path = checkpoint_path or results_path + ".checkpoint"
+    done = load_checkpoint(checkpoint_path)
+    recorder = _Recorder(results_path, checkpoint_path)
+    stats = {"total": 0, "ok": 0, "failed": 0, "skipped": 0}
+    started = time.perf_counter()
+
+    def collect(finished: Set[Future]) -> None:
+        for future in finished:
+            record = future.result()
+            recorder.record(record)
+            stats["ok" if record["status"] == "ok" else "failed"] += 1
+
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch")
+    pending: Set[Future] = set()
+    seen: Set[str] = set()
+    try:
+        for job_id, job in iter_jobs(jobs_path):
+            stats["total"] += 1
+            if job_id in done:
+                stats["skipped"] += 1
+                continue
+            if job_id in seen:
+                logger.warning(f"任务 id 重复，跳过: {job_id}")
+                stats["skipped"] += 1
+                continue
+            seen.add(job_id)
+            # 在途任务数不超过 workers，任务文件不会被提前读入内存
+            while len(pending) >= workers:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(finished)
+            pending.add(pool.submit(run_job, job_id, job, output_dir))
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            collect(finished)
+    except KeyboardInterrupt:
+        logger.warning("收到中断，等待在途任务结束后退出（未开始的任务下次续跑）")
+        for future in pending:
+            future.cancel()
+        finished, _ = wait(pending)
+        collect({f for f in finished if not f.cancelled()})
+        raise
+    finally:
+        pool.shutdown(wait=True)
+        recorder.close()
+
+    stats["elapsed"] = round(time.perf_counter() - started, 3)
+    return stats
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="从 JSONL 任务文件批量生成图像")
+    parser.add_argument("jobs", help="任务文件（JSONL）")
+    parser.add_argument("--out", default="results.jsonl", help="结果文件（JSONL，追加写入）")
+    parser.add_argument("--checkpoint", default=None, help="检查点文件，默认 <out>.checkpoint")
+    parser.add_argument("--workers", type=int, default=4, help="并发任务数")
+    parser.add_argument("--output-dir", default=DEFAULT_OUTPUT_DIR, help="图像输出目录")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    stats = run_batch(
+        args.jobs,
+        args.out,
+        checkpoint_path=args.checkpoint,
+        workers=max(1, args.workers),
+        output_dir=args.output_dir,
+    )
+    print(json.dumps(stats, ensure_ascii=False))
+    return 0 if stats["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
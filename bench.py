@@ -0,0 +1,435 @@
+"""
+离线基准测试：对本地模拟 API（mock_image_api.py）测量客户端自身开销
+
+每个场景在独立子进程中运行（峰值 RSS 互不影响），测量：
+  - 吞吐（次/秒）与延迟分位数 p50 / p90 / p99
+  - 峰值 RSS（resource.getrusage）
+  - tracemalloc 统计的 Python 分配峰值与单次调用的分配块数（单独一轮，避免影响计时）
+
+场景覆盖 SeeDream4API.generate_image（JSON / SSE）、generate_image_with_seedream4，
+以及 gpt_image_1 的 text_to_image（含 lazy）、image_to_image、image_to_image_with_base64、
+generate_image、save_images、encode_image_to_base64 与 AsyncGptImage1.generate_image。
+
+用法:
+  python bench.py --out bench-results.json
+  python bench.py --scenarios gpt_text_to_image --iterations 200 --concurrency 8 --payload-bytes 2097152
+  python bench.py --compare bench-old.json bench-results.json      # 对比两次结果（NEW 中有失败场景时退出码为 1）
+  python bench.py --imports --import-budget-ms 20                  # 仅测导入耗时，超出预算时退出码为 1
+
+导入耗时：每个模块在全新解释器中导入 --import-repeats 次取中位数，并检查导入后是否已加载
+requests / httpx / openai / PIL / numpy / dotenv 等重量级依赖（它们应在首次使用时才加载）。
+
+任一场景的子进程崩溃或有调用出错（errors > 0）时退出码为 1：全部调用都失败的场景吞吐为 0，
+只看数字很容易被当成"变慢"而漏掉。
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+SCENARIOS = (
+    "seedream_api_json",
+    "seedream_api_sse",
+    "seedream_generate",
+    "gpt_text_to_image",
+    "gpt_text_to_image_lazy",
+    "gpt_image_to_image",
+    "gpt_image_to_image_base64",
+    "gpt_generate_image",
+    "gpt_save_images",
+    "gpt_encode_base64",
+    "gpt_async_generate_image",
+)
+
+IMPORT_MODULES = ("seedream", "gpt_image_1")
+HEAVY_MODULES = ("requests", "httpx", "openai", "PIL", "numpy", "dotenv", "asyncio")
+
+_IMPORT_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - started
+print(json.dumps({{"seconds": seconds, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def _percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def _peak_rss() -> Optional[int]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 为单位，macOS 以字节为单位
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _bench_env(port: int, workdir: str) -> Dict[str, str]:
+    base = f"http://127.0.0.1:{port}"
+    env = dict(os.environ)
+    env.update({
+        "SEEDREAM4_API_KEY": "bench",
+        "SEEDREAM4_BASE_URL": f"{base}/api/v3/images/generations",
+        "AZURE_OPENAI_ENDPOINT": base,
+        "AZURE_OPENAI_API_KEY": "bench",
+        "AZURE_OPENAI_DEPLOYMENT_NAME": "gpt-image-1",
+        "IMAGE_RATE_LIMIT_DIR": os.path.join(workdir, "rate-limits"),
+        "IMAGE_RESULT_CACHE_DIR": os.path.join(workdir, "cache"),
+    })
+    # 基准只测客户端开销，不启用限流
+    for name in ("SEEDREAM4_RPM", "SEEDREAM4_IPM", "AZURE_OPENAI_RPM", "AZURE_OPENAI_IPM"):
+        env.pop(name, None)
+    return env
+
+
+def _make_scenario(name: str, workdir: str, n: int) -> Callable[[int], Any]:
+    """返回 fn(i)，执行一次场景调用；在子进程中调用（环境变量已指向模拟服务）"""
+    from mock_image_api import load_fixture_image, load_fixture_request
+
+    fixture = load_fixture_request()
+    prompt = fixture.get("prompt", "benchmark")
+    size = fixture.get("size", "2K")
+    output_dir = os.path.join(workdir, "outputs")
+    input_path = os.path.join(workdir, "input.png")
+    with open(input_path, "wb") as f:
+        f.write(load_fixture_image())
+
+    if name.startswith("seedream"):
+        import seedream
+
+        api = seedream.SeeDream4API()
+        if name == "seedream_api_json":
+            return lambda i: api.generate_image(f"{prompt} #{i}", max_images=n, size=size, stream=False)
+        if name == "seedream_api_sse":
+            return lambda i: api.generate_image(f"{prompt} #{i}", max_images=n, size=size, stream=True)
+        return lambda i: seedream.generate_image_with_seedream4(
+            f"{prompt} #{i}", max_images=n, size=size, coalesce=False, output_dir=output_dir
+        )
+
+    import gpt_image_1
+
+    if name == "gpt_text_to_image":
+        return lambda i: gpt_image_1.text_to_image(f"{prompt} #{i}", n=n)
+    if name == "gpt_text_to_image_lazy":
+        return lambda i: gpt_image_1.save_images(
+            gpt_image_1.text_to_image(f"{prompt} #{i}", n=n, lazy=True), output_dir
+        )
+    if name == "gpt_image_to_image":
+        return lambda i: gpt_image_1.image_to_image(input_path, f"{prompt} #{i}", n=n)
+    if name == "gpt_image_to_image_base64":
+        return lambda i: gpt_image_1.image_to_image_with_base64(input_path, f"{prompt} #{i}", n=n)
+    if name == "gpt_generate_image":
+        return lambda i: gpt_image_1.generate_image(f"{prompt} #{i}", n=n, coalesce=False)
+    if name == "gpt_save_images":
+        images = gpt_image_1.text_to_image(prompt, n=n)
+        return lambda i: gpt_image_1.save_images(images, output_dir, naming="uuid")
+    if name == "gpt_encode_base64":
+        return lambda i: gpt_image_1.encode_image_to_base64(input_path)
+    if name == "gpt_async_generate_image":
+        loop = asyncio.new_event_loop()
+        client = loop.run_until_complete(_async_client(gpt_image_1))
+        return lambda i: loop.run_until_complete(client.generate_image(f"{prompt} #{i}", n=n, coalesce=False))
+    raise ValueError(f"未知场景: {name}")
+
+
+async def _async_client(gpt_image_1):
+    return gpt_image_1.AsyncGptImage1()
+
+
+def _check(result: Any) -> None:
+    if isinstance(result, dict) and not result.get("success", True):
+        raise RuntimeError(result.get("error"))
+
+
+def run_scenario(name: str, iterations: int, concurrency: int, n: int, alloc_iterations: int) -> Dict[str, Any]:
+    """在当前进程中运行单个场景（由子进程调用）"""
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    try:
+        fn = _make_scenario(name, workdir, n)
+        fn(-1)  # 预热：建立连接、导入依赖、填充缓存
+
+        latencies: List[float] = []
+        errors: List[str] = []
+
+        def timed(i: int) -> None:
+            started = time.perf_counter()
+            try:
+                _check(fn(i))
+            except Exception as e:
+                errors.append(str(e))
+                return
+            latencies.append(time.perf_counter() - started)
+
+        workers = 1 if name == "gpt_async_generate_image" else concurrency
+        started = time.perf_counter()
+        if workers <= 1:
+            for i in range(iterations):
+                timed(i)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(timed, range(iterations)))
+        wall = time.perf_counter() - started
+        peak_rss = _peak_rss()
+
+        # 分配统计单独一轮（tracemalloc 会显著拖慢执行）
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        for i in range(alloc_iterations):
+            try:
+                fn(iterations + i)
+            except Exception:
+                pass
+        _, alloc_peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        blocks = sum(max(0, stat.count_diff) for stat in after.compare_to(before, "filename"))
+
+        return {
+            "scenario": name,
+            "iterations": iterations,
+            "concurrency": workers,
+            "images_per_call": n,
+            "errors": len(errors),
+            "first_error": errors[0] if errors else None,
+            "wall_seconds": round(wall, 4),
+            "throughput": round(len(latencies) / wall, 3) if wall > 0 else 0.0,
+            "latency": {
+                "mean": round(statistics.fmean(latencies), 6) if latencies else 0.0,
+                "p50": round(_percentile(latencies, 0.5), 6),
+                "p90": round(_percentile(latencies, 0.9), 6),
+                "p99": round(_percentile(latencies, 0.99), 6),
+                "max": round(max(latencies), 6) if latencies else 0.0,
+            },
+            "peak_rss_bytes": peak_rss,
+            "alloc_peak_bytes": alloc_peak,
+            "alloc_blocks_retained_per_call": round(blocks / alloc_iterations, 1) if alloc_iterations else None,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _start_mock(args) -> subprocess.Popen:
+    cmd = [
+        sys.executable, os.path.join(_HERE, "mock_image_api.py"), "--port", "0",
+        "--latency", str(args.latency), "--jitter", str(args.jitter),
+        "--payload-bytes", str(args.payload_bytes), "--sse-interval", str(args.sse_interval),
+    ]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    line = proc.stdout.readline().strip()
+    if not line.startswith("listening "):
+        proc.kill()
+        raise RuntimeError(f"模拟服务启动失败: {line!r}")
+    proc.port = int(line.split()[1])
+    return proc
+
+
+def measure_import(module: str, repeats: int = 10) -> Dict[str, Any]:
+    """在全新解释器中反复导入 module，返回耗时中位数 / 最大值与导入时被加载的重量级依赖"""
+    samples: List[float] = []
+    heavy: List[str] = []
+    code = _IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)
+    for _ in range(repeats):
+        proc = subprocess.run([sys.executable, "-c", code], cwd=_HERE, capture_output=True, text=True)
+        if proc.returncode != 0:
+            return {"module": module, "failed": True, "stderr": proc.stderr[-2000:]}
+        probe = json.loads(proc.stdout.strip().splitlines()[-1])
+        samples.append(probe["seconds"])
+        heavy = sorted(set(heavy) | set(probe["heavy"]))
+    return {
+        "module": module,
+        "repeats": repeats,
+        "median": statistics.median(samples),
+        "max": max(samples),
+        "heavy_loaded": heavy,
+    }
+
+
+def run_imports(repeats: int, budget_ms: Optional[float] = None) -> List[Dict[str, Any]]:
+    """测量 IMPORT_MODULES 的导入耗时；设置 budget_ms 时标记超出预算或提前加载重量级依赖的模块"""
+    results = []
+    for module in IMPORT_MODULES:
+        result = measure_import(module, repeats)
+        if not result.get("failed"):
+            over = budget_ms is not None and result["median"] * 1000 > budget_ms
+            result["regressed"] = bool(over or result["heavy_loaded"])
+            print(
+                f"import {module:22s} median {result['median'] * 1000:7.2f}ms  max {result['max'] * 1000:7.2f}ms  "
+                f"heavy {','.join(result['heavy_loaded']) or '-'}",
+                file=sys.stderr,
+            )
+        results.append(result)
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=_HERE, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(args) -> Dict[str, Any]:
+    imports = run_imports(args.import_repeats, args.import_budget_ms)
+    server = _start_mock(args)
+    workdir = tempfile.mkdtemp(prefix="bench-env-")
+    results = []
+    try:
+        env = _bench_env(server.port, workdir)
+        for name in args.scenarios:
+            cmd = [
+                sys.executable, os.path.abspath(__file__), "--child", name,
+                "--iterations", str(args.iterations), "--concurrency", str(args.concurrency),
+                "--images", str(args.images), "--alloc-iterations", str(args.alloc_iterations),
+            ]
+            proc = subprocess.run(cmd, env=env, cwd=_HERE, capture_output=True, text=True)
+            if proc.returncode != 0:
+                results.append({"scenario": name, "failed": True, "stderr": proc.stderr[-2000:]})
+                print(f"{name}: 失败", file=sys.stderr)
+                continue
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+            results.append(result)
+            print(
+                f"{name:28s} {result['throughput']:9.2f}/s  p50 {result['latency']['p50'] * 1000:8.2f}ms  "
+                f"p99 {result['latency']['p99'] * 1000:8.2f}ms  rss {(result['peak_rss_bytes'] or 0) / 2**20:7.1f}MiB",
+                file=sys.stderr,
+            )
+            if result["errors"]:
+                print(f"{name}: {result['errors']}/{result['iterations']} 次调用出错: {result['first_error']}",
+                      file=sys.stderr)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "iterations": args.iterations,
+            "concurrency": args.concurrency,
+            "images": args.images,
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "payload_bytes": args.payload_bytes,
+            "sse_interval": args.sse_interval,
+        },
+        "imports": imports,
+        "results": results,
+    }
+
+
+def scenario_failed(result: Dict[str, Any]) -> bool:
+    """场景子进程崩溃或有调用出错"""
+    return bool(result.get("failed") or result.get("errors"))
+
+
+def compare(old_path: str, new_path: str) -> Tuple[str, bool]:
+    """对比两份结果，输出吞吐、p50/p99 延迟、峰值 RSS 与导入耗时的变化百分比；返回 (报告, NEW 中是否有失败场景)"""
+    with open(old_path, "r", encoding="utf-8") as f:
+        old_report = json.load(f)
+    with open(new_path, "r", encoding="utf-8") as f:
+        new_report = json.load(f)
+    old = {r["scenario"]: r for r in old_report.get("results", []) if not scenario_failed(r)}
+    new = {r["scenario"]: r for r in new_report.get("results", []) if not scenario_failed(r)}
+    failures = [r for r in new_report.get("results", []) if scenario_failed(r)]
+    old_imports = {r["module"]: r for r in old_report.get("imports", []) if not r.get("failed")}
+    new_imports = {r["module"]: r for r in new_report.get("imports", []) if not r.get("failed")}
+
+    def delta(a: Optional[float], b: Optional[float]) -> str:
+        if not a or b is None:
+            return "    n/a"
+        return f"{(b - a) / a * 100:+7.1f}%"
+
+    lines = [f"{'scenario':28s} {'throughput':>10s} {'p50':>8s} {'p99':>8s} {'rss':>8s}"]
+    for name in sorted(set(old) & set(new)):
+        a, b = old[name], new[name]
+        lines.append(
+            f"{name:28s} {delta(a['throughput'], b['throughput']):>10s} "
+            f"{delta(a['latency']['p50'], b['latency']['p50']):>8s} "
+            f"{delta(a['latency']['p99'], b['latency']['p99']):>8s} "
+            f"{delta(a['peak_rss_bytes'], b['peak_rss_bytes']):>8s}"
+        )
+    for module in sorted(set(old_imports) & set(new_imports)):
+        lines.append(
+            f"{'import ' + module:28s} {delta(old_imports[module]['median'], new_imports[module]['median']):>10s}"
+        )
+    for result in failures:
+        reason = "子进程崩溃" if result.get("failed") else f"{result['errors']} 次调用出错: {result.get('first_error')}"
+        lines.append(f"{result['scenario']:28s} 失败（{reason}）")
+    return "\n".join(lines), bool(failures)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="图像客户端离线基准测试")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--images", type=int, default=1, help="每次调用生成的图片数（n / max_images）")
+    parser.add_argument("--alloc-iterations", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--payload-bytes", type=int, default=256 * 1024)
+    parser.add_argument("--sse-interval", type=float, default=0.0)
+    parser.add_argument("--out", default=None, help="结果 JSON 文件（默认输出到标准输出）")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="对比两份结果文件")
+    parser.add_argument("--imports", action="store_true", help="仅测量模块导入耗时")
+    parser.add_argument("--import-repeats", type=int, default=10)
+    parser.add_argument("--import-budget-ms", type=float, default=None,
+                        help="导入耗时中位数上限（毫秒），超出或提前加载重量级依赖时退出码为 1")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        text, failed = compare(*args.compare)
+        print(text)
+        return 1 if failed else 0
+    if args.child:
+        sys.path.insert(0, _HERE)
+        result = run_scenario(args.child, args.iterations, args.concurrency, args.images, args.alloc_iterations)
+        print(json.dumps(result))
+        return 0
+
+    if args.imports:
+        imports = run_imports(args.import_repeats, args.import_budget_ms)
+        print(json.dumps({"commit": _git_commit(), "python": platform.python_version(), "imports": imports},
+                         ensure_ascii=False, indent=2))
+        return 0 if not any(r.get("failed") or r.get("regressed") for r in imports) else 1
+
+    report = run_suite(args)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    failed = any(scenario_failed(r) for r in report["results"])
+    regressed = any(r.get("failed") or r.get("regressed") for r in report["imports"])
+    return 0 if not (failed or regressed) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
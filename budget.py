@@ -0,0 +1,407 @@
+"""
+端到端时间预算与协作式取消
+
+- 公开入口用 @budget.bounded 装饰后接受两个关键字参数：
+    deadline: 整体时限（秒），从调用开始计时；
+    cancel:   CancelToken，调用方（如界面已放弃等待）调用 token.cancel() 取消整个调用。
+- 预算通过 contextvars 传递给各阶段（编码、上传、等待上游、SSE 读取、下载、解码、保存）：
+  budget.timeout(默认值) 返回本阶段可用的超时（不超过剩余时间），budget.check() 在阶段边界检查
+  是否已超时或被取消；嵌套调用取更早的截止时间，外层取消会传递给内层。
+- 取消时：重试退避立即结束；正在等待的同步请求立即返回调用方（后台尝试在阻塞调用返回后关闭连接）；
+  流式上传、SSE 与分块下载在下一个数据块处中断并关闭连接，未完成的 .part 文件被删除；
+  异步调用直接取消任务，httpx 随之关闭连接。
+- 超时抛出 DeadlineExceeded（TimeoutError 子类），取消抛出 Cancelled；二者都不会被重试。
+
+用法:
+    token = budget.CancelToken()
+    images = gpt_image_1.generate_image("a cat", deadline=45, cancel=token)
+    # 另一个线程中：token.cancel("用户关闭了页面")
+"""
+from __future__ import annotations
+
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+from lazy import lazy_import
+
+asyncio = lazy_import("asyncio")
+
+logger = logging.getLogger('budget')
+
+T = TypeVar("T")
+
+
+class DeadlineExceeded(TimeoutError):
+    """整体时限已用完"""
+
+
+class Cancelled(Exception):
+    """调用被 CancelToken 取消"""
+
+
+class CancelToken(threading.Event):
+    """取消令牌：cancel() 置位并依次执行登记的回调（关闭连接、唤醒等待等）
+
+    继承 threading.Event，可直接作为 resilience 各尝试的取消事件使用。
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._callbacks: List[Callable[[], None]] = []
+        self._callbacks_lock = threading.Lock()
+        self.reason = "调用已取消"
+
+    def cancel(self, reason: Optional[str] = None) -> None:
+        if reason:
+            self.reason = reason
+        self.set()
+
+    def set(self) -> None:
+        with self._callbacks_lock:
+            if self.is_set():
+                return
+            super().set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f"取消回调执行失败: {e}")
+
+    @property
+    def cancelled(self) -> bool:
+        return self.is_set()
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """登记取消回调，返回注销函数；已取消时立即执行"""
+        with self._callbacks_lock:
+            if not self.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._discard(callback)
+        callback()
+        return lambda: None
+
+    def _discard(self, callback: Callable[[], None]) -> None:
+        with self._callbacks_lock:
+            try:
+                self._callbacks.remove(callback)
+            except ValueError:
+                pass
+
+    def check(self) -> None:
+        if self.is_set():
+            raise Cancelled(self.reason)
+
+
+class Budget:
+    """一次调用的时间预算：截止时刻（time.monotonic）与取消令牌"""
+
+    def __init__(self, expires_at: Optional[float] = None, token: Optional[CancelToken] = None):
+        self.expires_at = expires_at
+        self.token = token
+
+    def remaining(self) -> Optional[float]:
+        if self.expires_at is None:
+            return None
+        return self.expires_at - time.monotonic()
+
+    def check(self, phase: str = "") -> None:
+        if self.token is not None:
+            self.token.check()
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded(f"已超出整体时限{f'（{phase}）' if phase else ''}")
+
+
+_current: contextvars.ContextVar[Optional[Budget]] = contextvars.ContextVar("budget", default=None)
+
+
+def current() -> Optional[Budget]:
+    """当前上下文中的预算（不在任何预算内时为 None）"""
+    return _current.get()
+
+
+def _combine(
+    outer: Optional[Budget], deadline: Optional[float], cancel: Optional[CancelToken]
+) -> Tuple[Budget, Optional[Callable[[], None]]]:
+    """与外层预算合并，返回 (新预算, 解除外层取消传递的函数)"""
+    expires_at = time.monotonic() + max(0.0, float(deadline)) if deadline is not None else None
+    if outer is not None and outer.expires_at is not None:
+        expires_at = outer.expires_at if expires_at is None else min(expires_at, outer.expires_at)
+    token = cancel or (outer.token if outer is not None else None)
+    unlink = None
+    if cancel is not None and outer is not None and outer.token is not None and outer.token is not cancel:
+        outer_token = outer.token
+        unlink = outer_token.on_cancel(lambda: cancel.cancel(outer_token.reason))
+    return Budget(expires_at, token), unlink
+
+
+@contextmanager
+def scope(deadline: Optional[float] = None, cancel: Optional[CancelToken] = None) -> Iterator[Optional[Budget]]:
+    """在 deadline 秒 / cancel 令牌内执行；与外层预算合并（取更早的截止时间，外层取消传递给内层）"""
+    if deadline is None and cancel is None:
+        yield _current.get()
+        return
+    budget, unlink = _combine(_current.get(), deadline, cancel)
+    ctx_token = _current.set(budget)
+    try:
+        yield budget
+    finally:
+        _current.reset(ctx_token)
+        if unlink is not None:
+            unlink()
+
+
+@contextmanager
+def activate(budget: Optional[Budget]) -> Iterator[Optional[Budget]]:
+    """在当前上下文（如后台线程）中启用已有预算"""
+    ctx_token = _current.set(budget)
+    try:
+        yield budget
+    finally:
+        _current.reset(ctx_token)
+
+
+def remaining() -> Optional[float]:
+    budget = _current.get()
+    return budget.remaining() if budget is not None else None
+
+
+def cancel_token() -> Optional[CancelToken]:
+    budget = _current.get()
+    return budget.token if budget is not None else None
+
+
+def check(phase: str = "") -> None:
+    """已超时或已取消时抛出 DeadlineExceeded / Cancelled"""
+    budget = _current.get()
+    if budget is not None:
+        budget.check(phase)
+
+
+def timeout(default: Optional[float] = None, phase: str = "") -> Optional[float]:
+    """本阶段可用的超时：不超过剩余时间；不在预算内时返回 default"""
+    budget = _current.get()
+    if budget is None:
+        return default
+    budget.check(phase)
+    left = budget.remaining()
+    if left is None:
+        return default
+    return left if default is None else min(default, left)
+
+
+def sleep(seconds: float) -> None:
+    """可被取消的等待；等待时间超出剩余预算时直接抛出 DeadlineExceeded"""
+    budget = _current.get()
+    if budget is None:
+        time.sleep(seconds)
+        return
+    left = budget.remaining()
+    if left is not None and seconds >= left:
+        raise DeadlineExceeded(f"剩余 {max(left, 0):.1f}s，不足以等待 {seconds:.1f}s 后重试")
+    if budget.token is not None:
+        budget.token.wait(seconds)
+    else:
+        time.sleep(seconds)
+    budget.check()
+
+
+async def asleep(seconds: float) -> None:
+    """sleep 的异步版本；取消由外层 bound() 取消任务完成"""
+    budget = _current.get()
+    if budget is not None:
+        left = budget.remaining()
+        if left is not None and seconds >= left:
+            raise DeadlineExceeded(f"剩余 {max(left, 0):.1f}s，不足以等待 {seconds:.1f}s 后重试")
+    await asyncio.sleep(seconds)
+    check()
+
+
+def guard(chunks: Iterable[T], on_abort: Optional[Callable[[], None]] = None) -> Iterator[T]:
+    """逐块迭代并在每块之前检查预算；超时或取消时执行 on_abort（如关闭响应）再抛出
+
+    on_abort 同时登记为取消回调：阻塞在读取上时取消会立即关闭连接，读取方抛出的底层异常
+    随之改为 Cancelled。
+    """
+    budget = _current.get()
+    if budget is None:
+        yield from chunks
+        return
+    unlink = budget.token.on_cancel(on_abort) if budget.token is not None and on_abort is not None else None
+    iterator = iter(chunks)
+    try:
+        while True:
+            try:
+                budget.check()
+            except Exception:
+                if on_abort is not None:
+                    on_abort()
+                raise
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            except Exception:
+                budget.check()
+                raise
+            yield chunk
+    finally:
+        if unlink is not None:
+            unlink()
+
+
+class GuardedBody:
+    """包装流式请求体：保留长度（Content-Length 不变），发送每块前检查预算，超时或取消时中断上传"""
+
+    def __init__(self, body: Any, budget: Optional[Budget] = None):
+        self.body = body
+        self.budget = budget if budget is not None else _current.get()
+
+    def __len__(self) -> int:
+        return len(self.body)
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in self.body:
+            if self.budget is not None:
+                self.budget.check("upload")
+            yield chunk
+
+
+_interrupt_pool: Optional[ThreadPoolExecutor] = None
+_interrupt_workers = 0
+_interrupt_lock = threading.Lock()
+
+
+def _default_interrupt_workers() -> int:
+    try:
+        configured = int(os.getenv("IMAGE_INTERRUPT_WORKERS", 0))
+    except ValueError:
+        configured = 0
+    return configured or max(64, 16 * (os.cpu_count() or 1))
+
+
+def _interrupt_executor(min_workers: int = 0) -> ThreadPoolExecutor:
+    """interruptible 使用的线程池；容量不足 min_workers 时换成更大的线程池（旧池中的尝试照常执行完）"""
+    global _interrupt_pool, _interrupt_workers
+    with _interrupt_lock:
+        if _interrupt_pool is None or _interrupt_workers < min_workers:
+            workers = max(min_workers, _interrupt_workers or _default_interrupt_workers())
+            previous = _interrupt_pool
+            _interrupt_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="budget")
+            _interrupt_workers = workers
+            if previous is not None:
+                previous.shutdown(wait=False)
+        return _interrupt_pool
+
+
+def reserve(concurrency: int) -> None:
+    """声明调用方同时在预算内执行的调用数（如守护进程的并发上限）
+
+    interruptible 的线程池至少扩到 concurrency 的两倍：被放弃的尝试要等阻塞调用返回才释放线程，
+    留出同样多的余量，几个卡住的尝试不会让新请求排队。默认容量可用 IMAGE_INTERRUPT_WORKERS 配置。
+    """
+    _interrupt_executor(2 * max(1, concurrency))
+
+
+def interruptible(fn: Callable[[CancelToken], T]) -> T:
+    """执行 fn(attempt_token)，取消或超时时立即返回调用方
+
+    fn 在后台线程中执行，阻塞调用返回后应检查 attempt_token 并关闭连接（与对冲尝试的约定一致）。
+    不在预算内时直接在当前线程执行。
+    """
+    budget = _current.get()
+    attempt = CancelToken()
+    if budget is None:
+        return fn(attempt)
+    budget.check()
+    wake = threading.Event()
+    unlink = budget.token.on_cancel(wake.set) if budget.token is not None else None
+    future = _interrupt_executor().submit(contextvars.copy_context().run, fn, attempt)
+    future.add_done_callback(lambda _: wake.set())
+    try:
+        left = budget.remaining()
+        wake.wait(None if left is None else max(0.0, left))
+        if not future.done():
+            attempt.cancel()
+            budget.check()
+            raise DeadlineExceeded("已超出整体时限")
+        return future.result()
+    finally:
+        if unlink is not None:
+            unlink()
+
+
+async def bound(awaitable: Any, budget: Optional[Budget] = None) -> Any:
+    """在预算内等待协程：超时抛出 DeadlineExceeded，令牌取消时取消任务（httpx 随之关闭连接）"""
+    budget = budget if budget is not None else _current.get()
+    if budget is None:
+        return await awaitable
+    budget.check()
+    task = asyncio.ensure_future(awaitable)
+    unlink = None
+    if budget.token is not None:
+        loop = asyncio.get_running_loop()
+        unlink = budget.token.on_cancel(lambda: loop.call_soon_threadsafe(task.cancel))
+    try:
+        left = budget.remaining()
+        return await asyncio.wait_for(task, None if left is None else max(0.0, left))
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded("已超出整体时限") from None
+    except asyncio.CancelledError:
+        if budget.token is not None and budget.token.cancelled:
+            raise Cancelled(budget.token.reason) from None
+        raise
+    finally:
+        if unlink is not None:
+            unlink()
+
+
+def bounded(fn: Callable) -> Callable:
+    """装饰器：为同步函数、协程与生成器增加 deadline / cancel 关键字参数（见模块说明）"""
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_wrapper(*args, deadline: Optional[float] = None, cancel: Optional[CancelToken] = None,
+                                **kwargs):
+            if deadline is None and cancel is None:
+                return await fn(*args, **kwargs)
+            with scope(deadline, cancel) as budget:
+                return await bound(fn(*args, **kwargs), budget)
+        return async_wrapper
+
+    if inspect.isgeneratorfunction(fn):
+        @functools.wraps(fn)
+        def generator_wrapper(*args, deadline: Optional[float] = None, cancel: Optional[CancelToken] = None,
+                              **kwargs):
+            if deadline is None and cancel is None:
+                return (yield from fn(*args, **kwargs))
+            # 生成器跨 yield 不能持有 contextvars 的设置：每次恢复执行时重新启用同一份预算
+            budget, unlink = _combine(_current.get(), deadline, cancel)
+            gen = fn(*args, **kwargs)
+            try:
+                while True:
+                    with activate(budget):
+                        item = next(gen)
+                    yield item
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                with activate(budget):
+                    gen.close()
+                if unlink is not None:
+                    unlink()
+        return generator_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, deadline: Optional[float] = None, cancel: Optional[CancelToken] = None, **kwargs):
+        with scope(deadline, cancel):
+            return fn(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,672 @@
+"""
+常驻生成守护进程：进程内保持 SDK 客户端、连接池与配置常驻，通过本地 Unix socket 或 localhost HTTP 提供服务
+
+每次以脚本方式调用都要付出解释器启动、.env 查找、SDK 导入与重新握手的开销；守护进程启动时预热一次，
+之后 Node 服务与批处理工具的每个请求只需一次本地往返（毫秒级）。
+
+接口（HTTP/1.1，支持长连接）：
+  GET  /health                  {"ok": true, "pid": ..., "uptime": ..., "inflight": ..., "warm": {...}}
+  GET  /metrics                 Prometheus 文本格式（见 metrics）
+  POST /v1/generate             请求体为 JSON，字段与 batch.py 的任务行一致（provider / prompt / size / n /
+                                max_images / images / image_path / mask_path / quality ...），另可带：
+                                  id:        请求 id（缺省自动生成），用于取消
+                                  transfer:  "path"（默认，结果写入 output_dir，返回文件路径）
+                                             | "shm"（结果放入共享内存，返回段名，由客户端读取后负责释放）
+                                  deadline:  整体时限（秒），见 budget
+                                  stream:    默认 true，以 NDJSON 逐行返回进度事件；false 时只返回最终 JSON
+  POST /v1/cancel/<id>          取消进行中的请求（关闭上游连接、删除未完成的下载）
+
+进度事件（每行一个 JSON）：
+  {"event": "accepted", "id": ...}
+  {"event": "started", "id": ..., "provider": ...}
+  {"event": "image", "index": i, "path": ..., "bytes": n}        或 {"event": "image", "index": i, "shm": 段名, "bytes": n}
+  {"event": "image_failed", "index": i, "error": ...}
+  {"event": "done", "id": ..., "provider": ..., "count": n, "latency": 秒}
+  {"event": "error", "id": ..., "error": ..., "cancelled": bool}
+
+共享内存：Linux 上段名对应 /dev/shm/<段名>，Node 可直接读取该文件后删除；Python 客户端用 read_shm()。
+客户端在请求完成前断开连接时，该请求自动取消。
+
+访问控制（本机任何进程与浏览器页面都能连到 localhost 端口）：
+  - POST 请求体必须是 Content-Type: application/json（浏览器跨域的简单请求无法满足，会被拒绝）；
+  - TCP 模式只接受 Host 为 127.0.0.1 / localhost / [::1] 的请求（防 DNS 重绑定）；
+    配置令牌（--token 或 IMAGE_DAEMON_TOKEN）后所有请求都需带 Authorization: Bearer <令牌>；
+  - 结果只写入启动时配置的 --output-dir，请求不能指定保存目录；
+  - images / image_path / mask_path 中的本地路径必须位于 --input-root 之下（默认为启动时的工作目录），
+    http(s) 与 data URL 不受限制。
+
+用法:
+  python daemon.py --socket /tmp/image-daemon.sock
+  python daemon.py --port 8766 --token <令牌>        # 仅监听 127.0.0.1
+  python daemon.py --socket ... --input-root ./refs --input-root /data/images
+  也可用环境变量 IMAGE_DAEMON_SOCKET / IMAGE_DAEMON_PORT / IMAGE_DAEMON_TOKEN /
+  IMAGE_DAEMON_INPUT_ROOTS（os.pathsep 分隔）指定；启动后在标准输出打印一行 "listening <地址>"。
+
+  client = daemon.DaemonClient(socket_path="/tmp/image-daemon.sock")
+  result = client.generate({"provider": "gpt_image_1", "prompt": "a cat", "n": 2}, on_event=print)
+"""
+from __future__ import annotations
+
+import argparse
+import hmac
+import http.client
+import json
+import logging
+import os
+import queue
+import select
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import batch
+import budget
+import metrics
+import resilience
+from lazy import load_env
+from output_writer import OutputWriter
+
+logger = logging.getLogger('daemon')
+
+DEFAULT_PORT = 8766
+DEFAULT_OUTPUT_DIR = "outputs"
+TRANSFERS = ("path", "shm")
+LOCAL_HOSTS = ("127.0.0.1", "localhost", "[::1]")
+
+Emit = Callable[[Dict[str, Any]], None]
+
+
+def _to_shm(data: bytes) -> str:
+    """把图片字节放入新建的共享内存段，返回段名；段的释放由客户端负责"""
+    from multiprocessing import shared_memory
+
+    try:
+        shm = shared_memory.SharedMemory(create=True, size=len(data), track=False)
+    except TypeError:
+        # Python 3.13 之前没有 track 参数：从 resource_tracker 注销，避免守护进程退出时回收客户端尚未读取的段
+        from multiprocessing import resource_tracker
+
+        shm = shared_memory.SharedMemory(create=True, size=len(data))
+        resource_tracker.unregister(shm._name, "shared_memory")
+    try:
+        shm.buf[:len(data)] = data
+        return shm.name
+    finally:
+        shm.close()
+
+
+def read_shm(name: str, size: int, *, unlink: bool = True) -> bytes:
+    """读取守护进程返回的共享内存段（默认读取后释放）"""
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+
+
+class _Delivery:
+    """按 transfer 方式交付结果图片，并产出 image 事件"""
+
+    def __init__(self, transfer: str, output_dir: str, emit: Emit):
+        self.transfer = transfer
+        self.writer = OutputWriter(output_dir)
+        self.emit = emit
+        self.count = 0
+        self.failed = 0
+
+    def send_bytes(self, index: int, data: bytes, prefix: str) -> None:
+        budget.check("save")
+        if self.transfer == "shm":
+            self.emit({"event": "image", "index": index, "shm": _to_shm(data), "bytes": len(data)})
+        else:
+            with metrics.phase("save"):
+                path = self.writer.write(data, prefix)
+            self.emit({"event": "image", "index": index, "path": path, "bytes": len(data)})
+        self.count += 1
+
+    def fail(self, index: int, error: Any) -> None:
+        self.emit({"event": "image_failed", "index": index, "error": error})
+        self.failed += 1
+
+    def send_file(self, index: int, path: str) -> None:
+        if self.transfer == "shm":
+            with open(path, "rb") as f:
+                data = f.read()
+            os.remove(path)
+            self.emit({"event": "image", "index": index, "shm": _to_shm(data), "bytes": len(data)})
+        else:
+            self.emit({"event": "image", "index": index, "path": path, "bytes": os.path.getsize(path)})
+        self.count += 1
+
+
+def _run_seedream4(job: Dict[str, Any], delivery: _Delivery) -> None:
+    import seedream
+
+    # 组图结果逐张下载完成即交付；预算与取消令牌随当前上下文传入流式生成
+    completed = False
+    for event in seedream.generate_image_with_seedream4_stream(
+        prompt=job["prompt"],
+        images=job.get("images"),
+        max_images=int(job.get("max_images", 1)),
+        size=job.get("size", "2K"),
+    ):
+        kind = event.get("type")
+        if kind == "image":
+            if event.get("local_path"):
+                delivery.send_file(event["image_index"], event["local_path"])
+            else:
+                delivery.fail(event["image_index"], event.get("error"))
+        elif kind == "image_failed":
+            delivery.fail(event["image_index"], event.get("error"))
+        elif kind == "completed":
+            completed = True
+        elif kind == "error":
+            if event.get("cancelled"):
+                raise budget.Cancelled(event.get("error"))
+            raise RuntimeError(event.get("error") or "SeeDream 4.0 生成失败")
+    if not completed:
+        raise RuntimeError("SeeDream 4.0 流式响应未正常结束")
+
+
+def _run_gpt_image_1(job: Dict[str, Any], delivery: _Delivery) -> None:
+    import gpt_image_1
+
+    # lazy=True：边读取响应边解码，每解出一张就交付，不等整份 JSON 解析完
+    images = gpt_image_1.generate_image(
+        job["prompt"],
+        job.get("image_path") or job.get("images"),
+        size=job.get("size", "1024x1024"),
+        n=int(job.get("n", 1)),
+        quality=job.get("quality", "high"),
+        model=job.get("model"),
+        mask_path=job.get("mask_path"),
+        use_base64=bool(job.get("use_base64", False)),
+        preprocess=bool(job.get("preprocess", False)),
+        lazy=True,
+    )
+    close = getattr(images, "close", None)
+    prefix = job.get("prefix", "gpt_image_1")
+    for index, data in enumerate(budget.guard(images, close)):
+        delivery.send_bytes(index, data, prefix)
+
+
+RUNNERS: Dict[str, Callable[[Dict[str, Any], _Delivery], None]] = {
+    "seedream4": _run_seedream4,
+    "gpt_image_1": _run_gpt_image_1,
+}
+
+
+def warm_up() -> Dict[str, Any]:
+    """预热：加载 .env 与配置、导入 SDK、创建共享客户端与连接池；返回各项是否就绪"""
+    state: Dict[str, Any] = {}
+    load_env()
+    for name in ("requests", "httpx", "openai", "PIL.Image", "numpy"):
+        try:
+            __import__(name)
+            state[name] = True
+        except ImportError:
+            state[name] = False
+    try:
+        import gpt_image_1
+
+        gpt_image_1._client()
+        state["gpt_image_1"] = True
+    except Exception as e:
+        logger.info(f"gpt-image-1 未预热: {e}")
+        state["gpt_image_1"] = False
+    try:
+        import seedream
+
+        seedream.SeeDream4API()
+        state["seedream4"] = True
+    except Exception as e:
+        logger.info(f"SeeDream 4.0 未预热: {e}")
+        state["seedream4"] = False
+    return state
+
+
+def _default_input_roots() -> List[str]:
+    configured = os.getenv("IMAGE_DAEMON_INPUT_ROOTS")
+    if configured:
+        return [root for root in configured.split(os.pathsep) if root]
+    return [os.getcwd()]
+
+
+class Daemon:
+    """守护进程状态：预热结果、执行线程池与进行中请求的取消令牌
+
+    input_roots: 请求中本地输入路径（参考图、遮罩）允许所在的目录，默认 IMAGE_DAEMON_INPUT_ROOTS 或当前工作目录
+    """
+
+    def __init__(self, *, max_inflight: int = 16, output_dir: str = DEFAULT_OUTPUT_DIR,
+                 input_roots: Optional[List[str]] = None):
+        self.started = time.time()
+        self.output_dir = output_dir
+        self.input_roots = [os.path.realpath(root) for root in (input_roots or _default_input_roots())]
+        self.warm: Dict[str, Any] = {}
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_inflight), thread_name_prefix="daemon")
+        # 每个请求都在预算内执行，interruptible 与对冲的线程池要能容纳全部并发请求
+        budget.reserve(max_inflight)
+        resilience.reserve(max_inflight)
+        self._inflight: Dict[str, budget.CancelToken] = {}
+        self._lock = threading.Lock()
+
+    def health(self) -> Dict[str, Any]:
+        with self._lock:
+            inflight = len(self._inflight)
+        return {
+            "ok": True,
+            "pid": os.getpid(),
+            "uptime": round(time.time() - self.started, 1),
+            "inflight": inflight,
+            "warm": self.warm,
+        }
+
+    def cancel(self, request_id: str, reason: str = "客户端取消") -> bool:
+        with self._lock:
+            token = self._inflight.get(request_id)
+        if token is None:
+            return False
+        token.cancel(reason)
+        return True
+
+    def _check_input(self, value: Any, field: str) -> None:
+        """本地路径必须位于 input_roots 之下（解析符号链接后判断）；URL 与 data URL 直接放行"""
+        if not isinstance(value, str):
+            raise ValueError(f"{field} 必须是 URL 或本地路径字符串")
+        if value.startswith(("http://", "https://", "data:")):
+            return
+        path = os.path.realpath(value)
+        for root in self.input_roots:
+            if os.path.commonpath([root, path]) == root:
+                return
+        raise ValueError(f"{field} 不在允许的输入目录内: {value}")
+
+    def _check_inputs(self, job: Dict[str, Any]) -> None:
+        for field in ("image_path", "images"):
+            value = job.get(field)
+            if not value:
+                continue
+            for item in (value if isinstance(value, list) else [value]):
+                self._check_input(item, field)
+        if job.get("mask_path"):
+            self._check_input(job["mask_path"], "mask_path")
+        prefix = job.get("prefix")
+        if prefix is not None and (not isinstance(prefix, str) or os.path.basename(prefix) != prefix
+                                   or prefix.startswith(".")):
+            raise ValueError("prefix 只能是文件名前缀，不能包含路径")
+
+    def submit(self, job: Dict[str, Any]) -> Tuple["queue.Queue[Optional[Dict[str, Any]]]", budget.CancelToken]:
+        """校验请求并提交执行，返回 (事件队列, 取消令牌)；队列中 None 表示结束，参数有误时抛出 ValueError"""
+        if not job.get("prompt"):
+            raise ValueError("请求缺少 prompt")
+        if "output_dir" in job:
+            raise ValueError("不支持按请求指定 output_dir，结果写入守护进程启动时配置的目录")
+        self._check_inputs(job)
+        provider = batch.infer_provider(job)
+        runner = RUNNERS.get(provider)
+        if runner is None:
+            raise ValueError(f"不支持的 provider: {provider}")
+        transfer = job.get("transfer", "path")
+        if transfer not in TRANSFERS:
+            raise ValueError(f"transfer 仅支持 {TRANSFERS}")
+        deadline = job.get("deadline")
+        deadline = float(deadline) if deadline is not None else None
+        request_id = str(job.get("id") or uuid.uuid4().hex)
+        token = budget.CancelToken()
+        with self._lock:
+            if request_id in self._inflight:
+                raise ValueError(f"请求 id 已在执行中: {request_id}")
+            self._inflight[request_id] = token
+
+        events: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+        events.put({"event": "accepted", "id": request_id})
+        delivery = _Delivery(transfer, self.output_dir, events.put)
+
+        def run() -> None:
+            started = time.perf_counter()
+            try:
+                events.put({"event": "started", "id": request_id, "provider": provider})
+                with budget.scope(deadline, token):
+                    runner(job, delivery)
+                if delivery.count == 0:
+                    # 一张图片都没有拿到（上游未返回结果或全部失败）：不能当作成功
+                    raise RuntimeError(f"{provider} 未返回任何图片（失败 {delivery.failed} 张）")
+                events.put({
+                    "event": "done",
+                    "id": request_id,
+                    "provider": provider,
+                    "count": delivery.count,
+                    "latency": round(time.perf_counter() - started, 3),
+                })
+            except Exception as e:
+                logger.warning(f"请求 {request_id} 失败: {e}")
+                events.put({
+                    "event": "error",
+                    "id": request_id,
+                    "error": str(e),
+                    "cancelled": isinstance(e, budget.Cancelled),
+                })
+            finally:
+                with self._lock:
+                    self._inflight.pop(request_id, None)
+                events.put(None)
+
+        self.executor.submit(run)
+        return events, token
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    daemon: Daemon
+    # TCP 模式下允许的 Host 头（None 表示不检查，即 Unix socket）与访问令牌
+    allowed_hosts: Optional[frozenset] = None
+    token: Optional[str] = None
+
+    def log_message(self, format: str, *args) -> None:
+        # Unix socket 没有客户端地址，统一记入日志而不是 stderr
+        logger.debug(format % args)
+
+    def _send_json(self, payload: Any, status: int = 200) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self) -> bool:
+        """检查 Host 与访问令牌，不通过时直接回复错误并关闭连接（请求体未读取）"""
+        error = None
+        if self.allowed_hosts is not None and (self.headers.get("Host") or "").lower() not in self.allowed_hosts:
+            error = ({"error": "不接受的 Host"}, 403)
+        elif self.token and not hmac.compare_digest(
+            (self.headers.get("Authorization") or "").encode("utf-8"), f"Bearer {self.token}".encode("utf-8")
+        ):
+            error = ({"error": "缺少或错误的访问令牌"}, 401)
+        if error is None:
+            return True
+        self._send_json(*error)
+        self.close_connection = True
+        return False
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length") or 0)
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if not isinstance(payload, dict):
+            raise ValueError("请求体必须是 JSON 对象")
+        return payload
+
+    def _client_gone(self) -> bool:
+        """客户端是否已断开（可读且读到 EOF）"""
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            return bool(readable) and self.connection.recv(1, socket.MSG_PEEK) == b""
+        except OSError:
+            return True
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        path = self.path.split("?")[0]
+        if path == "/health":
+            self._send_json(self.daemon.health())
+            return
+        if path == "/metrics":
+            body = metrics.export_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        path = self.path.split("?")[0]
+        content_type = (self.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+        if content_type != "application/json":
+            # 浏览器跨域的简单请求（text/plain 等）不经预检即可发出，一律拒绝
+            self._send_json({"error": "Content-Type 必须是 application/json"}, 415)
+            self.close_connection = True
+            return
+        try:
+            payload = self._read_json()
+        except ValueError as e:
+            self._send_json({"error": f"无效的请求体: {e}"}, 400)
+            return
+        if path.startswith("/v1/cancel/"):
+            found = self.daemon.cancel(path[len("/v1/cancel/"):], payload.get("reason") or "客户端取消")
+            self._send_json({"cancelled": found}, 200 if found else 404)
+            return
+        if path != "/v1/generate":
+            self._send_json({"error": "not found"}, 404)
+            return
+        try:
+            events, token = self.daemon.submit(payload)
+        except ValueError as e:
+            self._send_json({"error": str(e)}, 400)
+            return
+        if payload.get("stream", True):
+            self._stream(events, token)
+        else:
+            self._collect(events, token)
+
+    def _next_events(self, events: "queue.Queue[Optional[Dict[str, Any]]]", token: budget.CancelToken
+                     ) -> Iterator[Dict[str, Any]]:
+        """依次取出事件；等待期间客户端断开时取消请求"""
+        while True:
+            try:
+                event = events.get(timeout=0.5)
+            except queue.Empty:
+                if not token.cancelled and self._client_gone():
+                    token.cancel("客户端已断开")
+                continue
+            if event is None:
+                return
+            yield event
+
+    def _stream(self, events, token: budget.CancelToken) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for event in self._next_events(events, token):
+            raw = (json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8")
+            try:
+                self.wfile.write(f"{len(raw):x}\r\n".encode() + raw + b"\r\n")
+                self.wfile.flush()
+            except OSError:
+                token.cancel("客户端已断开")
+                self.close_connection = True
+        if not self.close_connection:
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+    def _collect(self, events, token: budget.CancelToken) -> None:
+        result: Dict[str, Any] = {"images": [], "failed": []}
+        status = 200
+        for event in self._next_events(events, token):
+            kind = event.pop("event")
+            if kind == "image":
+                result["images"].append(event)
+            elif kind == "image_failed":
+                result["failed"].append(event)
+            elif kind == "error":
+                status = 499 if event.get("cancelled") else 500
+                result.update(event)
+            else:
+                result.update(event)
+        self._send_json(result, status)
+
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(
+    daemon: Daemon,
+    *,
+    socket_path: Optional[str] = None,
+    host: str = "127.0.0.1",
+    port: int = DEFAULT_PORT,
+    token: Optional[str] = None,
+):
+    """创建 HTTP 服务：给出 socket_path 时监听 Unix socket，否则监听 host:port
+
+    token: 访问令牌，缺省取 IMAGE_DAEMON_TOKEN；设置后所有请求需带 Authorization: Bearer <令牌>
+    """
+    attrs: Dict[str, Any] = {"daemon": daemon, "token": token or os.getenv("IMAGE_DAEMON_TOKEN") or None}
+    if socket_path:
+        handler = type("DaemonHandler", (_Handler,), attrs)
+        if os.path.exists(socket_path):
+            # 上次未正常退出遗留的 socket 文件
+            os.remove(socket_path)
+        server = _UnixHTTPServer(socket_path, handler)
+        os.chmod(socket_path, 0o660)
+        return server
+    handler = type("DaemonHandler", (_Handler,), attrs)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    bound_port = server.server_address[1]
+    names = set(LOCAL_HOSTS) | {host.lower()}
+    handler.allowed_hosts = frozenset(names | {f"{name}:{bound_port}" for name in names})
+    return server
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class DaemonClient:
+    """守护进程的 Python 客户端（单个实例复用一条长连接，不可跨线程共享）"""
+
+    def __init__(self, socket_path: Optional[str] = None, host: str = "127.0.0.1", port: int = DEFAULT_PORT,
+                 timeout: Optional[float] = None, token: Optional[str] = None):
+        self.socket_path = socket_path or os.getenv("IMAGE_DAEMON_SOCKET")
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.token = token or os.getenv("IMAGE_DAEMON_TOKEN")
+        self._conn: Optional[http.client.HTTPConnection] = None
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if self._conn is None:
+            if self.socket_path:
+                self._conn = _UnixConnection(self.socket_path, self.timeout)
+            else:
+                self._conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return self._conn
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _request(self, method: str, path: str, payload: Optional[Dict[str, Any]] = None) -> http.client.HTTPResponse:
+        body = json.dumps(payload or {}, ensure_ascii=False).encode("utf-8") if method == "POST" else None
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        for retry in (True, False):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                return conn.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # 长连接被服务端关闭：重新连接一次
+                self.close()
+                if not retry:
+                    raise
+        raise RuntimeError("unreachable")
+
+    def health(self) -> Dict[str, Any]:
+        return json.loads(self._request("GET", "/health").read())
+
+    def cancel(self, request_id: str, reason: Optional[str] = None) -> bool:
+        response = self._request("POST", f"/v1/cancel/{request_id}", {"reason": reason} if reason else {})
+        return bool(json.loads(response.read()).get("cancelled"))
+
+    def generate(self, job: Dict[str, Any], *, on_event: Optional[Emit] = None) -> Dict[str, Any]:
+        """提交请求并逐行读取进度事件，返回 {"id", "provider", "images", "failed", "latency"}；失败时抛出 RuntimeError"""
+        response = self._request("POST", "/v1/generate", {**job, "stream": True})
+        if response.status != 200:
+            raise RuntimeError(f"守护进程返回 {response.status}: {response.read().decode('utf-8', 'replace')}")
+        result: Dict[str, Any] = {"images": [], "failed": []}
+        error: Optional[Dict[str, Any]] = None
+        for line in iter(response.readline, b""):
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if on_event is not None:
+                on_event(event)
+            kind = event.get("event")
+            if kind == "image":
+                result["images"].append(event)
+            elif kind == "image_failed":
+                result["failed"].append(event)
+            elif kind == "error":
+                error = event
+            elif kind in ("accepted", "done"):
+                result.update({k: v for k, v in event.items() if k != "event"})
+        if error is not None:
+            raise RuntimeError(error.get("error") or "生成失败")
+        return result
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="常驻图像生成守护进程")
+    parser.add_argument("--socket", default=os.getenv("IMAGE_DAEMON_SOCKET"), help="监听的 Unix socket 路径")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=int(os.getenv("IMAGE_DAEMON_PORT", DEFAULT_PORT)))
+    parser.add_argument("--max-inflight", type=int, default=16, help="同时执行的生成请求数")
+    parser.add_argument("--output-dir", default=DEFAULT_OUTPUT_DIR)
+    parser.add_argument("--input-root", action="append", dest="input_roots",
+                        help="允许读取本地参考图/遮罩的目录（可重复），默认 IMAGE_DAEMON_INPUT_ROOTS 或当前工作目录")
+    parser.add_argument("--token", default=os.getenv("IMAGE_DAEMON_TOKEN"), help="访问令牌（TCP 模式建议设置）")
+    parser.add_argument("--no-warm", action="store_true", help="启动时不预热客户端")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    daemon = Daemon(max_inflight=args.max_inflight, output_dir=args.output_dir, input_roots=args.input_roots)
+    if not args.no_warm:
+        started = time.perf_counter()
+        daemon.warm = warm_up()
+        logger.info(f"预热完成 {time.perf_counter() - started:.2f}s: {daemon.warm}")
+    server = make_server(daemon, socket_path=args.socket, host=args.host, port=args.port, token=args.token)
+    address = args.socket or f"{server.server_address[0]}:{server.server_address[1]}"
+    print(f"listening {address}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+        daemon.executor.shutdown(wait=False)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,242 @@
+"""
+结果图下载：并发、分块落盘、断点续传
+
+- download_file(url, filepath)：流式分块写入 <filepath>.part，完成后原子重命名为目标文件；
+  传输中断时按已写入的字节数发送 HTTP Range 请求续传，内存占用与图片大小无关。
+- adownload_file(client, url, filepath)：异步版本（httpx.AsyncClient，aiter_bytes 分块），行为相同。
+- download_all([(url, filepath), ...], workers=4)：同一批结果并行下载，总耗时取决于最慢的一张。
+- 续传时校验 206 响应的 Content-Range 起点与已下载字节数一致，不一致时丢弃 .part 从头下载。
+- 在 budget 预算内下载时：读超时不超过剩余时间，每块写盘前检查是否已超时或被取消，
+  中断时关闭连接并删除 .part 文件（调用方已放弃，不再保留续传进度）；
+  其他不可恢复的错误（如 4xx）与续传次数用尽时同样删除 .part 文件。
+"""
+from __future__ import annotations
+
+import contextvars
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple, Union
+
+import budget
+import http_pool
+from lazy import lazy_import
+
+requests = lazy_import("requests")
+httpx = lazy_import("httpx")
+asyncio = lazy_import("asyncio")
+
+logger = logging.getLogger('downloader')
+
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+_CONTENT_RANGE = re.compile(r"bytes\s+(\d+)-\d+/(?:\d+|\*)")
+
+
+class IncompleteDownload(ConnectionError):
+    """读取到的字节数与 Content-Length 不符（连接提前结束），可从断点续传"""
+
+
+def _part_path(filepath: str) -> str:
+    return f"{filepath}.part"
+
+
+def _discard(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _write_mode(status_code: int, offset: int, headers) -> Optional[str]:
+    """根据响应决定 .part 的写入方式："ab" 续写、"wb" 从头写；续传范围与已下载字节数不符时返回 None"""
+    if not offset or status_code != 206:
+        # 服务端不支持 Range 时返回 200 与完整内容，从头写入
+        return "wb"
+    match = _CONTENT_RANGE.match(headers.get("Content-Range") or "")
+    if match is None or int(match.group(1)) != offset:
+        return None
+    return "ab"
+
+
+def _expected_length(headers) -> Optional[int]:
+    # 带 Content-Encoding 时 Content-Length 是压缩后的长度，无法直接比较
+    if headers.get("Content-Encoding"):
+        return None
+    length = headers.get("Content-Length")
+    return int(length) if length is not None else None
+
+
+def download_file(
+    url: str,
+    filepath: str,
+    *,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    timeout: float = 30,
+    max_attempts: int = 3,
+) -> str:
+    """下载 url 到 filepath，返回 filepath。
+
+    参数:
+      - chunk_size: 每次写盘的块大小（字节）
+      - timeout: 单次读超时（秒）
+      - max_attempts: 连接中断时的最大尝试次数（每次从已下载位置续传）
+    """
+    directory = os.path.dirname(filepath)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    part_path = _part_path(filepath)
+    session = http_pool.get_session(url)
+
+    last_error: Optional[Exception] = None
+    for attempt in range(1, max_attempts + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=http_pool.timeout(timeout)) as response:
+                if response.status_code == 416:
+                    # 服务端认为范围无效（文件已变化或 .part 异常），丢弃后重新下载
+                    os.remove(part_path)
+                    last_error = requests.HTTPError(f"416 Range Not Satisfiable: {url}")
+                    continue
+                response.raise_for_status()
+
+                mode = _write_mode(response.status_code, offset, response.headers)
+                if mode is None:
+                    # 返回的范围与 .part 对不上，续写会得到损坏的文件：丢弃后重新下载
+                    _discard(part_path)
+                    last_error = IncompleteDownload(
+                        f"续传范围不符: 期望从 {offset} 开始，Content-Range 为 {response.headers.get('Content-Range')}"
+                    )
+                    logger.warning(f"{last_error}，重新下载")
+                    continue
+
+                expected = _expected_length(response.headers)
+                written = 0
+                with open(part_path, mode) as f:
+                    for chunk in budget.guard(response.iter_content(chunk_size=chunk_size), response.close):
+                        if chunk:
+                            f.write(chunk)
+                            written += len(chunk)
+                if expected is not None and written != expected:
+                    raise IncompleteDownload(f"下载不完整: 期望 {expected} 字节，实际 {written} 字节")
+
+            os.replace(part_path, filepath)
+            return filepath
+
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+                IncompleteDownload) as e:
+            last_error = e
+            logger.warning(f"下载中断（第 {attempt}/{max_attempts} 次），将从断点续传: {e}")
+        except BaseException:
+            # 超时、取消或不可恢复的错误（如 HTTP 4xx）：不再续传，删除 .part
+            _discard(part_path)
+            raise
+
+    _discard(part_path)
+    raise Exception(f"下载失败: {url}: {last_error}")
+
+
+async def adownload_file(
+    client: "httpx.AsyncClient",
+    url: str,
+    filepath: str,
+    *,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    timeout: float = 30,
+    max_attempts: int = 3,
+) -> str:
+    """download_file 的异步版本：用 client 流式下载 url 到 filepath，返回 filepath；写盘在线程中执行"""
+    directory = os.path.dirname(filepath)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    part_path = _part_path(filepath)
+
+    last_error: Optional[Exception] = None
+    for attempt in range(1, max_attempts + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        f = None
+        try:
+            async with client.stream(
+                "GET", url, headers=headers, timeout=http_pool.httpx_timeout(timeout)
+            ) as response:
+                if response.status_code == 416:
+                    _discard(part_path)
+                    last_error = IncompleteDownload(f"416 Range Not Satisfiable: {url}")
+                    continue
+                response.raise_for_status()
+
+                mode = _write_mode(response.status_code, offset, response.headers)
+                if mode is None:
+                    _discard(part_path)
+                    last_error = IncompleteDownload(
+                        f"续传范围不符: 期望从 {offset} 开始，Content-Range 为 {response.headers.get('Content-Range')}"
+                    )
+                    logger.warning(f"{last_error}，重新下载")
+                    continue
+
+                expected = _expected_length(response.headers)
+                written = 0
+                f = await asyncio.to_thread(open, part_path, mode)
+                async for chunk in response.aiter_bytes(chunk_size):
+                    budget.check("download")
+                    if chunk:
+                        await asyncio.to_thread(f.write, chunk)
+                        written += len(chunk)
+                await asyncio.to_thread(f.close)
+                f = None
+                if expected is not None and written != expected:
+                    raise IncompleteDownload(f"下载不完整: 期望 {expected} 字节，实际 {written} 字节")
+
+            os.replace(part_path, filepath)
+            return filepath
+
+        except (httpx.TransportError, IncompleteDownload) as e:
+            last_error = e
+            logger.warning(f"下载中断（第 {attempt}/{max_attempts} 次），将从断点续传: {e}")
+        except BaseException:
+            # 超时、取消（任务被取消时为 CancelledError）或不可恢复的错误：不再续传，删除 .part
+            if f is not None:
+                f.close()
+                f = None
+            _discard(part_path)
+            raise
+        finally:
+            if f is not None:
+                f.close()
+
+    _discard(part_path)
+    raise Exception(f"下载失败: {url}: {last_error}")
+
+
+def download_all(
+    items: Sequence[Tuple[str, str]],
+    *,
+    workers: int = 4,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    timeout: float = 30,
+    max_attempts: int = 3,
+) -> List[Union[str, Exception]]:
+    """并行下载一批 (url, filepath)，按输入顺序返回保存路径；失败项返回对应异常。"""
+    if not items:
+        return []
+
+    def _one(item: Tuple[str, str]) -> Union[str, Exception]:
+        url, filepath = item
+        try:
+            return download_file(
+                url, filepath, chunk_size=chunk_size, timeout=timeout, max_attempts=max_attempts
+            )
+        except Exception as e:
+            return e
+
+    if workers <= 1 or len(items) == 1:
+        return [_one(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as pool:
+        # 在调用方上下文中下载，预算与指标埋点随之传递
+        futures = [pool.submit(contextvars.copy_context().run, _one, item) for item in items]
+        return [future.result() for future in futures]
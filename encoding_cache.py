@@ -0,0 +1,209 @@
+"""
+参考图编码缓存：按内容摘要记忆 base64 / data URL 结果
+
+- 同一张参考图反复用于不同 prompt 时，跳过读文件、PNG 编码与 base64 编码。
+- 文件路径按 (绝对路径, mtime, size) 记忆其内容摘要，命中时连文件都不读；
+  字节、文件对象与 PIL Image 按内容摘要命中。
+- MIME 由文件头嗅探（PNG/JPEG/WebP/GIF/BMP/TIFF/AVIF/HEIC），不再一律标为 image/png。
+- 内存上限：IMAGE_ENCODING_CACHE_BYTES（默认 256MB），超出时按 LRU 淘汰。
+"""
+from __future__ import annotations
+
+import base64
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def sniff_mime(head: bytes) -> Optional[str]:
+    """根据文件头识别图片 MIME，无法识别时返回 None"""
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if head.startswith(b"BM"):
+        return "image/bmp"
+    if head.startswith((b"II*\x00", b"MM\x00*")):
+        return "image/tiff"
+    if head[4:8] == b"ftyp":
+        brand = head[8:12]
+        if brand in (b"avif", b"avis"):
+            return "image/avif"
+        if brand in (b"heic", b"heix", b"mif1", b"msf1"):
+            return "image/heic"
+    return None
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class EncodingCache:
+    """内容摘要 -> data URL 的 LRU 缓存（线程安全）"""
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # 摘要 -> (data URL, base64 部分的起始下标)
+        self._payloads: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        self._bytes = 0
+        # (绝对路径, mtime_ns, size) -> 摘要
+        self._file_digests: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # ---- 摘要 ----
+
+    def _stat_key(self, path: str) -> Tuple[str, int, int]:
+        st = os.stat(path)
+        return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+    def file_digest(self, path: str) -> str:
+        """文件内容摘要；路径、mtime 与大小未变时直接复用上次的结果"""
+        key = self._stat_key(path)
+        with self._lock:
+            digest = self._file_digests.get(key)
+            if digest is not None:
+                self._file_digests.move_to_end(key)
+                return digest
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        self._remember_file(key, digest)
+        return digest
+
+    def _remember_file(self, key: Tuple[str, int, int], digest: str) -> None:
+        with self._lock:
+            self._file_digests[key] = digest
+            # 只存摘要，条目很小；数量上限防止无限增长
+            while len(self._file_digests) > 4096:
+                self._file_digests.popitem(last=False)
+
+    # ---- 编码 ----
+
+    def _lookup(self, digest: str) -> Optional[Tuple[str, int]]:
+        with self._lock:
+            payload = self._payloads.get(digest)
+            if payload is not None:
+                self._payloads.move_to_end(digest)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return payload
+
+    def _store(self, digest: str, data: bytes, mime: str) -> Tuple[str, int]:
+        prefix = f"data:{mime};base64,"
+        payload = (prefix + base64.b64encode(data).decode("ascii"), len(prefix))
+        size = len(payload[0])
+        if size > self.max_bytes:
+            return payload
+        with self._lock:
+            if digest not in self._payloads:
+                self._payloads[digest] = payload
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    _, (old, _) = self._payloads.popitem(last=False)
+                    self._bytes -= len(old)
+        return payload
+
+    def encode(
+        self,
+        image_input: Any,
+        *,
+        as_data_url: bool = True,
+        fallback_mime: str = "image/png",
+    ) -> str:
+        """将图片输入编码为 data URL（或纯 base64）。
+
+        image_input 支持文件路径、字节、文件对象与 PIL Image。
+        fallback_mime 用于无法从文件头识别格式的情况。
+        """
+        data: Optional[bytes] = None
+        mime: Optional[str] = None
+        if isinstance(image_input, str):
+            stat_key = self._stat_key(image_input)
+            with self._lock:
+                digest = self._file_digests.get(stat_key)
+            if digest is None:
+                with open(image_input, "rb") as f:
+                    data = f.read()
+                digest = _sha256(data)
+                self._remember_file(stat_key, digest)
+        elif isinstance(image_input, (bytes, bytearray, memoryview)):
+            data = bytes(image_input)
+            digest = _sha256(data)
+        elif hasattr(image_input, "read"):
+            data = image_input.read()
+            if hasattr(image_input, "seek"):
+                image_input.seek(0)  # 重置文件指针
+            digest = _sha256(data)
+        elif hasattr(image_input, "tobytes") and hasattr(image_input, "save"):
+            # PIL Image：按像素摘要命中，未命中时才编码为 PNG
+            h = hashlib.sha256(f"{image_input.mode}:{image_input.size}".encode("utf-8"))
+            h.update(image_input.tobytes())
+            digest = "pil:" + h.hexdigest()
+            mime = "image/png"
+        else:
+            raise ValueError(f"不支持的图片输入类型: {type(image_input)}")
+
+        payload = self._lookup(digest)
+        if payload is None:
+            if data is None:
+                if mime == "image/png":
+                    buffer = io.BytesIO()
+                    image_input.save(buffer, format="PNG")
+                    data = buffer.getvalue()
+                else:
+                    with open(image_input, "rb") as f:
+                        data = f.read()
+            mime = mime or sniff_mime(data[:32]) or fallback_mime
+            payload = self._store(digest, data, mime)
+
+        data_url, b64_start = payload
+        return data_url if as_data_url else data_url[b64_start:]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._payloads.clear()
+            self._file_digests.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._payloads),
+                "bytes": self._bytes,
+            }
+
+
+def _default_max_bytes() -> int:
+    try:
+        return int(os.getenv("IMAGE_ENCODING_CACHE_BYTES", DEFAULT_MAX_BYTES))
+    except ValueError:
+        return DEFAULT_MAX_BYTES
+
+
+default_cache = EncodingCache(_default_max_bytes())
+
+
+def encode_image(image_input: Any, *, as_data_url: bool = True, fallback_mime: str = "image/png") -> str:
+    """使用进程级默认缓存编码图片"""
+    return default_cache.encode(image_input, as_data_url=as_data_url, fallback_mime=fallback_mime)
+
+
+def file_digest(path: str) -> str:
+    """使用进程级默认缓存计算文件摘要"""
+    return default_cache.file_digest(path)
@@ -0,0 +1,116 @@
+"""
+大批量请求拆分：把 n / max_images 较大的一次请求拆成若干并行子请求
+
+- plan(total, shard_size) 把总数拆成每份不超过 shard_size 的分片；
+- run_shards() 在至多 concurrency 个线程中执行各分片，结果按分片顺序合并；
+- 某个分片失败不影响其他分片，全部跑完后只重试以可重试错误失败的分片（至多 retries 轮）：
+  错误按 resilience.classify_error 归类，参数错误、内容审核、鉴权失败等不可重试的错误直接记为失败；
+- 配额：每个子请求在发送前各自经过 rate_limiter（按本分片的图片数计），不会超出部署配额；
+- 子请求在调用方的 contextvars 上下文中运行，指标计入同一次调用。
+
+用法:
+    result = fanout.run_shards(lambda count, index: generate(n=count), total=10, shard_size=2)
+    result.items        # 成功分片的结果按顺序拼接
+    result.failed       # 最终仍失败的分片 [ShardFailure(index, count, error)]
+"""
+from __future__ import annotations
+
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Generic, List, Sequence, TypeVar
+
+import resilience
+
+logger = logging.getLogger('fanout')
+
+T = TypeVar("T")
+
+
+@dataclass
+class ShardFailure:
+    index: int
+    count: int
+    error: BaseException
+
+    def as_dict(self) -> Dict[str, object]:
+        return {"index": self.index, "count": self.count, "error": str(self.error)}
+
+
+@dataclass
+class FanoutResult(Generic[T]):
+    items: List[T] = field(default_factory=list)
+    failed: List[ShardFailure] = field(default_factory=list)
+    shards: int = 0
+    retried: int = 0
+
+    @property
+    def partial(self) -> bool:
+        return bool(self.failed) and bool(self.items)
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed
+
+
+def plan(total: int, shard_size: int) -> List[int]:
+    """拆分总数：前面的分片取 shard_size，余数放在最后一片"""
+    if total < 1:
+        raise ValueError("total 必须为正整数")
+    if shard_size < 1:
+        raise ValueError("shard_size 必须为正整数")
+    counts = [shard_size] * (total // shard_size)
+    if total % shard_size:
+        counts.append(total % shard_size)
+    return counts
+
+
+def run_shards(
+    fn: Callable[[int, int], Sequence[T]],
+    total: int,
+    *,
+    shard_size: int,
+    concurrency: int = 4,
+    retries: int = 1,
+) -> FanoutResult[T]:
+    """并行执行 fn(count, index) 并按分片顺序合并结果；以可重试错误失败的分片在后续轮次中单独重试"""
+    counts = plan(total, shard_size)
+    outputs: Dict[int, Sequence[T]] = {}
+    errors: Dict[int, BaseException] = {}
+    pending = list(range(len(counts)))
+    retried = 0
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(counts))), thread_name_prefix="fanout") as pool:
+        for round_ in range(retries + 1):
+            if round_:
+                retried += len(pending)
+                logger.warning(f"重试 {len(pending)} 个失败分片（第 {round_} 轮）")
+            futures = {
+                index: pool.submit(contextvars.copy_context().run, fn, counts[index], index)
+                for index in pending
+            }
+            failed = []
+            for index, future in futures.items():
+                try:
+                    outputs[index] = future.result()
+                    errors.pop(index, None)
+                except Exception as e:
+                    errors[index] = e
+                    retryable, _ = resilience.classify_error(e)
+                    if retryable:
+                        logger.warning(f"分片 {index}（{counts[index]} 张）失败: {e}")
+                        failed.append(index)
+                    else:
+                        logger.warning(f"分片 {index}（{counts[index]} 张）失败，错误不可重试: {e}")
+            pending = failed
+            if not pending:
+                break
+
+    result: FanoutResult[T] = FanoutResult(shards=len(counts), retried=retried)
+    for index in range(len(counts)):
+        if index in outputs:
+            result.items.extend(outputs[index])
+        else:
+            result.failed.append(ShardFailure(index, counts[index], errors[index]))
+    return result
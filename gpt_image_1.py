@@ -9,47 +9,145 @@ Azure OpenAI gpt-image-1 通用工具：支持文生图与图生图
 - 提供两个核心函数：
   1) text_to_image(prompt, size="1024x1024", n=1, quality="high")
   2) image_to_image(image_path, prompt, size="1024x1024", n=1, quality="high", mask_path=None)
+     image_path 可以是多张参考图的路径列表（最多 16 张），各参考图的读取/预处理/编码并发执行
+
+- 局部编辑：image_to_image / image_to_image_with_base64 传 region=True 且遮罩只覆盖小块区域时，
+  只上传该区域的裁剪图，返回的补丁在本地羽化合成回原图（见 region_edit）。
+
+- 异步版本：AsyncGptImage1(max_concurrency=...) 提供同名的 text_to_image / image_to_image /
+  image_to_image_with_base64 / generate_image 协程方法，返回结构与同步函数一致。
 
 - 返回值：均返回 List[bytes]，每个元素为 PNG 图片的原始字节，可配合 save_images 保存到本地。
+  传 lazy=True 时改为返回 ImageStream：逐张按需解码，或经 save_images 直接流式解码到文件，
+  内存只与单张图片相关。
+
+- 时限与取消：各公开函数（含 AsyncGptImage1 的方法）接受 deadline=整体时限（秒）与 cancel=budget.CancelToken()，
+  编码、上传、等待上游、解码、保存各阶段共用剩余时间，超时抛出 budget.DeadlineExceeded，取消抛出 budget.Cancelled。
+
+- 连接：所有请求复用 http_pool 中按主机共享的保活连接池，可用 http_pool.pool_stats() 查看复用情况。
 
 注意：不要在代码中硬编码密钥，默认从环境变量读取。
 """
 from __future__ import annotations
 
 import base64
+import logging
 import os
 import mimetypes
-from typing import List, Optional
+import threading
+import time
+from contextlib import ExitStack
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import budget
+import encoding_cache
+import fanout
+import http_pool
+import metrics
+import postprocess
+import rate_limiter
+import region_edit
+import resilience
+import singleflight
+from output_writer import OutputWriter
+from result_stream import ImageStream
+import streaming_body
+from preprocess import PreparedImage, map_inputs, prepare_image, prepare_mask
+from resilience import RetryPolicy
+from lazy import lazy_import, load_env
+from result_cache import ResultCache, try_request_key
+
+if TYPE_CHECKING:
+    from openai import AzureOpenAI
 
-import requests
-from openai import AzureOpenAI
-# 新增：在模块内加载 .env，确保直接运行该文件也能读取环境变量
-from dotenv import load_dotenv, find_dotenv
-load_dotenv(find_dotenv(), override=False)
+# openai SDK 导入需要数百毫秒，首次创建客户端时才加载；import gpt_image_1 只需几毫秒
+asyncio = lazy_import("asyncio")
+httpx = lazy_import("httpx")
+openai = lazy_import("openai")
+
+logger = logging.getLogger('gpt_image_1')
+
+
+@dataclass(frozen=True)
+class AzureConfig:
+    """Azure OpenAI 连接配置"""
+    endpoint: Optional[str]
+    api_key: Optional[str]
+    deployment: Optional[str]
+    # API 版本：images.generate 与 images/edits 目前使用不同的预览版本
+    api_version_image: str
+    api_version_edits: str
+
+    @classmethod
+    def from_env(cls) -> "AzureConfig":
+        return cls(
+            endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+            deployment=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME", "gpt-image-1"),
+            api_version_image=os.getenv("AZURE_OPENAI_API_VERSION", "2025-03-01-preview"),
+            api_version_edits=os.getenv("AZURE_OPENAI_API_VERSION_EDITS", "2025-04-01-preview"),
+        )
 
-# API 版本：images.generate 与 images/edits 目前使用不同的预览版本
-API_VERSION_IMAGE = os.getenv("AZURE_OPENAI_API_VERSION", "2025-03-01-preview")
-API_VERSION_EDITS = os.getenv("AZURE_OPENAI_API_VERSION_EDITS", "2025-04-01-preview")
 
-# 读取环境变量
-AZURE_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
-AZURE_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
-DEPLOYMENT_NAME = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME", "gpt-image-1")
+_config: Optional[AzureConfig] = None
+_config_lock = threading.Lock()
 
 
-def _ensure_env():
+def get_config() -> AzureConfig:
+    """首次使用时加载 .env 并读取环境变量，之后复用"""
+    global _config
+    config = _config
+    if config is None:
+        with _config_lock:
+            if _config is None:
+                load_env()
+                _config = AzureConfig.from_env()
+            config = _config
+    return config
+
+
+def reload_config() -> AzureConfig:
+    """重新加载 .env 与环境变量（如轮换密钥后），并丢弃按旧配置缓存的同步 SDK 客户端"""
+    global _config
+    with _config_lock:
+        load_env(force=True)
+        _config = AzureConfig.from_env()
+        _clients.clear()
+        return _config
+
+
+# 兼容旧代码中的模块级常量（gpt_image_1.DEPLOYMENT_NAME 等），读取时按当前配置解析
+_LEGACY_NAMES = {
+    "API_VERSION_IMAGE": "api_version_image",
+    "API_VERSION_EDITS": "api_version_edits",
+    "AZURE_ENDPOINT": "endpoint",
+    "AZURE_API_KEY": "api_key",
+    "DEPLOYMENT_NAME": "deployment",
+}
+
+
+def __getattr__(name: str):
+    if name in _LEGACY_NAMES:
+        return getattr(get_config(), _LEGACY_NAMES[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _ensure_env() -> AzureConfig:
+    config = get_config()
     missing = []
-    if not AZURE_ENDPOINT:
+    if not config.endpoint:
         missing.append("AZURE_OPENAI_ENDPOINT")
-    if not AZURE_API_KEY:
+    if not config.api_key:
         missing.append("AZURE_OPENAI_API_KEY")
-    if not DEPLOYMENT_NAME:
+    if not config.deployment:
         missing.append("AZURE_OPENAI_DEPLOYMENT_NAME")
     if missing:
         raise RuntimeError(
             "缺少必要环境变量: " + ", ".join(missing) +
             ". 请在 .env 或系统环境中配置。"
         )
+    return config
 
 
 def _image_mime_by_path(path: str) -> str:
@@ -57,15 +155,188 @@ def _image_mime_by_path(path: str) -> str:
     return mime or "image/png"
 
 
-def _client() -> AzureOpenAI:
-    _ensure_env()
-    return AzureOpenAI(
-        azure_endpoint=AZURE_ENDPOINT,
-        api_key=AZURE_API_KEY,
-        api_version=API_VERSION_IMAGE,
+def _sniff_mime_by_path(path: str) -> str:
+    """按文件头识别 MIME，识别不了再按扩展名"""
+    with open(path, "rb") as f:
+        head = f.read(32)
+    return encoding_cache.sniff_mime(head) or _image_mime_by_path(path)
+
+
+# images/edits 单次最多接受的参考图数量
+MAX_REFERENCE_IMAGES = 16
+
+ImagePaths = Union[str, Sequence[str]]
+
+
+def _as_paths(image_path: ImagePaths) -> List[str]:
+    """单个路径或路径列表统一为列表，并校验数量"""
+    paths = [image_path] if isinstance(image_path, (str, os.PathLike)) else list(image_path)
+    if not paths:
+        raise ValueError("至少需要一张输入图片")
+    if len(paths) > MAX_REFERENCE_IMAGES:
+        raise ValueError(f"输入图片最多 {MAX_REFERENCE_IMAGES} 张，实际 {len(paths)} 张")
+    return [os.fspath(path) for path in paths]
+
+
+def _check_inputs(image_paths: List[str], mask_path: Optional[str]) -> None:
+    for path in image_paths:
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"找不到输入图片: {path}")
+    if mask_path and not os.path.isfile(mask_path):
+        raise FileNotFoundError(f"找不到遮罩图片: {mask_path}")
+
+
+def _gather(outcomes: List[Any]) -> List[Any]:
+    """map_inputs 的结果中有失败项时抛出第一个异常"""
+    for outcome in outcomes:
+        if isinstance(outcome, Exception):
+            raise outcome
+    return outcomes
+
+
+def _preprocess_inputs(
+    image_paths: List[str], mask_path: Optional[str], size: str
+) -> Tuple[List[PreparedImage], Optional[PreparedImage]]:
+    """按输出尺寸并发缩放/压缩全部输入图，遮罩缩放到第一张图的尺寸；记录节省的上传字节数。"""
+    with metrics.phase("encode"):
+        images = _gather(map_inputs(lambda path: prepare_image(path, size), image_paths))
+        mask = prepare_mask(mask_path, (images[0].width, images[0].height)) if mask_path else None
+    saved = sum(image.bytes_saved for image in images) + (mask.bytes_saved if mask else 0)
+    logger.info(f"gpt-image-1 上传预处理节省 {saved} 字节（{len(images)} 张参考图）")
+    return images, mask
+
+
+def _check_region(region: bool, lazy: bool) -> None:
+    if region and lazy:
+        # 补丁要全部解码后才能合成回原图，逐张解码的 ImageStream 无从谈起
+        raise ValueError("region=True 不支持 lazy=True")
+
+
+def _region_crop(
+    image_paths: List[str], mask_path: Optional[str], margin: int
+) -> Optional[region_edit.RegionCrop]:
+    """region=True 时计算裁剪区域；区域过大或有多张参考图时返回 None（整图上传）"""
+    if not mask_path:
+        raise ValueError("region=True 需要提供 mask_path")
+    if len(image_paths) > 1:
+        logger.info("多张参考图不支持局部编辑，改为整图上传")
+        return None
+    with metrics.phase("encode"):
+        crop = region_edit.crop_to_region(image_paths[0], mask_path, margin=margin)
+    if crop is not None:
+        logger.info(f"gpt-image-1 局部编辑节省上传 {crop.bytes_saved} 字节（上传尺寸 {crop.size}）")
+    return crop
+
+
+def _composite_region(crop: region_edit.RegionCrop, patches: List[bytes]) -> List[bytes]:
+    """把返回的各张补丁并发合成回原图"""
+    budget.check("composite")
+    with metrics.phase("composite"):
+        return _gather(map_inputs(crop.composite, patches))
+
+
+def _edits_url(model: Optional[str], config: Optional[AzureConfig] = None) -> str:
+    config = config or get_config()
+    return (
+        f"{config.endpoint}/openai/deployments/"
+        f"{model or config.deployment}/images/edits"
+        f"?api-version={config.api_version_edits}"
     )
 
 
+_RESPONSE_CHUNK_SIZE = 64 * 1024
+
+
+def _stream_result(resp) -> ImageStream:
+    """将流式响应包装为惰性结果"""
+    return ImageStream(resp.iter_content(chunk_size=_RESPONSE_CHUNK_SIZE), resp.close)
+
+
+def _post_edits(
+    url: str,
+    headers: Dict[str, str],
+    body: streaming_body.StreamingBody,
+    timeout: int,
+    lazy: bool,
+    retry_policy: Optional[RetryPolicy],
+    *,
+    deployment: str,
+    n: int,
+) -> Union[List[bytes], ImageStream]:
+    """发送 images/edits 请求；429/5xx 与网络错误按 retry_policy 重试（请求体可重复发送）"""
+    policy = retry_policy or resilience.DEFAULT_POLICY
+
+    def attempt(cancel):
+        # 多进程共享的部署配额：不足时排队等待
+        rate_limiter.throttle("azure_openai", "images/edits", deployment, n)
+        # 请求体发送完毕的时刻把耗时拆分为 upload 与 upstream；超时或取消时在下一块处中断上传
+        timed = metrics.TimedBody(body)
+        started = time.perf_counter()
+        resp = http_pool.get_session(url).post(
+            url, headers=headers, data=budget.GuardedBody(timed), timeout=http_pool.timeout(timeout), stream=lazy
+        )
+        finished = time.perf_counter()
+        if timed.upload_done is not None:
+            metrics.add_phase("upstream", finished - timed.upload_done)
+        else:
+            metrics.add_phase("request", finished - started)
+        if cancel.is_set():
+            resp.close()
+            raise resilience.AttemptCancelled()
+        resilience.check_response(resp, policy)
+        if not resp.ok:
+            resp.close()
+        resp.raise_for_status()
+        return resp
+
+    resp = resilience.execute(attempt, policy, key="gpt_image_1:edits")
+    if lazy:
+        return _stream_result(resp)
+    metrics.add_bytes(received=len(resp.content))
+    with metrics.phase("response"):
+        payload = resp.json()
+    return _decode_b64_items(payload.get("data", []) or [])
+
+
+def _decode_b64_items(items: List[dict]) -> List[bytes]:
+    budget.check("decode")
+    images: List[bytes] = []
+    with metrics.phase("decode"):
+        for item in items:
+            b64 = item.get("b64_json")
+            if b64:
+                images.append(base64.b64decode(b64))
+    return images
+
+
+# AzureOpenAI 客户端按 (endpoint, key, api_version) 缓存，底层共用 http_pool 的保活连接
+_clients: Dict[Tuple[str, str, str], AzureOpenAI] = {}
+
+
+def _client() -> AzureOpenAI:
+    config = _ensure_env()
+    key = (config.endpoint, config.api_key, config.api_version_image)
+    client = _clients.get(key)
+    if client is None:
+        client = openai.AzureOpenAI(
+            azure_endpoint=config.endpoint,
+            api_key=config.api_key,
+            api_version=config.api_version_image,
+            http_client=http_pool.get_httpx_client(config.endpoint),
+            # 重试统一交给 resilience，避免 SDK 内部重试与之叠加
+            max_retries=0,
+        )
+        _clients[key] = client
+    return client
+
+
+def _sdk_options() -> Dict[str, Any]:
+    """openai SDK 调用的超时：在有时限的 budget 预算内时不超过剩余时间，否则沿用 SDK 默认"""
+    return {"timeout": http_pool.httpx_timeout()} if budget.remaining() is not None else {}
+
+
+@budget.bounded
+@metrics.traced("gpt_image_1", "images/generations")
 def text_to_image(
     prompt: str,
     *,
@@ -73,7 +344,9 @@ def text_to_image(
     n: int = 1,
     quality: str = "high",
     model: Optional[str] = None,
-) -> List[bytes]:
+    lazy: bool = False,
+    retry_policy: Optional[RetryPolicy] = None,
+) -> Union[List[bytes], ImageStream]:
     """文生图：返回 n 张 PNG 图像的字节数组列表。
 
     参数:
@@ -82,28 +355,64 @@ def text_to_image(
       - n: 生成数量 (1-10，依据配额)
       - quality: "high" | "standard"
       - model: 可选，默认使用 DEPLOYMENT_NAME
+      - lazy: True 时返回 ImageStream，不一次性解码全部结果
+      - retry_policy: 可选重试/对冲策略，默认 resilience.DEFAULT_POLICY
     """
     if not prompt or not prompt.strip():
         raise ValueError("prompt 不能为空")
 
     client = _client()
-    resp = client.images.generate(
-        model=model or DEPLOYMENT_NAME,
+    params = dict(
+        model=model or get_config().deployment,
         prompt=prompt,
         size=size,
         n=int(n),
         quality=quality,
     )
+    policy = retry_policy or resilience.DEFAULT_POLICY
+
+    if lazy:
+        # 使用原始流式响应，跳过 SDK 对整份 JSON 的解析
+        def attempt_raw(cancel):
+            rate_limiter.throttle("azure_openai", "images/generations", params["model"], params["n"])
+            stack = ExitStack()
+            with metrics.phase("request"):
+                raw = stack.enter_context(client.images.with_streaming_response.generate(**params, **_sdk_options()))
+            metrics.add_bytes(sent=len(raw.http_request.content))
+            if cancel.is_set():
+                stack.close()
+                raise resilience.AttemptCancelled()
+            return raw, stack
+
+        raw, stack = resilience.execute(
+            attempt_raw, policy, key="gpt_image_1:generations", discard=lambda result: result[1].close()
+        )
+        return ImageStream(raw.iter_bytes(_RESPONSE_CHUNK_SIZE), stack.close)
+
+    def attempt(cancel):
+        rate_limiter.throttle("azure_openai", "images/generations", params["model"], params["n"])
+        # with_raw_response 以便统计收发字节数，解析结果与 generate() 相同
+        with metrics.phase("request"):
+            raw = client.images.with_raw_response.generate(**params, **_sdk_options())
+        metrics.add_bytes(sent=len(raw.http_request.content), received=len(raw.http_response.content))
+        with metrics.phase("response"):
+            return raw.parse()
+
+    resp = resilience.execute(attempt, policy, key="gpt_image_1:generations")
+    budget.check("decode")
     images: List[bytes] = []
-    for item in getattr(resp, "data", []) or []:
-        b64 = getattr(item, "b64_json", None)
-        if b64:
-            images.append(base64.b64decode(b64))
+    with metrics.phase("decode"):
+        for item in getattr(resp, "data", []) or []:
+            b64 = getattr(item, "b64_json", None)
+            if b64:
+                images.append(base64.b64decode(b64))
     return images
 
 
+@budget.bounded
+@metrics.traced("gpt_image_1", "images/edits")
 def image_to_image(
-    image_path: str,
+    image_path: ImagePaths,
     prompt: str,
     *,
     size: str = "1024x1024",
@@ -112,40 +421,65 @@ def image_to_image(
     model: Optional[str] = None,
     mask_path: Optional[str] = None,
     timeout: int = 180,
-) -> List[bytes]:
+    preprocess: bool = False,
+    lazy: bool = False,
+    retry_policy: Optional[RetryPolicy] = None,
+    region: bool = False,
+    region_margin: int = region_edit.DEFAULT_MARGIN,
+) -> Union[List[bytes], ImageStream]:
     """图生图（编辑）：基于输入图片与提示词生成 n 张图像。
 
     参数:
-      - image_path: 源图片路径（必填）
+      - image_path: 源图片路径，或多张参考图的路径列表（最多 MAX_REFERENCE_IMAGES 张，均以 image[] 上传）
       - prompt: 编辑说明/生成提示
       - size: 输出尺寸，如 "1024x1024"
       - n: 生成数量
       - quality: "high" | "standard"
       - model: 可选，默认使用 DEPLOYMENT_NAME
-      - mask_path: 可选遮罩图路径（黑白图，黑色区域会被替换）
+      - mask_path: 可选遮罩图路径（黑白图，黑色区域会被替换；多张参考图时作用于第一张）
       - timeout: 请求超时（秒），默认 120 秒
+      - preprocess: 上传前按 size 并发缩放、压缩全部输入图并去除元数据，遮罩同步缩放
+      - lazy: True 时返回 ImageStream，不一次性解码全部结果
+      - retry_policy: 可选重试/对冲策略，默认 resilience.DEFAULT_POLICY
+      - region: 局部编辑，只上传遮罩外接框（外扩 region_margin 像素）的裁剪图，按裁剪比例选用支持的 size，
+        结果在本地合成回原图，返回原图尺寸的 PNG；此时忽略 size / preprocess。
+        合成需要完整的补丁，不能与 lazy=True 同时使用（抛出 ValueError）。遮罩区域过大时自动退回整图上传
     """
-    _ensure_env()
-    if not os.path.isfile(image_path):
-        raise FileNotFoundError(f"找不到输入图片: {image_path}")
+    config = _ensure_env()
+    image_paths = _as_paths(image_path)
+    _check_inputs(image_paths, mask_path)
+    _check_region(region, lazy)
 
-    url = (
-        f"{AZURE_ENDPOINT}/openai/deployments/"
-        f"{model or DEPLOYMENT_NAME}/images/edits"
-        f"?api-version={API_VERSION_EDITS}"
-    )
+    url = _edits_url(model, config)
+    crop = _region_crop(image_paths, mask_path, region_margin) if region else None
 
-    files = {
-        # Azure 期望字段名为 image[]
-        "image[]": (os.path.basename(image_path), open(image_path, "rb"), _image_mime_by_path(image_path)),
-    }
-    if mask_path:
-        if not os.path.isfile(mask_path):
-            raise FileNotFoundError(f"找不到遮罩图片: {mask_path}")
-        files["mask"] = (os.path.basename(mask_path), open(mask_path, "rb"), _image_mime_by_path(mask_path))
+    # 文件内容在发送时逐块读出，句柄随请求体迭代结束立即关闭
+    if crop is not None:
+        size = crop.size
+        files = {
+            "image[]": [(f"region.{crop.image.extension}", crop.image.data, crop.image.mime)],
+            "mask": ("mask.png", crop.mask.data, crop.mask.mime),
+        }
+    elif preprocess:
+        images, mask = _preprocess_inputs(image_paths, mask_path, size)
+        files = {
+            "image[]": [
+                (f"{os.path.splitext(os.path.basename(path))[0]}.{image.extension}", image.data, image.mime)
+                for path, image in zip(image_paths, images)
+            ],
+        }
+        if mask:
+            files["mask"] = ("mask.png", mask.data, mask.mime)
+    else:
+        files = {
+            # Azure 期望字段名为 image[]，多张参考图重复该字段
+            "image[]": [(os.path.basename(path), path, _image_mime_by_path(path)) for path in image_paths],
+        }
+        if mask_path:
+            files["mask"] = (os.path.basename(mask_path), mask_path, _image_mime_by_path(mask_path))
 
     data = {
-        "model": model or DEPLOYMENT_NAME,
+        "model": model or config.deployment,
         "prompt": prompt,
         "size": size,
         "n": str(int(n)),
@@ -153,33 +487,64 @@ def image_to_image(
         # 可以按需新增如 background, style 等参数（若 API 支持）
     }
 
-    headers = {
-        "api-key": AZURE_API_KEY,
-    }
+    body = streaming_body.multipart_body(data, files)
+    headers = streaming_body.headers_for(body, {
+        "api-key": config.api_key,
+    })
 
-    resp = requests.post(url, headers=headers, files=files, data=data, timeout=timeout)
-    resp.raise_for_status()
-    payload = resp.json()
-    images: List[bytes] = []
-    for item in payload.get("data", []) or []:
-        b64 = item.get("b64_json")
-        if b64:
-            images.append(base64.b64decode(b64))
-    return images
+    images = _post_edits(url, headers, body, timeout, lazy, retry_policy, deployment=data["model"], n=int(n))
+    return _composite_region(crop, images) if crop is not None else images
+
+
+@budget.bounded
+def save_images(
+    images: Union[Iterable[bytes], ImageStream],
+    output_dir: str = "outputs",
+    prefix: str = "gpt_image_1",
+    *,
+    naming: str = "hash",
+    workers: int = 4,
+    fsync: str = "none",
+) -> List[str]:
+    """将图片字节保存为文件，返回保存路径列表。
 
+    文件名为 <prefix>_<内容哈希>.png（naming="uuid" 时为随机 UUID），经临时文件原子重命名写入，
+    多个并发任务共享同一输出目录也不会互相覆盖；列表输入由 workers 个线程并行写盘。
+    fsync: "none" | "each" | "batch"，见 output_writer。
+
+    images 可以是 List[bytes]、任意字节迭代器，或 lazy=True 返回的 ImageStream
+    （后者直接从响应流解码写盘，不在内存中生成完整列表）。
+    """
+    budget.check("save")
+    writer = OutputWriter(output_dir, naming=naming, workers=workers, fsync=fsync)
+    with metrics.phase("save"):
+        if isinstance(images, ImageStream):
+            return images.save(output_dir, prefix, writer=writer)
+        if not images:
+            return []
+        return writer.write_many(images, prefix)
+
+
+def save_images_with_variants(
+    images: Union[Iterable[bytes], ImageStream],
+    output_dir: str = "outputs",
+    prefix: str = "gpt_image_1",
+    *,
+    variants: Any = True,
+    **kwargs,
+) -> List[Dict[str, Any]]:
+    """保存图片并生成缩略图/分发格式变体（见 postprocess），其余参数同 save_images。
 
-def save_images(images: List[bytes], output_dir: str = "outputs", prefix: str = "gpt_image_1") -> List[str]:
-    """将字节数组列表保存为 PNG 文件，返回保存路径列表。"""
-    if not images:
-        return []
-    os.makedirs(output_dir, exist_ok=True)
-    saved = []
-    for idx, data in enumerate(images, 1):
-        path = os.path.join(output_dir, f"{prefix}_{idx}.png")
-        with open(path, "wb") as f:
-            f.write(data)
-        saved.append(path)
-    return saved
+    返回 [{"local_path": ..., "bytes": 原图字节数, "variants": [{name, path, bytes, width, height}, ...]}]。
+    """
+    variant_list = postprocess.parse_variants(variants)
+    paths = save_images(images, output_dir, prefix, **kwargs)
+    with metrics.phase("postprocess"):
+        mapping = postprocess.process_paths(paths, variant_list)
+    return [
+        {"local_path": path, "bytes": os.path.getsize(path), "variants": mapping.get(path, [])}
+        for path in paths
+    ]
 
 # 新增：将本地图片转为 base64（可选 data URL 格式）
 def encode_image_to_base64(image_path: str, *, as_data_url: bool = True) -> str:
@@ -193,14 +558,16 @@ def encode_image_to_base64(image_path: str, *, as_data_url: bool = True) -> str:
     """
     if not os.path.isfile(image_path):
         raise FileNotFoundError(f"找不到输入图片: {image_path}")
-    mime = _image_mime_by_path(image_path)
-    with open(image_path, "rb") as f:
-        b64 = base64.b64encode(f.read()).decode("utf-8")
-    return (f"data:{mime};base64,{b64}") if as_data_url else b64
+    # 结果按文件摘要缓存；MIME 优先按文件头识别，识别不了再按扩展名
+    return encoding_cache.encode_image(
+        image_path, as_data_url=as_data_url, fallback_mime=_image_mime_by_path(image_path)
+    )
 
 # 新增：以 base64 的方式调用 Azure images/edits（直接作为 JSON 的 image 参数）
+@budget.bounded
+@metrics.traced("gpt_image_1", "images/edits")
 def image_to_image_with_base64(
-    image_path: str,
+    image_path: ImagePaths,
     prompt: str,
     *,
     size: str = "1024x1024",
@@ -210,56 +577,72 @@ def image_to_image_with_base64(
     mask_path: Optional[str] = None,
     use_data_url: bool = True,
     timeout: int = 120,
-) -> List[bytes]:
+    preprocess: bool = False,
+    lazy: bool = False,
+    retry_policy: Optional[RetryPolicy] = None,
+    region: bool = False,
+    region_margin: int = region_edit.DEFAULT_MARGIN,
+) -> Union[List[bytes], ImageStream]:
     """图生图（使用 base64 直传）
 
     与 image_to_image 的区别：不走 multipart 文件上传，而是把图片以 base64（默认 data URL）
-    放在 JSON body 的 image 字段中（mask 同理）。
+    放在 JSON body 的 image 字段中（mask 同理）。base64 在发送时逐块编码，不在内存中拼出完整请求。
     注意：该用法依赖服务端是否支持 base64 直传。
     参数:
+      - image_path: 源图片路径或路径列表；多张时 image 字段为字符串数组
       - timeout: 请求超时（秒），默认 120 秒
+      - preprocess: 上传前按 size 缩放、压缩输入图并去除元数据，遮罩同步缩放
+      - lazy: True 时返回 ImageStream，不一次性解码全部结果
+      - retry_policy: 可选重试/对冲策略，默认 resilience.DEFAULT_POLICY
+      - region / region_margin: 局部编辑，同 image_to_image（同样不能与 lazy=True 同时使用）
     """
-    _ensure_env()
-    url = (
-        f"{AZURE_ENDPOINT}/openai/deployments/"
-        f"{model or DEPLOYMENT_NAME}/images/edits"
-        f"?api-version={API_VERSION_EDITS}"
-    )
+    config = _ensure_env()
+    url = _edits_url(model, config)
+    image_paths = _as_paths(image_path)
+    _check_inputs(image_paths, mask_path)
+    _check_region(region, lazy)
+    crop = _region_crop(image_paths, mask_path, region_margin) if region else None
+    if crop is not None:
+        size = crop.size
 
-    image_b64 = encode_image_to_base64(image_path, as_data_url=use_data_url)
     payload = {
-        "model": model or DEPLOYMENT_NAME,
+        "model": model or config.deployment,
         "prompt": prompt,
         "size": size,
         "n": int(n),
         "quality": quality,
-        "image": image_b64,
     }
+    # 图片在发送时才逐块 base64 编码写入 socket，内存中不保留完整的 base64 字符串
+    if crop is not None:
+        entries = [(crop.image.data, crop.image.mime if use_data_url else None)]
+        mask_entry = (crop.mask.data, crop.mask.mime if use_data_url else None)
+    elif preprocess:
+        prepared, prepared_mask = _preprocess_inputs(image_paths, mask_path, size)
+        entries = [(image.data, image.mime if use_data_url else None) for image in prepared]
+        mask_entry = (prepared_mask.data, prepared_mask.mime if use_data_url else None) if prepared_mask else None
+    else:
+        # MIME 需读取文件头，多张参考图并发识别
+        mimes = _gather(map_inputs(_sniff_mime_by_path, image_paths)) if use_data_url else [None] * len(image_paths)
+        entries = list(zip(image_paths, mimes))
+        mask_entry = (mask_path, _sniff_mime_by_path(mask_path) if use_data_url else None) if mask_path else None
+    # 单张参考图保持字符串形式，与原有请求格式一致
+    files = {"image": entries if len(entries) > 1 else entries[0]}
+    if mask_entry:
+        files["mask"] = mask_entry
 
-    if mask_path:
-        if not os.path.isfile(mask_path):
-            raise FileNotFoundError(f"找不到遮罩图片: {mask_path}")
-        payload["mask"] = encode_image_to_base64(mask_path, as_data_url=use_data_url)
+    body = streaming_body.json_body(payload, files)
+    headers = streaming_body.headers_for(body, {
+        "api-key": config.api_key,
+    })
 
-    headers = {
-        "api-key": AZURE_API_KEY,
-        "Content-Type": "application/json",
-    }
-
-    resp = requests.post(url, headers=headers, json=payload, timeout=timeout)
-    resp.raise_for_status()
-    payload = resp.json()
-    images: List[bytes] = []
-    for item in payload.get("data", []) or []:
-        b64 = item.get("b64_json")
-        if b64:
-            images.append(base64.b64decode(b64))
-    return images
+    images = _post_edits(url, headers, body, timeout, lazy, retry_policy, deployment=payload["model"], n=int(n))
+    return _composite_region(crop, images) if crop is not None else images
 
 
+@budget.bounded
 def generate_image(
     prompt: str,
-    image_path: Optional[str] = None,
+    image_path: Optional[ImagePaths] = None,
     *,
     size: str = "1024x1024",
     n: int = 1,
@@ -268,7 +651,14 @@ def generate_image(
     mask_path: Optional[str] = None,
     use_base64: bool = False,
     timeout: int = 180,
-) -> List[bytes]:
+    cache: Optional[ResultCache] = None,
+    preprocess: bool = False,
+    lazy: bool = False,
+    retry_policy: Optional[RetryPolicy] = None,
+    coalesce: bool = False,
+    shard_size: Optional[int] = None,
+    shard_concurrency: int = 4,
+) -> Union[List[bytes], ImageStream]:
     """通用生图函数
 
     - 不传 image_path => 文生图（text_to_image）
@@ -276,7 +666,7 @@ def generate_image(
 
     参数:
       - prompt: 提示词
-      - image_path: 可选，作为图生图输入图像路径；不传则执行文生图
+      - image_path: 可选，作为图生图输入图像路径（或多张参考图的路径列表）；不传则执行文生图
       - size: 输出尺寸，例如 "1024x1024"
       - n: 生成数量
       - quality: "high" | "standard"
@@ -284,11 +674,97 @@ def generate_image(
       - mask_path: 可选遮罩图（仅图生图有效）
       - use_base64: True 时使用 base64 直传通道（依赖服务端支持）
       - timeout: 请求超时（秒），默认 120 秒
+      - cache: 可选 ResultCache；相同 prompt/参数/输入图的请求直接返回缓存结果
+      - preprocess: 图生图时先缩放、压缩输入图再上传（仅图生图有效）
+      - lazy: True 时返回 ImageStream（逐张解码）；此时结果不写入 cache，但仍会读取已有缓存
+      - retry_policy: 可选重试/对冲策略，默认 resilience.DEFAULT_POLICY
+      - coalesce: 默认关闭；开启后相同 prompt/参数/输入图的请求正在进行时，挂在其结果上而不重复请求上游
+        （生成结果不确定，合并的调用方会拿到同一批图片；lazy 或输入图无法读取时不合并）
+      - shard_size: n 大于该值时拆成每份至多 shard_size 张的子请求，至多 shard_concurrency 个并行（见 fanout）；
+        结果按分片顺序合并，只重试以可重试错误（429/5xx、网络中断）失败的分片；
+        部分分片最终失败时返回已成功的图片（少于 n 张，不写入 cache），
+        全部失败时抛出第一个分片的异常。lazy=True 时不拆分
+      - deadline / cancel: 整体时限（秒）与 budget.CancelToken，覆盖排队、编码、上传、等待上游与解码；
+        带任一参数的调用不参与 coalesce（见 budget）
     返回: List[bytes] 每个元素为 PNG 字节
     """
+    # ImageStream 只能消费一次，无法共享给多个调用者；带时限或取消令牌的调用不与他人共享上游请求
+    coalesce = coalesce and not lazy and budget.current() is None
+    cache_key = None
+    if cache is not None or coalesce:
+        cache_key = try_request_key(
+            "gpt_image_1",
+            model=model or get_config().deployment,
+            prompt=prompt,
+            size=size,
+            count=n,
+            quality=quality,
+            references=_as_paths(image_path) if image_path else (),
+            mask=mask_path if image_path else None,
+        )
+        if cache_key is None:
+            # 输入图无法读取：不缓存也不合并，照常请求并由图生图逻辑报告错误
+            cache, coalesce = None, False
+    if cache is not None:
+        entry = cache.get(cache_key)
+        if entry is not None:
+            return entry.read_all()
+
+    if coalesce:
+        return singleflight.default_group.do(
+            cache_key,
+            lambda: _generate_uncached(
+                prompt, image_path, size, n, quality, model, mask_path, use_base64,
+                timeout, cache, cache_key, preprocess, lazy, retry_policy, shard_size, shard_concurrency,
+            ),
+        )
+    return _generate_uncached(
+        prompt, image_path, size, n, quality, model, mask_path, use_base64,
+        timeout, cache, cache_key, preprocess, lazy, retry_policy, shard_size, shard_concurrency,
+    )
+
+
+def _generate_uncached(
+    prompt: str,
+    image_path: Optional[ImagePaths],
+    size: str,
+    n: int,
+    quality: str,
+    model: Optional[str],
+    mask_path: Optional[str],
+    use_base64: bool,
+    timeout: int,
+    cache: Optional[ResultCache],
+    cache_key: Optional[str],
+    preprocess: bool,
+    lazy: bool,
+    retry_policy: Optional[RetryPolicy],
+    shard_size: Optional[int] = None,
+    shard_concurrency: int = 4,
+) -> Union[List[bytes], ImageStream]:
+    """按参数路由到文生图/图生图，成功后写入结果缓存"""
+    if shard_size and int(n) > shard_size and not lazy:
+        return _generate_sharded(
+            prompt, image_path, size, int(n), quality, model, mask_path, use_base64,
+            timeout, cache, cache_key, preprocess, retry_policy, shard_size, shard_concurrency,
+        )
     if image_path:
         if use_base64:
-            return image_to_image_with_base64(
+            images = image_to_image_with_base64(
+                image_path,
+                prompt,
+                size=size,
+                n=n,
+                quality=quality,
+                model=model,
+                mask_path=mask_path,
+                timeout=timeout,
+                preprocess=preprocess,
+                lazy=lazy,
+                retry_policy=retry_policy,
+            )
+        else:
+            images = image_to_image(
                 image_path,
                 prompt,
                 size=size,
@@ -297,25 +773,323 @@ def generate_image(
                 model=model,
                 mask_path=mask_path,
                 timeout=timeout,
+                preprocess=preprocess,
+                lazy=lazy,
+                retry_policy=retry_policy,
             )
-        return image_to_image(
-            image_path,
+    else:
+        # 文生图
+        images = text_to_image(
+            prompt,
+            size=size,
+            n=n,
+            quality=quality,
+            model=model,
+            lazy=lazy,
+            retry_policy=retry_policy,
+        )
+
+    if cache is not None and images and not isinstance(images, ImageStream):
+        cache.put(cache_key, images, meta={"provider": "gpt_image_1", "prompt": prompt})
+    return images
+
+
+def _generate_sharded(
+    prompt: str,
+    image_path: Optional[ImagePaths],
+    size: str,
+    n: int,
+    quality: str,
+    model: Optional[str],
+    mask_path: Optional[str],
+    use_base64: bool,
+    timeout: int,
+    cache: Optional[ResultCache],
+    cache_key: Optional[str],
+    preprocess: bool,
+    retry_policy: Optional[RetryPolicy],
+    shard_size: int,
+    shard_concurrency: int,
+) -> List[bytes]:
+    """把 n 张拆成并行子请求，合并成功分片的结果；全部成功时才写入结果缓存"""
+    def shard(count: int, index: int) -> List[bytes]:
+        return _generate_uncached(
+            prompt, image_path, size, count, quality, model, mask_path, use_base64,
+            timeout, None, None, preprocess, False, retry_policy,
+        )
+
+    endpoint = "images/edits" if image_path else "images/generations"
+    with metrics.call("gpt_image_1", endpoint, size):
+        result = fanout.run_shards(shard, n, shard_size=shard_size, concurrency=shard_concurrency)
+        if not result.items:
+            raise result.failed[0].error
+        if result.failed:
+            metrics.set_status("partial")
+            logger.warning(
+                f"gpt-image-1 拆分请求部分失败：成功 {len(result.items)}/{n} 张，"
+                f"失败分片 {[f.as_dict() for f in result.failed]}"
+            )
+            return result.items
+    if cache is not None:
+        cache.put(cache_key, result.items, meta={"provider": "gpt_image_1", "prompt": prompt})
+    return result.items
+
+
+class AsyncGptImage1:
+    """gpt-image-1 异步客户端：基于 httpx.AsyncClient，方法与模块级同步函数一一对应。
+
+    max_concurrency 限制本客户端同时在途的请求数，单个事件循环即可维持大量并发生成。
+    用法：
+        async with AsyncGptImage1(max_concurrency=100) as client:
+            images = await client.generate_image("a cat", n=1)
+    """
+
+    def __init__(self, max_concurrency: int = 64, retry_policy: Optional[RetryPolicy] = None):
+        # 客户端绑定创建时的配置；reload_config() 之后新建的客户端才会使用新配置
+        self.config = _ensure_env()
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # 429/5xx 与网络错误的重试、退避与可选对冲策略（与同步函数共用 resilience）
+        self.retry_policy = retry_policy or resilience.DEFAULT_POLICY
+        self.http = http_pool.new_async_client(max_connections=max_concurrency)
+        self._openai = openai.AsyncAzureOpenAI(
+            azure_endpoint=self.config.endpoint,
+            api_key=self.config.api_key,
+            api_version=self.config.api_version_image,
+            http_client=self.http,
+            # 重试统一交给 resilience，避免 SDK 内部重试与之叠加
+            max_retries=0,
+        )
+
+    async def __aenter__(self) -> "AsyncGptImage1":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self.http.aclose()
+
+    @budget.bounded
+    @metrics.traced("gpt_image_1", "images/generations")
+    async def text_to_image(
+        self,
+        prompt: str,
+        *,
+        size: str = "1024x1024",
+        n: int = 1,
+        quality: str = "high",
+        model: Optional[str] = None,
+    ) -> List[bytes]:
+        """文生图（异步），参数同 text_to_image。"""
+        if not prompt or not prompt.strip():
+            raise ValueError("prompt 不能为空")
+
+        deployment = model or self.config.deployment
+
+        async def attempt():
+            async with self._semaphore:
+                await rate_limiter.athrottle("azure_openai", "images/generations", deployment, int(n))
+                with metrics.phase("request"):
+                    raw = await self._openai.images.with_raw_response.generate(
+                        model=deployment,
+                        prompt=prompt,
+                        size=size,
+                        n=int(n),
+                        quality=quality,
+                        **_sdk_options(),
+                    )
+            metrics.add_bytes(sent=len(raw.http_request.content), received=len(raw.http_response.content))
+            with metrics.phase("response"):
+                return raw.parse()
+
+        resp = await resilience.aexecute(attempt, self.retry_policy, key="gpt_image_1:generations")
+        items = [{"b64_json": getattr(item, "b64_json", None)} for item in getattr(resp, "data", []) or []]
+        return await asyncio.to_thread(_decode_b64_items, items)
+
+    async def _post_edits(
+        self,
+        url: str,
+        timeout: int,
+        deployment: str,
+        n: int,
+        body: Optional[streaming_body.StreamingBody] = None,
+        **kwargs,
+    ) -> List[bytes]:
+        """发送 images/edits 请求；429/5xx 与网络错误按 retry_policy 重试（流式请求体每次尝试重新迭代）"""
+        async def attempt():
+            async with self._semaphore:
+                await rate_limiter.athrottle("azure_openai", "images/edits", deployment, n)
+                with metrics.phase("request"):
+                    resp = await self.http.post(
+                        url,
+                        content=body.aiter() if body is not None else None,
+                        timeout=http_pool.httpx_timeout(timeout),
+                        **kwargs,
+                    )
+            metrics.add_bytes(sent=int(resp.request.headers.get("content-length", 0)), received=len(resp.content))
+            resilience.check_response(resp, self.retry_policy)
+            resp.raise_for_status()
+            return resp
+
+        resp = await resilience.aexecute(attempt, self.retry_policy, key="gpt_image_1:edits")
+        with metrics.phase("response"):
+            payload = resp.json()
+        return await asyncio.to_thread(_decode_b64_items, payload.get("data", []) or [])
+
+    @budget.bounded
+    @metrics.traced("gpt_image_1", "images/edits")
+    async def image_to_image(
+        self,
+        image_path: ImagePaths,
+        prompt: str,
+        *,
+        size: str = "1024x1024",
+        n: int = 1,
+        quality: str = "high",
+        model: Optional[str] = None,
+        mask_path: Optional[str] = None,
+        timeout: int = 180,
+    ) -> List[bytes]:
+        """图生图（异步，multipart 上传），参数同 image_to_image；文件内容在发送时逐块读出，不整体读入内存。"""
+        image_paths = _as_paths(image_path)
+        _check_inputs(image_paths, mask_path)
+
+        files = {
+            "image[]": [(os.path.basename(path), path, _image_mime_by_path(path)) for path in image_paths],
+        }
+        if mask_path:
+            files["mask"] = (os.path.basename(mask_path), mask_path, _image_mime_by_path(mask_path))
+        data = {
+            "model": model or self.config.deployment,
+            "prompt": prompt,
+            "size": size,
+            "n": str(int(n)),
+            "quality": quality,
+        }
+        body = streaming_body.multipart_body(data, files)
+        headers = streaming_body.headers_for(body, {"api-key": self.config.api_key})
+        return await self._post_edits(
+            _edits_url(model, self.config), timeout, data["model"], int(n), body, headers=headers
+        )
+
+    @budget.bounded
+    @metrics.traced("gpt_image_1", "images/edits")
+    async def image_to_image_with_base64(
+        self,
+        image_path: ImagePaths,
+        prompt: str,
+        *,
+        size: str = "1024x1024",
+        n: int = 1,
+        quality: str = "high",
+        model: Optional[str] = None,
+        mask_path: Optional[str] = None,
+        use_data_url: bool = True,
+        timeout: int = 120,
+    ) -> List[bytes]:
+        """图生图（异步，base64 直传），参数同 image_to_image_with_base64；多张参考图并发编码。"""
+        image_paths = _as_paths(image_path)
+        _check_inputs(image_paths, mask_path)
+        with metrics.phase("encode"):
+            paths = image_paths + ([mask_path] if mask_path else [])
+            encoded = await asyncio.gather(
+                *(asyncio.to_thread(encode_image_to_base64, path, as_data_url=use_data_url) for path in paths)
+            )
+            images = encoded[:len(image_paths)]
+            payload = {
+                "model": model or self.config.deployment,
+                "prompt": prompt,
+                "size": size,
+                "n": int(n),
+                "quality": quality,
+                "image": images if len(images) > 1 else images[0],
+            }
+            if mask_path:
+                payload["mask"] = encoded[-1]
+
+        return await self._post_edits(
+            _edits_url(model, self.config), timeout, payload["model"], int(n),
+            headers={"api-key": self.config.api_key}, json=payload
+        )
+
+    @budget.bounded
+    async def generate_image(
+        self,
+        prompt: str,
+        image_path: Optional[ImagePaths] = None,
+        *,
+        size: str = "1024x1024",
+        n: int = 1,
+        quality: str = "high",
+        model: Optional[str] = None,
+        mask_path: Optional[str] = None,
+        use_base64: bool = False,
+        timeout: int = 180,
+        coalesce: bool = False,
+    ) -> List[bytes]:
+        """通用生图（异步），参数与路由规则同 generate_image；coalesce=True 时同一事件循环内的相同请求只发送一次。"""
+        def generate():
+            return self._generate(prompt, image_path, size, n, quality, model, mask_path, use_base64, timeout)
+
+        if not coalesce or budget.current() is not None:
+            return await generate()
+        key = await asyncio.to_thread(
+            try_request_key,
+            "gpt_image_1",
+            model=model or self.config.deployment,
+            prompt=prompt,
+            size=size,
+            count=n,
+            quality=quality,
+            references=_as_paths(image_path) if image_path else (),
+            mask=mask_path if image_path else None,
+        )
+        if key is None:
+            return await generate()
+        return await singleflight.default_group.ado(key, generate)
+
+    async def _generate(
+        self,
+        prompt: str,
+        image_path: Optional[ImagePaths],
+        size: str,
+        n: int,
+        quality: str,
+        model: Optional[str],
+        mask_path: Optional[str],
+        use_base64: bool,
+        timeout: int,
+    ) -> List[bytes]:
+        if image_path:
+            if use_base64:
+                return await self.image_to_image_with_base64(
+                    image_path,
+                    prompt,
+                    size=size,
+                    n=n,
+                    quality=quality,
+                    model=model,
+                    mask_path=mask_path,
+                    timeout=timeout,
+                )
+            return await self.image_to_image(
+                image_path,
+                prompt,
+                size=size,
+                n=n,
+                quality=quality,
+                model=model,
+                mask_path=mask_path,
+                timeout=timeout,
+            )
+        return await self.text_to_image(
             prompt,
             size=size,
             n=n,
             quality=quality,
             model=model,
-            mask_path=mask_path,
-            timeout=timeout,
         )
-    # 文生图
-    return text_to_image(
-        prompt,
-        size=size,
-        n=n,
-        quality=quality,
-        model=model,
-    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,263 @@
+"""
+共享 HTTP 传输层：按 provider 主机复用保活连接池
+
+- requests 通道（SeeDream 生成与结果下载、Azure images/edits）：get_session(url)
+- openai SDK 通道（Azure images.generate）：get_httpx_client(url)
+- asyncio 通道：new_async_client()，由各异步客户端持有
+- 连接池大小与超时可通过环境变量或 configure_pool() 调整：
+  IMAGE_HTTP_POOL_CONNECTIONS=10   # 每个 Session 缓存的连接池数量
+  IMAGE_HTTP_POOL_MAXSIZE=32       # 单主机最大保活连接数
+  IMAGE_HTTP_CONNECT_TIMEOUT=10    # 建连超时（秒）
+  IMAGE_HTTP_READ_TIMEOUT=180      # 未显式指定时的默认读超时（秒）
+  IMAGE_HTTP_KEEPALIVE_EXPIRY=60   # httpx 空闲连接保活时长（秒）
+
+- timeout() / httpx_timeout() 给出的超时不超过当前 budget 预算的剩余时间。
+
+- pool_stats() 返回每个主机已建立的连接数与复用次数，用于确认握手是否已减少。
+"""
+from __future__ import annotations
+
+import os
+import threading
+from dataclasses import dataclass, replace
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import budget
+from lazy import lazy_import
+
+# 延迟导入：首次创建会话 / 客户端时才加载
+httpx = lazy_import("httpx")
+requests = lazy_import("requests")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+@dataclass(frozen=True)
+class PoolConfig:
+    """连接池配置"""
+    pool_connections: int = 10
+    pool_maxsize: int = 32
+    connect_timeout: float = 10.0
+    read_timeout: float = 180.0
+    keepalive_expiry: float = 60.0
+
+    @classmethod
+    def from_env(cls) -> "PoolConfig":
+        return cls(
+            pool_connections=_env_int("IMAGE_HTTP_POOL_CONNECTIONS", cls.pool_connections),
+            pool_maxsize=_env_int("IMAGE_HTTP_POOL_MAXSIZE", cls.pool_maxsize),
+            connect_timeout=_env_float("IMAGE_HTTP_CONNECT_TIMEOUT", cls.connect_timeout),
+            read_timeout=_env_float("IMAGE_HTTP_READ_TIMEOUT", cls.read_timeout),
+            keepalive_expiry=_env_float("IMAGE_HTTP_KEEPALIVE_EXPIRY", cls.keepalive_expiry),
+        )
+
+
+_lock = threading.Lock()
+_config: Optional[PoolConfig] = None
+_sessions: Dict[str, requests.Session] = {}
+_httpx_clients: Dict[str, httpx.Client] = {}
+# httpx 通道的统计：{"<host> (httpx)": {"connections_opened": int, "requests": int}}
+_httpx_counters: Dict[str, Dict[str, int]] = {}
+
+
+def get_config() -> PoolConfig:
+    global _config
+    if _config is None:
+        _config = PoolConfig.from_env()
+    return _config
+
+
+def configure_pool(**overrides: Any) -> PoolConfig:
+    """调整连接池配置。已创建的连接池会被关闭，下次使用时按新配置重建。"""
+    global _config
+    new_config = replace(get_config(), **overrides)
+    close_pools()
+    _config = new_config
+    return new_config
+
+
+def host_key(url: str) -> str:
+    """返回 scheme://host[:port]，作为连接池的复用粒度。"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+
+def timeout(read: Optional[float] = None) -> Tuple[float, float]:
+    """requests 使用的 (connect, read) 超时元组；read 未指定时使用默认读超时。
+
+    在 budget 预算内调用时，两者都不超过剩余时间（已超时或已取消时抛出）。
+    """
+    config = get_config()
+    read = budget.timeout(read if read is not None else config.read_timeout)
+    return (min(config.connect_timeout, read), read)
+
+
+def httpx_timeout(read: Optional[float] = None):
+    """httpx 使用的超时对象，规则同 timeout()"""
+    connect, read = timeout(read)
+    return httpx.Timeout(read, connect=connect)
+
+
+def get_session(url: str) -> requests.Session:
+    """获取指定主机共享的 requests.Session（保活连接池）。"""
+    key = host_key(url)
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            config = get_config()
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=config.pool_connections,
+                pool_maxsize=config.pool_maxsize,
+                max_retries=0,
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[key] = session
+    return session
+
+
+def _httpx_counters_for(key: str) -> Dict[str, int]:
+    with _lock:
+        return _httpx_counters.setdefault(key, {"connections_opened": 0, "requests": 0})
+
+
+def _bump(counters: Dict[str, int], name: str) -> None:
+    with _lock:
+        counters[name] += 1
+
+
+def _count_httpx_request(request: httpx.Request) -> None:
+    counters = _httpx_counters_for(f"{host_key(str(request.url))} (httpx)")
+    _bump(counters, "requests")
+
+    def trace(event_name: str, info: Dict[str, Any]) -> None:
+        if event_name == "connection.connect_tcp.complete":
+            _bump(counters, "connections_opened")
+
+    request.extensions["trace"] = trace
+
+
+async def _count_async_httpx_request(request: httpx.Request) -> None:
+    counters = _httpx_counters_for(f"{host_key(str(request.url))} (httpx-async)")
+    _bump(counters, "requests")
+
+    # 异步客户端要求 trace 回调为协程函数
+    async def trace(event_name: str, info: Dict[str, Any]) -> None:
+        if event_name == "connection.connect_tcp.complete":
+            _bump(counters, "connections_opened")
+
+    request.extensions["trace"] = trace
+
+
+def _httpx_limits(max_connections: int) -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections,
+        keepalive_expiry=get_config().keepalive_expiry,
+    )
+
+
+def _httpx_timeout() -> httpx.Timeout:
+    config = get_config()
+    return httpx.Timeout(config.read_timeout, connect=config.connect_timeout)
+
+
+def get_httpx_client(url: str) -> httpx.Client:
+    """获取指定主机共享的 httpx.Client，供 openai SDK 复用连接。"""
+    key = host_key(url)
+    client = _httpx_clients.get(key)
+    if client is not None:
+        return client
+    with _lock:
+        client = _httpx_clients.get(key)
+        if client is None:
+            client = httpx.Client(
+                limits=_httpx_limits(get_config().pool_maxsize),
+                timeout=_httpx_timeout(),
+                event_hooks={"request": [_count_httpx_request]},
+            )
+            _httpx_clients[key] = client
+    return client
+
+
+def new_async_client(max_connections: Optional[int] = None) -> httpx.AsyncClient:
+    """创建非阻塞的 httpx.AsyncClient。
+
+    异步客户端绑定事件循环，因此不做全局共享，由调用方（如 AsyncSeeDream4API）持有并负责 aclose()。
+    连接统计同样汇总到 pool_stats()。
+    """
+    return httpx.AsyncClient(
+        limits=_httpx_limits(max_connections or get_config().pool_maxsize),
+        timeout=_httpx_timeout(),
+        event_hooks={"request": [_count_async_httpx_request]},
+    )
+
+
+def pool_stats() -> Dict[str, Dict[str, Any]]:
+    """返回每个主机的连接统计：connections_opened / requests / connections_reused。"""
+    stats: Dict[str, Dict[str, Any]] = {}
+    with _lock:
+        sessions = list(_sessions.items())
+        httpx_counters = {k: dict(v) for k, v in _httpx_counters.items()}
+
+    for key, session in sessions:
+        opened = 0
+        sent = 0
+        for adapter in set(session.adapters.values()):
+            pools = getattr(getattr(adapter, "poolmanager", None), "pools", None)
+            if pools is None:
+                continue
+            for pool_key in list(pools.keys()):
+                pool = pools.get(pool_key)
+                if pool is None:
+                    continue
+                opened += getattr(pool, "num_connections", 0)
+                sent += getattr(pool, "num_requests", 0)
+        stats[key] = {
+            "transport": "requests",
+            "connections_opened": opened,
+            "requests": sent,
+            "connections_reused": max(sent - opened, 0),
+        }
+
+    for key, counters in httpx_counters.items():
+        opened = counters["connections_opened"]
+        sent = counters["requests"]
+        stats[key] = {
+            "transport": "httpx",
+            "connections_opened": opened,
+            "requests": sent,
+            "connections_reused": max(sent - opened, 0),
+        }
+    return stats
+
+
+def close_pools() -> None:
+    """关闭所有共享连接池（进程退出或重新配置时调用）。"""
+    with _lock:
+        sessions = list(_sessions.values())
+        clients = list(_httpx_clients.values())
+        _sessions.clear()
+        _httpx_clients.clear()
+        _httpx_counters.clear()
+    for session in sessions:
+        session.close()
+    for client in clients:
+        client.close()
@@ -0,0 +1,474 @@
+"""
+持久化生成任务队列：SQLite 存储任务与结果，进程池 worker 消费
+
+- submit() 写入任务后立即返回 job id；status() / get() 查询进度，result() 阻塞等待结果；
+- 每个任务带幂等键（默认对 provider 与参数做稳定哈希），重复提交返回已有任务，成功的任务不会再次执行；
+- worker 以租约方式领取任务并定期续租；worker 崩溃或重启后租约过期，任务被重新领取；
+- worker 默认启用结果缓存（result_cache）：上一次执行已拿到上游结果但未来得及记录时，重跑直接命中缓存，不会重复计费；
+- 失败的任务按 max_attempts 重新排队，超过次数标记为 failed，可用 retry() 手动重试。
+
+任务参数与 batch.py 的任务行格式一致，例如：
+  {"provider": "seedream4", "prompt": "一只小猫", "size": "2K", "max_images": 1}
+  {"provider": "gpt_image_1", "prompt": "a cat", "size": "1024x1024", "n": 2}
+
+数据库路径默认为 IMAGE_JOB_QUEUE_DB，未配置时为 image_jobs.sqlite3。
+
+用法:
+  python jobqueue.py submit jobs.jsonl
+  python jobqueue.py work --concurrency 4 --drain
+  python jobqueue.py status <job_id>
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import batch
+from result_cache import ResultCache
+
+logger = logging.getLogger('jobqueue')
+
+DEFAULT_DB = "image_jobs.sqlite3"
+
+STATUSES = ("queued", "running", "succeeded", "failed")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id              TEXT PRIMARY KEY,
+    idempotency_key TEXT NOT NULL UNIQUE,
+    provider        TEXT NOT NULL,
+    params          TEXT NOT NULL,
+    status          TEXT NOT NULL,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    max_attempts    INTEGER NOT NULL,
+    result          TEXT,
+    error           TEXT,
+    worker          TEXT,
+    lease_until     REAL,
+    created_at      REAL NOT NULL,
+    updated_at      REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+"""
+
+
+class JobFailed(RuntimeError):
+    """任务最终失败（重试次数用尽）"""
+
+    def __init__(self, job: "Job"):
+        super().__init__(f"任务 {job.id} 失败: {job.error}")
+        self.job = job
+
+
+@dataclass
+class Job:
+    id: str
+    idempotency_key: str
+    provider: str
+    params: Dict[str, Any]
+    status: str
+    attempts: int
+    max_attempts: int
+    result: Optional[Dict[str, Any]]
+    error: Optional[str]
+    worker: Optional[str]
+    lease_until: Optional[float]
+    created_at: float
+    updated_at: float
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> "Job":
+        return cls(
+            id=row["id"],
+            idempotency_key=row["idempotency_key"],
+            provider=row["provider"],
+            params=json.loads(row["params"]),
+            status=row["status"],
+            attempts=row["attempts"],
+            max_attempts=row["max_attempts"],
+            result=json.loads(row["result"]) if row["result"] else None,
+            error=row["error"],
+            worker=row["worker"],
+            lease_until=row["lease_until"],
+            created_at=row["created_at"],
+            updated_at=row["updated_at"],
+        )
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+
+def make_idempotency_key(provider: str, params: Dict[str, Any]) -> str:
+    """对 provider 与任务参数做稳定哈希（键顺序无关）"""
+    text = json.dumps({"provider": provider, "params": params}, sort_keys=True, ensure_ascii=False,
+                      separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class JobQueue:
+    """SQLite 任务队列；同一数据库可被多个进程同时打开（每个线程使用独立连接）"""
+
+    def __init__(self, path: Optional[str] = None, *, lease: float = 300.0, max_attempts: int = 3):
+        self.path = path or os.getenv("IMAGE_JOB_QUEUE_DB", DEFAULT_DB)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        parent = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(parent, exist_ok=True)
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None：事务由 BEGIN IMMEDIATE 显式控制，避免并发领取时的写锁升级死锁
+            conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+    def submit(
+        self,
+        params: Dict[str, Any],
+        *,
+        provider: Optional[str] = None,
+        idempotency_key: Optional[str] = None,
+        max_attempts: Optional[int] = None,
+    ) -> str:
+        """提交任务并返回 job id；幂等键已存在时返回已有任务的 id（不会重复执行）"""
+        if not params.get("prompt"):
+            raise ValueError("任务缺少 prompt")
+        provider = provider or batch.infer_provider(params)
+        if provider not in batch.PROVIDERS:
+            raise ValueError(f"不支持的 provider: {provider}")
+        params = {k: v for k, v in params.items() if k not in ("id", "provider", "idempotency_key")}
+        key = idempotency_key or make_idempotency_key(provider, params)
+        now = time.time()
+        conn = self._transaction()
+        try:
+            row = conn.execute("SELECT id FROM jobs WHERE idempotency_key = ?", (key,)).fetchone()
+            if row is not None:
+                conn.execute("COMMIT")
+                return row["id"]
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (id, idempotency_key, provider, params, status, max_attempts, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, key, provider, json.dumps(params, ensure_ascii=False),
+                 max_attempts or self.max_attempts, now, now),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Job]:
+        row = self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job.from_row(row) if row is not None else None
+
+    def find(self, idempotency_key: str) -> Optional[Job]:
+        row = self._conn().execute("SELECT * FROM jobs WHERE idempotency_key = ?", (idempotency_key,)).fetchone()
+        return Job.from_row(row) if row is not None else None
+
+    def status(self, job_id: str) -> str:
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        return job.status
+
+    def result(self, job_id: str, timeout: Optional[float] = None, poll: float = 0.5) -> Dict[str, Any]:
+        """等待任务结束并返回结果记录（含 outputs）；失败抛出 JobFailed，超时抛出 TimeoutError"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            if job is None:
+                raise KeyError(job_id)
+            if job.status == "succeeded":
+                return job.result or {}
+            if job.status == "failed":
+                raise JobFailed(job)
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f"等待任务 {job_id} 超时（当前状态 {job.status}）")
+            time.sleep(poll if deadline is None else max(0.0, min(poll, deadline - time.monotonic())))
+
+    def claim(self, worker: str) -> Optional[Job]:
+        """领取最早的待执行任务（含租约已过期的运行中任务），没有任务时返回 None
+
+        租约过期说明 worker 崩溃或卡死；这类任务若已用完 max_attempts 次尝试则标记为 failed，
+        不再重新领取，避免一个每次都会拖垮 worker 的任务被无限重试。
+        """
+        now = time.time()
+        conn = self._transaction()
+        try:
+            exhausted = conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, lease_until = NULL, updated_at = ?"
+                " WHERE status = 'running' AND lease_until < ? AND attempts >= max_attempts",
+                ("worker 在执行期间失联（租约过期），已达到最大尝试次数", now, now),
+            ).rowcount
+            if exhausted:
+                logger.warning(f"{exhausted} 个任务的租约已过期且已达到最大尝试次数，标记为 failed")
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued'"
+                " OR (status = 'running' AND lease_until < ?)"
+                " ORDER BY created_at LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            if row["status"] == "running":
+                logger.warning(f"任务 {row['id']} 的租约已过期（worker {row['worker']}），重新领取")
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, lease_until = ?,"
+                " updated_at = ? WHERE id = ?",
+                (worker, now + self.lease, now, row["id"]),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return self.get(row["id"])
+
+    def heartbeat(self, job_id: str, worker: str) -> bool:
+        """续租；任务已不属于该 worker 时返回 False"""
+        now = time.time()
+        cursor = self._conn().execute(
+            "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND worker = ? AND status = 'running'",
+            (now + self.lease, now, job_id, worker),
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id: str, worker: str, result: Dict[str, Any]) -> bool:
+        cursor = self._conn().execute(
+            "UPDATE jobs SET status = 'succeeded', result = ?, error = NULL, lease_until = NULL, updated_at = ?"
+            " WHERE id = ? AND worker = ? AND status = 'running'",
+            (json.dumps(result, ensure_ascii=False), time.time(), job_id, worker),
+        )
+        return cursor.rowcount == 1
+
+    def fail(self, job_id: str, worker: str, error: str) -> bool:
+        """记录失败：未超过 max_attempts 时重新排队，否则标记为 failed"""
+        cursor = self._conn().execute(
+            "UPDATE jobs SET status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,"
+            " error = ?, lease_until = NULL, updated_at = ?"
+            " WHERE id = ? AND worker = ? AND status = 'running'",
+            (error, time.time(), job_id, worker),
+        )
+        return cursor.rowcount == 1
+
+    def release(self, job_id: str, worker: str) -> bool:
+        """worker 主动放弃（如收到中断）：任务重新排队，本次不计入尝试次数"""
+        cursor = self._conn().execute(
+            "UPDATE jobs SET status = 'queued', attempts = MAX(attempts - 1, 0), worker = NULL, lease_until = NULL,"
+            " updated_at = ? WHERE id = ? AND worker = ? AND status = 'running'",
+            (time.time(), job_id, worker),
+        )
+        return cursor.rowcount == 1
+
+    def retry(self, job_id: str) -> bool:
+        """把失败的任务重新排队（重置尝试次数）"""
+        cursor = self._conn().execute(
+            "UPDATE jobs SET status = 'queued', attempts = 0, error = NULL, updated_at = ?"
+            " WHERE id = ? AND status = 'failed'",
+            (time.time(), job_id),
+        )
+        return cursor.rowcount == 1
+
+    def counts(self) -> Dict[str, int]:
+        counts = {status: 0 for status in STATUSES}
+        for row in self._conn().execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status"):
+            counts[row["status"]] = row["n"]
+        return counts
+
+    def pending(self) -> int:
+        """尚未结束的任务数（排队中与运行中）"""
+        counts = self.counts()
+        return counts["queued"] + counts["running"]
+
+
+class _Heartbeat:
+    """后台线程定期续租，直到任务结束"""
+
+    def __init__(self, queue: JobQueue, job_id: str, worker: str):
+        self.queue = JobQueue(queue.path, lease=queue.lease, max_attempts=queue.max_attempts)
+        self.job_id = job_id
+        self.worker = worker
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"heartbeat-{job_id[:8]}", daemon=True)
+
+    def _run(self) -> None:
+        interval = max(1.0, self.queue.lease / 3)
+        try:
+            while not self._stop.wait(interval):
+                if not self.queue.heartbeat(self.job_id, self.worker):
+                    logger.warning(f"任务 {self.job_id} 已被其他 worker 接管")
+                    return
+        finally:
+            self.queue.close()
+
+    def __enter__(self) -> "_Heartbeat":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def work(
+    path: Optional[str] = None,
+    *,
+    worker: Optional[str] = None,
+    output_dir: str = batch.DEFAULT_OUTPUT_DIR,
+    lease: float = 300.0,
+    use_cache: bool = True,
+    drain: bool = False,
+    poll: float = 1.0,
+    max_jobs: Optional[int] = None,
+) -> int:
+    """单个 worker 的主循环：领取、执行、记录结果；drain=True 时队列为空即退出。返回处理的任务数"""
+    queue = JobQueue(path, lease=lease)
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+    cache = ResultCache() if use_cache else None
+    processed = 0
+    try:
+        while max_jobs is None or processed < max_jobs:
+            job = queue.claim(worker)
+            if job is None:
+                if drain:
+                    break
+                time.sleep(poll)
+                continue
+            logger.info(f"{worker} 开始执行任务 {job.id}（第 {job.attempts} 次）")
+            try:
+                with _Heartbeat(queue, job.id, worker):
+                    record = batch.run_job(job.id, {**job.params, "provider": job.provider}, output_dir, cache)
+            except BaseException:
+                # 中断或进程退出：立即交还任务，无需等待租约过期
+                queue.release(job.id, worker)
+                raise
+            if record["status"] == "ok":
+                if not queue.complete(job.id, worker, record):
+                    logger.warning(f"任务 {job.id} 已被其他 worker 接管，丢弃本次结果")
+            else:
+                queue.fail(job.id, worker, record.get("error", "未知错误"))
+            processed += 1
+    finally:
+        queue.close()
+    return processed
+
+
+def run_workers(
+    path: Optional[str] = None,
+    *,
+    concurrency: int = 4,
+    output_dir: str = batch.DEFAULT_OUTPUT_DIR,
+    lease: float = 300.0,
+    use_cache: bool = True,
+    drain: bool = False,
+    poll: float = 1.0,
+) -> int:
+    """启动 concurrency 个 worker 进程消费队列，返回处理的任务总数（drain=False 时持续运行直到中断）"""
+    path = path or os.getenv("IMAGE_JOB_QUEUE_DB", DEFAULT_DB)
+    JobQueue(path).close()  # 先在主进程中建表，避免多个 worker 同时初始化
+    with ProcessPoolExecutor(max_workers=concurrency) as pool:
+        futures = [
+            pool.submit(work, path, output_dir=output_dir, lease=lease, use_cache=use_cache, drain=drain, poll=poll)
+            for _ in range(concurrency)
+        ]
+        return sum(future.result() for future in futures)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="持久化图像生成任务队列")
+    parser.add_argument("--db", default=None, help=f"数据库路径（默认 IMAGE_JOB_QUEUE_DB 或 {DEFAULT_DB}）")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    submit = sub.add_parser("submit", help="从 JSONL 任务文件提交任务")
+    submit.add_argument("jobs", help="任务文件（JSONL，格式同 batch.py）")
+    submit.add_argument("--max-attempts", type=int, default=None)
+
+    worker = sub.add_parser("work", help="启动 worker 进程池消费队列")
+    worker.add_argument("--concurrency", type=int, default=4)
+    worker.add_argument("--output-dir", default=batch.DEFAULT_OUTPUT_DIR)
+    worker.add_argument("--lease", type=float, default=300.0, help="任务租约（秒），worker 失联超过该时长后任务被重新领取")
+    worker.add_argument("--no-cache", action="store_true", help="不使用结果缓存")
+    worker.add_argument("--drain", action="store_true", help="队列为空时退出")
+
+    status = sub.add_parser("status", help="查看任务状态；不指定 id 时输出各状态任务数")
+    status.add_argument("job_id", nargs="?")
+
+    retry = sub.add_parser("retry", help="重新排队失败的任务")
+    retry.add_argument("job_id")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    queue = JobQueue(args.db)
+
+    if args.command == "submit":
+        submitted = 0
+        for job_id, job in batch.iter_jobs(args.jobs):
+            if "_error" in job:
+                logger.error(f"{job_id}: {job['_error']}")
+                continue
+            # 任务文件中的 id 作为幂等键，重复提交同一文件不会产生重复任务
+            key = str(job["id"]) if job.get("id") else None
+            print(json.dumps({"line_id": job_id, "job_id": queue.submit(job, idempotency_key=key,
+                                                                         max_attempts=args.max_attempts)}))
+            submitted += 1
+        logger.info(f"已提交 {submitted} 个任务")
+        return 0
+    if args.command == "work":
+        processed = run_workers(
+            queue.path,
+            concurrency=max(1, args.concurrency),
+            output_dir=args.output_dir,
+            lease=args.lease,
+            use_cache=not args.no_cache,
+            drain=args.drain,
+        )
+        print(json.dumps({"processed": processed, **queue.counts()}, ensure_ascii=False))
+        return 0
+    if args.command == "status":
+        if not args.job_id:
+            print(json.dumps(queue.counts(), ensure_ascii=False))
+            return 0
+        job = queue.get(args.job_id)
+        if job is None:
+            print(f"任务不存在: {args.job_id}")
+            return 1
+        print(json.dumps(job.__dict__, ensure_ascii=False, indent=2))
+        return 0
+    if args.command == "retry":
+        return 0 if queue.retry(args.job_id) else 1
+    return 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,89 @@
+"""
+启动加速：重量级依赖延迟导入、.env 延迟加载
+
+- lazy_import("openai") 返回一个占位模块，首次访问其属性时才真正导入（线程安全）；
+  已经导入过的模块直接返回，不产生额外开销。
+- load_env() 在首次需要读取配置时才查找并加载 .env（find_dotenv 会遍历目录），进程内只执行一次；
+  load_env(force=True) 重新加载，供各模块的 reload_config() 使用：此前由 .env 设置的变量更新为 .env 中的新值
+  （从 .env 删除的则移除），启动时已存在于环境中的变量始终不被覆盖。
+"""
+from __future__ import annotations
+
+import importlib
+import os
+import sys
+import threading
+import types
+from typing import Dict, Optional
+
+
+class LazyModule(types.ModuleType):
+    """首次访问属性时导入真实模块，之后将其属性复制到自身，后续访问与普通模块无异"""
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__dict__["_lazy_lock"] = threading.Lock()
+        self.__dict__["_lazy_module"] = None
+
+    def _load(self) -> types.ModuleType:
+        module = self.__dict__["_lazy_module"]
+        if module is not None:
+            return module
+        with self.__dict__["_lazy_lock"]:
+            module = self.__dict__["_lazy_module"]
+            if module is None:
+                module = importlib.import_module(self.__name__)
+                self.__dict__.update(module.__dict__)
+                self.__dict__["_lazy_module"] = module
+        return module
+
+    def __getattr__(self, attr: str):
+        # 只有在自身找不到属性时才会调用，导入后属性已复制到 __dict__
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """延迟导入模块：已导入时直接返回真实模块，否则返回 LazyModule"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return LazyModule(name)
+
+
+_env_lock = threading.Lock()
+_env_loaded = False
+# 由 .env 写入环境的变量及写入时的值；值被其他代码改动过的变量不再视为来自 .env
+_env_values: Dict[str, str] = {}
+
+
+def load_env(force: bool = False) -> Optional[str]:
+    """加载项目 .env（不覆盖已有的环境变量），返回找到的 .env 路径；未安装 python-dotenv 时忽略
+
+    force=True 时重新读取 .env，并更新此前由 .env 设置的变量（如轮换后的密钥）。
+    """
+    global _env_loaded
+    with _env_lock:
+        if _env_loaded and not force:
+            return None
+        _env_loaded = True
+        try:
+            from dotenv import dotenv_values, find_dotenv
+        except ImportError:
+            return None
+        path = find_dotenv(usecwd=True) or find_dotenv()
+        values = {k: v for k, v in dotenv_values(path).items() if v is not None} if path else {}
+        for key, loaded in list(_env_values.items()):
+            if os.environ.get(key) != loaded:
+                _env_values.pop(key)
+            elif key not in values:
+                # 已从 .env 中删除
+                os.environ.pop(key, None)
+                _env_values.pop(key)
+        for key, value in values.items():
+            if key not in os.environ or key in _env_values:
+                os.environ[key] = value
+                _env_values[key] = value
+        return path
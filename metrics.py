@@ -0,0 +1,378 @@
+"""
+分阶段耗时统计与指标导出
+
+每次生成调用（call）记录一份 CallTrace：
+- phases: 各阶段耗时（秒），阶段名包括
+    encode      参考图读取 / 预处理 / base64 编码
+    upload      请求体发送（仅流式请求体可单独测得）
+    upstream    上游处理，直到收到响应头（无法区分上传时包含上传耗时，记为 request）
+    request     发送请求直到收到响应头
+    stream_parse  SSE 流读取与解析
+    response    非流式响应体读取
+    decode      b64_json 解码
+    download    结果图像下载
+    save        结果写盘
+    postprocess 缩略图与分发格式变体生成
+    composite   局部编辑结果合成回原图
+- bytes_sent / bytes_received / retries / status
+
+用法:
+    metrics.add_hook(lambda trace: print(trace.as_dict()))     # 每次调用结束时回调
+    print(metrics.export_prometheus())                         # Prometheus 文本格式
+    metrics.start_http_server(9108)                            # 或暴露 /metrics 供抓取（默认只监听 127.0.0.1）
+
+调用结束时阶段耗时按 provider / endpoint / size / phase 计入直方图。
+埋点通过 contextvars 关联到当前调用，嵌套的 call() 复用外层调用，线程与 asyncio 任务互不干扰。
+"""
+from __future__ import annotations
+
+import bisect
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger('metrics')
+
+# 生成接口耗时跨度大（亚秒到数分钟），桶边界相应放宽
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+
+_current: contextvars.ContextVar[Optional["CallTrace"]] = contextvars.ContextVar("image_call_trace", default=None)
+
+
+class CallTrace:
+    """单次生成调用的分阶段记录"""
+
+    def __init__(self, provider: str, endpoint: str, size: str = ""):
+        self.provider = provider
+        self.endpoint = endpoint
+        self.size = size or ""
+        self.phases: Dict[str, float] = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+        self.status = "ok"
+        self.duration = 0.0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def add_phase(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def add_bytes(self, sent: int = 0, received: int = 0) -> None:
+        with self._lock:
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def add_retry(self) -> None:
+        with self._lock:
+            self.retries += 1
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "provider": self.provider,
+                "endpoint": self.endpoint,
+                "size": self.size,
+                "status": self.status,
+                "duration": round(self.duration, 4),
+                "phases": {k: round(v, 4) for k, v in self.phases.items()},
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+                "retries": self.retries,
+                "started": self.started,
+            }
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Registry:
+    """进程内指标：直方图与计数器，按标签区分"""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._help: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, labels: Dict[str, str], help: str = "") -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._help.setdefault(name, help)
+            series = self._histograms.setdefault(name, {})
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = Histogram(self.buckets)
+            hist.observe(value)
+
+    def inc(self, name: str, value: float, labels: Dict[str, str], help: str = "") -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._help.setdefault(name, help)
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def record(self, trace: CallTrace) -> None:
+        base = {"provider": trace.provider, "endpoint": trace.endpoint, "size": trace.size}
+        self.observe("image_call_duration_seconds", trace.duration, {**base, "status": trace.status},
+                     "生成调用总耗时")
+        for phase, seconds in trace.phases.items():
+            self.observe("image_phase_duration_seconds", seconds, {**base, "phase": phase},
+                         "生成调用各阶段耗时")
+        self.inc("image_calls_total", 1, {**base, "status": trace.status}, "生成调用次数")
+        self.inc("image_bytes_sent_total", trace.bytes_sent, base, "发送字节数")
+        self.inc("image_bytes_received_total", trace.bytes_received, base, "接收字节数")
+        self.inc("image_retries_total", trace.retries, base, "重试次数")
+
+    def export(self) -> str:
+        """导出 Prometheus 文本格式（0.0.4）"""
+        lines: List[str] = []
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# HELP {name} {self._help.get(name, '')}")
+                lines.append(f"# TYPE {name} histogram")
+                for labels, hist in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(self.buckets, hist.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_labels(labels, le=_num(bound))} {cumulative}")
+                    lines.append(f"{name}_bucket{_labels(labels, le='+Inf')} {hist.count}")
+                    lines.append(f"{name}_sum{_labels(labels)} {_num(hist.sum)}")
+                    lines.append(f"{name}_count{_labels(labels)} {hist.count}")
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# HELP {name} {self._help.get(name, '')}")
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{name}{_labels(labels)} {_num(value)}")
+        return "\n".join(lines) + "\n"
+
+    def clear(self) -> None:
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+def _num(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: Labels, **extra: str) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+registry = Registry()
+_hooks: List[Callable[[CallTrace], None]] = []
+
+
+def add_hook(hook: Callable[[CallTrace], None]) -> None:
+    """注册回调：每次调用结束时以 CallTrace 调用"""
+    _hooks.append(hook)
+
+
+def remove_hook(hook: Callable[[CallTrace], None]) -> None:
+    try:
+        _hooks.remove(hook)
+    except ValueError:
+        pass
+
+
+def current() -> Optional[CallTrace]:
+    """当前上下文中的调用记录（不在调用中时为 None）"""
+    return _current.get()
+
+
+@contextmanager
+def call(provider: str, endpoint: str, size: str = "") -> Iterator[CallTrace]:
+    """记录一次生成调用；已在调用中时复用外层记录（外层负责汇总与上报）"""
+    outer = _current.get()
+    if outer is not None:
+        yield outer
+        return
+    trace = CallTrace(provider, endpoint, size)
+    token = _current.set(trace)
+    started = time.perf_counter()
+    try:
+        yield trace
+    except BaseException:
+        trace.status = "error"
+        raise
+    finally:
+        trace.duration = time.perf_counter() - started
+        _current.reset(token)
+        _finish(trace)
+
+
+def traced(provider: str, endpoint: str) -> Callable:
+    """装饰器：把函数的每次调用记录为一次 call()，size 取自同名参数（同步与异步函数均可）"""
+    def decorate(fn: Callable) -> Callable:
+        signature = inspect.signature(fn)
+        default_size = signature.parameters["size"].default if "size" in signature.parameters else ""
+
+        def size_of(args, kwargs) -> str:
+            try:
+                return str(signature.bind_partial(*args, **kwargs).arguments.get("size", default_size))
+            except TypeError:
+                return str(default_size)
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with call(provider, endpoint, size_of(args, kwargs)):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with call(provider, endpoint, size_of(args, kwargs)):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    return decorate
+
+
+@contextmanager
+def activate(trace: CallTrace) -> Iterator[CallTrace]:
+    """在当前上下文中临时启用已有的调用记录（用于后台线程与生成器，不负责上报）"""
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+def finish(trace: CallTrace, duration: Optional[float] = None) -> None:
+    """上报手动创建的调用记录（call() 会自动上报，无需调用）"""
+    if duration is not None:
+        trace.duration = duration
+    _finish(trace)
+
+
+def _finish(trace: CallTrace) -> None:
+    registry.record(trace)
+    for hook in list(_hooks):
+        try:
+            hook(trace)
+        except Exception as e:
+            logger.warning(f"metrics hook 执行失败: {e}")
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """记录当前调用中某个阶段的耗时（不在调用中时为空操作）"""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_phase(name, time.perf_counter() - started)
+
+
+def add_phase(name: str, seconds: float) -> None:
+    trace = _current.get()
+    if trace is not None:
+        trace.add_phase(name, seconds)
+
+
+def add_bytes(sent: int = 0, received: int = 0) -> None:
+    trace = _current.get()
+    if trace is not None:
+        trace.add_bytes(sent, received)
+
+
+def add_retry() -> None:
+    trace = _current.get()
+    if trace is not None:
+        trace.add_retry()
+
+
+def set_status(status: str) -> None:
+    trace = _current.get()
+    if trace is not None:
+        trace.status = status
+
+
+class TimedBody:
+    """包装流式请求体：记录发送字节数，发送完毕时记入 upload 阶段"""
+
+    def __init__(self, body: Any, trace: Optional[CallTrace] = None):
+        self.body = body
+        self.trace = trace if trace is not None else _current.get()
+        self.upload_done: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self.body)
+
+    def __iter__(self) -> Iterator[bytes]:
+        started = time.perf_counter()
+        sent = 0
+        for chunk in self.body:
+            sent += len(chunk)
+            yield chunk
+        self.upload_done = time.perf_counter()
+        if self.trace is not None:
+            self.trace.add_phase("upload", self.upload_done - started)
+            self.trace.add_bytes(sent=sent)
+
+
+def export_prometheus() -> str:
+    return registry.export()
+
+
+def start_http_server(port: int = 9108, host: Optional[str] = None):
+    """在后台线程暴露 GET /metrics，返回 HTTPServer（调用 shutdown() 停止）
+
+    默认只监听 127.0.0.1（或环境变量 IMAGE_METRICS_HOST）；指标含部署名与调用量，
+    需要供其他主机抓取时显式传入 host="0.0.0.0" 等地址。
+    """
+    host = host or os.getenv("IMAGE_METRICS_HOST", "127.0.0.1")
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = export_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
@@ -0,0 +1,225 @@
+"""
+本地模拟图像 API：用于离线基准测试与调试，不访问真实上游
+
+模拟的接口：
+  POST /api/v3/images/generations                      SeeDream 4.0（JSON 或 stream=true 时的 SSE）
+  GET  /files/<name>.png                               SeeDream 结果图片下载
+  POST /openai/deployments/<dep>/images/generations    Azure gpt-image-1 文生图（b64_json）
+  POST /openai/deployments/<dep>/images/edits          Azure gpt-image-1 图生图（multipart 或 JSON）
+
+响应基于仓库中的 fixture：图片取自 flux-body-mock.json，默认 prompt 取自 seedream-test.json。
+--payload-bytes 将图片填充到指定大小（PNG 尾部追加数据，文件头不变），--latency / --jitter 模拟上游处理耗时，
+--sse-interval 为组图模式下相邻两张图片事件的间隔。
+
+用法:
+  python mock_image_api.py --port 8765 --latency 0.2 --payload-bytes 1048576
+  端口为 0 时自动分配，启动后在标准输出打印一行 "listening <port>"。
+"""
+from __future__ import annotations
+
+import argparse
+import base64
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+IMAGE_FIXTURE = os.path.join(_HERE, "flux-body-mock.json")
+PROMPT_FIXTURE = os.path.join(_HERE, "seedream-test.json")
+
+_AZURE_PATH = re.compile(r"^/openai/deployments/([^/]+)/images/(generations|edits)$")
+
+
+def load_fixture_image(path: str = IMAGE_FIXTURE) -> bytes:
+    with open(path, "r", encoding="utf-8") as f:
+        return base64.b64decode(json.load(f)["images"][0])
+
+
+def load_fixture_request(path: str = PROMPT_FIXTURE) -> Dict[str, Any]:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def build_payload(base: bytes, size: int) -> bytes:
+    """把 fixture 图片填充到 size 字节（不足时原样返回）"""
+    if size <= len(base):
+        return base
+    return base + b"\0" * (size - len(base))
+
+
+class MockConfig:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, payload_bytes: int = 0,
+                 sse_interval: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.sse_interval = sse_interval
+        self.image = build_payload(load_fixture_image(), payload_bytes)
+        self.image_b64 = base64.b64encode(self.image).decode("ascii")
+        self.requests = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+
+    def delay(self) -> None:
+        seconds = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def count(self, received: int) -> None:
+        with self._lock:
+            self.requests += 1
+            self.bytes_received += received
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config: MockConfig
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        self.config.count(len(body))
+        return body
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/json") -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, payload: Any, status: int = 200) -> None:
+        self._send(status, json.dumps(payload).encode("utf-8"))
+
+    def do_GET(self):
+        if self.path.startswith("/files/"):
+            self.config.count(0)
+            self._send(200, self.config.image, "image/png")
+            return
+        self._send_json({"error": {"message": "not found"}}, 404)
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.path.split("?")[0] == "/api/v3/images/generations":
+            self._seedream(body)
+            return
+        match = _AZURE_PATH.match(self.path.split("?")[0])
+        if match:
+            self._azure(match.group(2), body)
+            return
+        self._send_json({"error": {"message": "not found"}}, 404)
+
+    def _image_url(self, index: int) -> str:
+        host = self.headers.get("Host") or f"127.0.0.1:{self.server.server_address[1]}"
+        return f"http://{host}/files/{int(time.time() * 1000)}_{index}.png"
+
+    def _seedream(self, body: bytes) -> None:
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            self._send_json({"error": {"message": "invalid json"}}, 400)
+            return
+        count = int(data.get("sequential_image_generation_options", {}).get("max_images", 1))
+        as_b64 = data.get("response_format") == "b64_json"
+        self.config.delay()
+
+        def item(index: int) -> Dict[str, Any]:
+            entry = {"size": data.get("size", "2K")}
+            if as_b64:
+                entry["b64_json"] = self.config.image_b64
+            else:
+                entry["url"] = self._image_url(index)
+            return entry
+
+        usage = {"generated_images": count, "output_tokens": 4096 * count, "total_tokens": 4096 * count}
+        if not data.get("stream"):
+            self._send_json({
+                "model": data.get("model"),
+                "created": int(time.time()),
+                "data": [item(i) for i in range(count)],
+                "usage": usage,
+            })
+            return
+
+        # SSE：逐张发送 partial_succeeded，最后 completed 与 [DONE]；使用 chunked 编码
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def chunk(text: str) -> None:
+            raw = text.encode("utf-8")
+            self.wfile.write(f"{len(raw):x}\r\n".encode() + raw + b"\r\n")
+            self.wfile.flush()
+
+        for index in range(count):
+            if index and self.config.sse_interval:
+                time.sleep(self.config.sse_interval)
+            event = {"type": "image_generation.partial_succeeded", "image_index": index, **item(index)}
+            chunk(f"data: {json.dumps(event)}\n\n")
+        chunk(f"data: {json.dumps({'type': 'image_generation.completed', 'usage': usage})}\n\n")
+        chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _azure(self, endpoint: str, body: bytes) -> None:
+        if not self.headers.get("api-key"):
+            self._send_json({"error": {"code": "401", "message": "missing api-key"}}, 401)
+            return
+        n = 1
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("application/json"):
+            try:
+                n = int(json.loads(body or b"{}").get("n", 1))
+            except ValueError:
+                self._send_json({"error": {"message": "invalid json"}}, 400)
+                return
+        else:
+            match = re.search(rb'name="n"\r\n\r\n(\d+)', body)
+            if match:
+                n = int(match.group(1))
+        self.config.delay()
+        self._send_json({
+            "created": int(time.time()),
+            "data": [{"b64_json": self.config.image_b64} for _ in range(n)],
+        })
+
+
+def make_server(host: str = "127.0.0.1", port: int = 0, config: Optional[MockConfig] = None) -> ThreadingHTTPServer:
+    handler = type("MockHandler", (_Handler,), {"config": config or MockConfig()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="本地模拟 SeeDream / Azure gpt-image-1 接口")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="每个生成请求的固定耗时（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="在固定耗时上追加的随机耗时上限（秒）")
+    parser.add_argument("--payload-bytes", type=int, default=0, help="结果图片大小（字节）")
+    parser.add_argument("--sse-interval", type=float, default=0.0, help="SSE 相邻图片事件间隔（秒）")
+    args = parser.parse_args(argv)
+
+    config = MockConfig(args.latency, args.jitter, args.payload_bytes, args.sse_interval)
+    server = make_server(args.host, args.port, config)
+    print(f"listening {server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,158 @@
+"""
+并发安全的结果写盘：内容哈希/UUID 命名 + 临时文件原子重命名 + 线程池并行写入
+
+- 文件名默认取内容 sha256 前 16 位（naming="hash"），相同内容得到相同文件名，不同内容不会互相覆盖；
+  naming="uuid" 时使用随机 UUID。多个进程共享同一 outputs/ 目录也不会冲突。
+- 先写入同目录下的临时文件再 os.replace，读者不会看到写了一半的图片。
+- fsync: "none"（默认）不强制落盘；"each" 每个文件写完即 fsync；"batch" 整批写完后统一 fsync 文件与目录。
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Iterable, List, Optional
+
+from encoding_cache import sniff_mime
+
+_EXTENSIONS = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/webp": "webp",
+    "image/gif": "gif",
+    "image/bmp": "bmp",
+    "image/tiff": "tiff",
+    "image/avif": "avif",
+    "image/heic": "heic",
+}
+NAMINGS = ("hash", "uuid")
+FSYNC_MODES = ("none", "each", "batch")
+
+
+def extension_for(head: bytes, default: str = "png") -> str:
+    """根据文件头推断扩展名"""
+    return _EXTENSIONS.get(sniff_mime(head[:32]) or "", default)
+
+
+def unique_filename(prefix: str, ext: str = "png") -> str:
+    """生成不会与其他进程冲突的文件名"""
+    return f"{prefix}_{uuid.uuid4().hex}.{ext}"
+
+
+def _fsync_path(path: str, flags: int = os.O_RDWR) -> None:
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_dir(directory: str) -> None:
+    """fsync 目录本身，使重命名持久化（Windows 不支持，忽略）"""
+    if os.name == "nt":
+        return
+    _fsync_path(directory, os.O_RDONLY)
+
+
+class AtomicFile:
+    """增量写入的临时文件，commit 时按内容哈希或 UUID 命名并原子重命名"""
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        # 不用 mkstemp：其 0600 权限会随重命名带到最终文件上
+        self.tmp_path = os.path.join(output_dir, f".tmp-{uuid.uuid4().hex}.part")
+        self._file: Optional[IO[bytes]] = open(self.tmp_path, "xb")
+        self._hash = hashlib.sha256()
+        self._head = b""
+
+    def write(self, data: bytes) -> None:
+        if len(self._head) < 32:
+            self._head += data[:32 - len(self._head)]
+        self._hash.update(data)
+        self._file.write(data)
+
+    def commit(self, prefix: str, naming: str = "hash", fsync: bool = False, ext: Optional[str] = None) -> str:
+        ext = ext or extension_for(self._head)
+        if naming == "hash":
+            name = f"{prefix}_{self._hash.hexdigest()[:16]}.{ext}"
+        else:
+            name = unique_filename(prefix, ext)
+        try:
+            self._file.flush()
+            if fsync:
+                os.fsync(self._file.fileno())
+        finally:
+            self._file.close()
+            self._file = None
+        path = os.path.join(self.output_dir, name)
+        os.replace(self.tmp_path, path)
+        return path
+
+    def discard(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class OutputWriter:
+    """批量结果写入器"""
+
+    def __init__(
+        self,
+        output_dir: str = "outputs",
+        *,
+        naming: str = "hash",
+        workers: int = 4,
+        fsync: str = "none",
+    ):
+        if naming not in NAMINGS:
+            raise ValueError(f"naming 仅支持 {NAMINGS}")
+        if fsync not in FSYNC_MODES:
+            raise ValueError(f"fsync 仅支持 {FSYNC_MODES}")
+        self.output_dir = output_dir
+        self.naming = naming
+        self.workers = workers
+        self.fsync = fsync
+
+    def open(self) -> AtomicFile:
+        """用于流式写入单个结果"""
+        return AtomicFile(self.output_dir)
+
+    def commit(self, pending: AtomicFile, prefix: str) -> str:
+        return pending.commit(prefix, self.naming, fsync=self.fsync == "each")
+
+    def write(self, data: bytes, prefix: str = "image") -> str:
+        pending = self.open()
+        try:
+            pending.write(data)
+            return self.commit(pending, prefix)
+        except BaseException:
+            pending.discard()
+            raise
+
+    def write_many(self, images: Iterable[bytes], prefix: str = "image") -> List[str]:
+        """并行写入一批图片，按输入顺序返回路径"""
+        images = list(images)
+        if not images:
+            return []
+        if self.workers <= 1 or len(images) == 1:
+            paths = [self.write(data, prefix) for data in images]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(images))) as pool:
+                paths = list(pool.map(lambda data: self.write(data, prefix), images))
+        self.finish(paths)
+        return paths
+
+    def finish(self, paths: List[str]) -> None:
+        """fsync="batch" 时统一刷盘；其他模式为空操作"""
+        if self.fsync != "batch" or not paths:
+            return
+        for path in paths:
+            _fsync_path(path)
+        fsync_dir(self.output_dir)
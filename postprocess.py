@@ -0,0 +1,246 @@
+"""
+生成结果后处理：缩略图与压缩分发格式（WebP / AVIF / JPEG），在进程池中并行执行
+
+- 每张结果图只解码一次，所有变体共用同一份解码结果；变体按尺寸从大到小依次缩放，小图从上一级缩放结果生成；
+- 变体写到原图旁边：<原文件名>_<变体名>.<扩展名>，先写临时文件再原子重命名；
+- 不同图片在进程池中并行处理（PIL 编码受 GIL 限制，线程无法并行），进程数默认 CPU 核数，
+  可用 IMAGE_POSTPROCESS_WORKERS 配置；
+- 当前 Pillow 不支持的格式（如未安装 AVIF 插件时的 avif）跳过并记录警告。
+
+变体写法："<格式>[@<最长边>][:<质量>]"，如 "jpeg@300:80"（与 server 端缩略图一致）、"webp"、"avif@1024"；
+也可传 Variant 对象。未指定时使用 DEFAULT_VARIANTS，或环境变量 IMAGE_VARIANTS（逗号分隔）。
+
+用法:
+    results = postprocess.process_paths(["outputs/a.png"], ["jpeg@300", "webp"])
+    # {"outputs/a.png": [{"name": "jpeg_300", "path": ..., "bytes": ..., "width": ..., "height": ...}, ...]}
+"""
+from __future__ import annotations
+
+import logging
+import os
+import re
+import threading
+import uuid
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Sequence, Union
+
+from lazy import lazy_import
+
+Image = lazy_import("PIL.Image")
+ImageOps = lazy_import("PIL.ImageOps")
+
+if TYPE_CHECKING:
+    # concurrent.futures.process 会导入 multiprocessing（约 20ms），首次创建进程池时才导入
+    from concurrent.futures import Executor, ProcessPoolExecutor
+
+logger = logging.getLogger('postprocess')
+
+_EXTENSIONS = {"jpeg": "jpg", "webp": "webp", "avif": "avif", "png": "png"}
+_DEFAULT_QUALITY = {"jpeg": 80, "webp": 80, "avif": 60, "png": 0}
+_SPEC = re.compile(r"^(jpeg|jpg|webp|avif|png)(?:@(\d+))?(?::(\d+))?$", re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class Variant:
+    """单个输出变体：max_side 为最长边（None 表示原尺寸，不放大）"""
+    format: str
+    max_side: Optional[int] = None
+    quality: Optional[int] = None
+    name: Optional[str] = None
+
+    @property
+    def label(self) -> str:
+        return self.name or (f"{self.format}_{self.max_side}" if self.max_side else self.format)
+
+    @property
+    def extension(self) -> str:
+        return _EXTENSIONS[self.format]
+
+
+# 缩略图与 server 端一致（300px JPEG q80），另附一份原尺寸 WebP 供分发
+DEFAULT_VARIANTS = (
+    Variant("jpeg", 300, 80, name="thumb"),
+    Variant("webp", None, 80),
+)
+
+VariantSpec = Union[Variant, str, Dict[str, Any]]
+
+
+def parse_variant(spec: VariantSpec) -> Variant:
+    if isinstance(spec, Variant):
+        return spec
+    if isinstance(spec, dict):
+        fmt = str(spec.get("format", "webp")).lower()
+        fmt = "jpeg" if fmt == "jpg" else fmt
+        if fmt not in _EXTENSIONS:
+            raise ValueError(f"不支持的变体格式: {fmt}")
+        max_side = spec.get("max_side")
+        quality = spec.get("quality")
+        return Variant(fmt, int(max_side) if max_side else None,
+                       int(quality) if quality is not None else None, spec.get("name"))
+    match = _SPEC.match(str(spec).strip())
+    if not match:
+        raise ValueError(f"无法解析变体: {spec!r}（格式如 jpeg@300:80、webp、avif@1024）")
+    fmt = match.group(1).lower()
+    fmt = "jpeg" if fmt == "jpg" else fmt
+    return Variant(fmt, int(match.group(2)) if match.group(2) else None,
+                   int(match.group(3)) if match.group(3) else None)
+
+
+def parse_variants(specs: Union[None, bool, str, Iterable[VariantSpec]]) -> List[Variant]:
+    """True / None 表示默认变体（IMAGE_VARIANTS 或 DEFAULT_VARIANTS），字符串按逗号分隔"""
+    if specs is None or specs is True:
+        env = os.getenv("IMAGE_VARIANTS")
+        return parse_variants(env) if env else list(DEFAULT_VARIANTS)
+    if specs is False:
+        return []
+    if isinstance(specs, str):
+        specs = [part for part in specs.split(",") if part.strip()]
+    variants = [parse_variant(spec) for spec in specs]
+    labels = [v.label for v in variants]
+    if len(set(labels)) != len(labels):
+        raise ValueError(f"变体名称重复: {labels}")
+    return variants
+
+
+def _supported(fmt: str) -> bool:
+    if fmt in ("jpeg", "png"):
+        return True
+    Image.init()
+    return fmt.upper() in Image.SAVE
+
+
+def _flatten(img, fmt: str):
+    """JPEG 不支持透明：合成到白底；其他格式保留 alpha"""
+    if fmt == "jpeg":
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            rgba = img.convert("RGBA")
+            background = Image.new("RGB", rgba.size, (255, 255, 255))
+            background.paste(rgba, mask=rgba.getchannel("A"))
+            return background
+        return img if img.mode in ("RGB", "L") else img.convert("RGB")
+    if img.mode not in ("RGB", "RGBA", "L", "LA"):
+        return img.convert("RGBA" if "transparency" in img.info else "RGB")
+    return img
+
+
+def _save(img, variant: Variant, path: str) -> None:
+    quality = variant.quality if variant.quality is not None else _DEFAULT_QUALITY[variant.format]
+    options: Dict[str, Any] = {}
+    if variant.format == "jpeg":
+        options = {"quality": quality, "optimize": True, "progressive": True}
+    elif variant.format == "webp":
+        options = {"quality": quality, "method": 4}
+    elif variant.format == "avif":
+        options = {"quality": quality, "speed": 6}
+    elif variant.format == "png":
+        options = {"optimize": True}
+    tmp_path = os.path.join(os.path.dirname(path) or ".", f".tmp-{uuid.uuid4().hex}.part")
+    try:
+        with open(tmp_path, "wb") as f:
+            img.save(f, format=variant.format.upper(), **options)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def variant_path(source: str, variant: Variant, output_dir: Optional[str] = None) -> str:
+    stem = os.path.splitext(os.path.basename(source))[0]
+    directory = output_dir or os.path.dirname(source)
+    return os.path.join(directory, f"{stem}_{variant.label}.{variant.extension}")
+
+
+def process_image(source: str, variants: Sequence[Variant], output_dir: Optional[str] = None) -> List[Dict[str, Any]]:
+    """解码一次 source，生成全部变体，返回 [{name, format, path, bytes, width, height}]"""
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with Image.open(source) as opened:
+        base = ImageOps.exif_transpose(opened)
+        base.load()
+    results: List[Dict[str, Any]] = []
+    # 从大到小缩放：每一级都从上一级结果缩小，避免对原图重复重采样
+    ordered = sorted(variants, key=lambda v: -(v.max_side or max(base.size)))
+    current = base
+    for variant in ordered:
+        if not _supported(variant.format):
+            logger.warning(f"当前 Pillow 不支持 {variant.format} 编码，跳过变体 {variant.label}")
+            continue
+        if variant.max_side and max(current.size) > variant.max_side:
+            scale = variant.max_side / max(current.size)
+            size = (max(1, round(current.width * scale)), max(1, round(current.height * scale)))
+            current = current.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        path = variant_path(source, variant, output_dir)
+        _save(_flatten(current, variant.format), variant, path)
+        results.append({
+            "name": variant.label,
+            "format": variant.format,
+            "path": path,
+            "bytes": os.path.getsize(path),
+            "width": current.width,
+            "height": current.height,
+        })
+    # 按调用方给出的顺序返回
+    order = {v.label: i for i, v in enumerate(variants)}
+    results.sort(key=lambda item: order[item["name"]])
+    return results
+
+
+_executor: Optional["ProcessPoolExecutor"] = None
+_executor_lock = threading.Lock()
+
+
+def _default_workers() -> int:
+    try:
+        return max(1, int(os.getenv("IMAGE_POSTPROCESS_WORKERS", 0)) or (os.cpu_count() or 1))
+    except ValueError:
+        return os.cpu_count() or 1
+
+
+def get_executor() -> "ProcessPoolExecutor":
+    """进程内共享的后处理进程池（首次使用时创建）"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+
+            _executor = ProcessPoolExecutor(max_workers=_default_workers())
+        return _executor
+
+
+def shutdown() -> None:
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+
+
+def process_paths(
+    paths: Sequence[str],
+    variants: Union[None, bool, str, Iterable[VariantSpec]] = None,
+    *,
+    output_dir: Optional[str] = None,
+    executor: Optional["Executor"] = None,
+) -> Dict[str, List[Dict[str, Any]]]:
+    """并行处理多张图片，返回 {原图路径: 变体列表}；单张失败时该图的结果为空列表并记录错误"""
+    variant_list = parse_variants(variants)
+    if not paths or not variant_list:
+        return {path: [] for path in paths}
+    if len(paths) == 1 and executor is None:
+        # 单张图不值得跨进程传递，直接在当前进程处理
+        futures = None
+    else:
+        pool = executor or get_executor()
+        futures = [pool.submit(process_image, path, variant_list, output_dir) for path in paths]
+    results: Dict[str, List[Dict[str, Any]]] = {}
+    for index, path in enumerate(paths):
+        try:
+            results[path] = futures[index].result() if futures else process_image(path, variant_list, output_dir)
+        except Exception as e:
+            logger.error(f"后处理失败 {path}: {e}")
+            results[path] = []
+    return results
@@ -0,0 +1,279 @@
+"""
+参考图上传前预处理：按目标尺寸缩放、压缩到字节预算内、去除元数据
+
+- 参考图缩放到所选 size 实际能用到的最大边长（"1K"/"2K"/"4K" 或 "1024x1536" 等），不放大。
+- 无透明通道的图片转为 JPEG，有透明通道的转为 WebP；按质量阶梯压缩，仍超出预算则继续缩小。
+- 重新编码时只保留 ICC 色彩配置，EXIF、XMP、PNG 文本块以及 C2PA（caBX）等元数据全部丢弃；
+  原图比重新编码结果更小时，只有逐块检查确认不含任何元数据才直接复用原始字节。
+- 遮罩统一为带 alpha 的 PNG，并用最近邻缩放到与处理后参考图完全一致的尺寸。
+- 透明度检测等逐像素操作使用 NumPy 向量化完成；每张图都会记录原始与处理后的字节数。
+- 多张参考图由 map_inputs() 在共享线程池中并发准备（读取、校验、预处理/编码），
+  Pillow 解码缩放与文件读取期间释放 GIL，6 张参考图的耗时接近单张；线程数可用 IMAGE_PREPARE_WORKERS 配置。
+"""
+from __future__ import annotations
+
+import base64
+import contextvars
+import io
+import logging
+import os
+import re
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, List, Optional, Sequence, Tuple, TypeVar, Union
+
+from encoding_cache import sniff_mime
+from lazy import lazy_import
+
+# numpy / Pillow 导入较慢，首次预处理时才加载
+np = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+ImageOps = lazy_import("PIL.ImageOps")
+
+logger = logging.getLogger('preprocess')
+
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+_QUALITY_STEPS = (90, 84, 78, 70, 62, 54)
+_SIZE_MAX_SIDE = {"1K": 1024, "2K": 2048, "4K": 4096}
+# gpt-image-1 的 "auto" 尺寸最大边为 1536
+_AUTO_MAX_SIDE = 1536
+
+
+@dataclass
+class PreparedImage:
+    """预处理结果"""
+    data: bytes
+    mime: str
+    width: int
+    height: int
+    original_bytes: int
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.original_bytes - len(self.data)
+
+    @property
+    def extension(self) -> str:
+        return {"image/jpeg": "jpg", "image/webp": "webp"}.get(self.mime, "png")
+
+    def data_url(self) -> str:
+        return f"data:{self.mime};base64,{base64.b64encode(self.data).decode('ascii')}"
+
+
+def target_max_side(size: Optional[str]) -> Optional[int]:
+    """返回 size 对应的最大边长；无法识别时返回 None（不缩放）"""
+    if not size:
+        return None
+    if size in _SIZE_MAX_SIDE:
+        return _SIZE_MAX_SIDE[size]
+    if size == "auto":
+        return _AUTO_MAX_SIDE
+    match = re.fullmatch(r"(\d+)x(\d+)", size)
+    if match:
+        return max(int(match.group(1)), int(match.group(2)))
+    return None
+
+
+def _read_input(image_input: Any) -> Tuple[Optional[bytes], Image.Image]:
+    """读取输入，返回 (原始字节或 None, 已打开的 PIL Image)"""
+    if isinstance(image_input, Image.Image):
+        return None, image_input
+    if isinstance(image_input, str):
+        with open(image_input, "rb") as f:
+            raw = f.read()
+    elif isinstance(image_input, (bytes, bytearray, memoryview)):
+        raw = bytes(image_input)
+    elif hasattr(image_input, "read"):
+        raw = image_input.read()
+        if hasattr(image_input, "seek"):
+            image_input.seek(0)
+    else:
+        raise ValueError(f"不支持的图片输入类型: {type(image_input)}")
+    return raw, Image.open(io.BytesIO(raw))
+
+
+def _has_transparency(img: Image.Image) -> bool:
+    if img.mode in ("RGBA", "LA", "PA"):
+        alpha = np.asarray(img.getchannel("A"))
+        return bool((alpha < 255).any())
+    if img.mode == "P" and "transparency" in img.info:
+        return True
+    return False
+
+
+# 原图直接复用时允许保留的块/段：图像数据与色彩信息，不含 EXIF、XMP、文本块、C2PA 等元数据
+_PNG_ALLOWED = {b"IHDR", b"PLTE", b"IDAT", b"IEND", b"tRNS", b"gAMA", b"cHRM", b"sRGB", b"iCCP", b"pHYs", b"sBIT", b"bKGD"}
+_WEBP_ALLOWED = {b"VP8 ", b"VP8L", b"VP8X", b"ALPH", b"ICCP"}
+# JPEG 中 APP0（JFIF）、APP2（ICC）、APP14（Adobe）之外的 APPn 与 COM 段都视为元数据
+_JPEG_ALLOWED_APP = {0xE0, 0xE2, 0xEE}
+
+
+def _metadata_free(raw: bytes, mime: str) -> bool:
+    """逐块检查原始字节中是否没有任何元数据；无法解析时按含元数据处理"""
+    try:
+        if mime == "image/png":
+            pos = 8
+            while pos + 8 <= len(raw):
+                length, kind = struct.unpack(">I4s", raw[pos:pos + 8])
+                if kind not in _PNG_ALLOWED:
+                    return False
+                if kind == b"IEND":
+                    return True
+                pos += 12 + length
+            return False
+        if mime == "image/webp":
+            pos = 12
+            while pos + 8 <= len(raw):
+                kind, length = struct.unpack("<4sI", raw[pos:pos + 8])
+                if kind not in _WEBP_ALLOWED:
+                    return False
+                pos += 8 + length + (length & 1)
+            return True
+        if mime == "image/jpeg":
+            pos = 2
+            while pos + 4 <= len(raw):
+                if raw[pos] != 0xFF:
+                    return False
+                marker = raw[pos + 1]
+                if marker == 0xDA:
+                    # 扫描数据开始，之后不再有元数据段
+                    return True
+                if (0xE0 <= marker <= 0xEF and marker not in _JPEG_ALLOWED_APP) or marker == 0xFE:
+                    return False
+                pos += 2 + struct.unpack(">H", raw[pos + 2:pos + 4])[0]
+            return False
+    except struct.error:
+        return False
+    return False
+
+
+def _encode(img: Image.Image, fmt: str, quality: int, icc: Optional[bytes]) -> bytes:
+    buffer = io.BytesIO()
+    params = {"quality": quality}
+    if icc:
+        params["icc_profile"] = icc
+    if fmt == "JPEG":
+        params.update(optimize=True, progressive=True)
+    elif fmt == "WEBP":
+        params.update(method=4)
+    img.save(buffer, format=fmt, **params)
+    return buffer.getvalue()
+
+
+def prepare_image(
+    image_input: Any,
+    size: Optional[str] = None,
+    *,
+    max_bytes: int = DEFAULT_MAX_BYTES,
+) -> PreparedImage:
+    """按目标 size 缩放并压缩参考图（文件路径 / 字节 / 文件对象 / PIL Image）。"""
+    raw, img = _read_input(image_input)
+    max_side = target_max_side(size)
+
+    # JPEG 可以在解码阶段直接按 1/2、1/4、1/8 缩小，省去全尺寸解码
+    if max_side and img.format == "JPEG":
+        img.draft("RGB", (max_side, max_side))
+    icc = img.info.get("icc_profile")
+    oriented = img.getexif().get(0x0112, 1) != 1
+    img = ImageOps.exif_transpose(img)
+
+    transparent = _has_transparency(img)
+    if transparent:
+        img = img.convert("RGBA")
+        fmt, mime = "WEBP", "image/webp"
+    else:
+        img = img.convert("RGB")
+        fmt, mime = "JPEG", "image/jpeg"
+
+    resized = False
+    if max_side and max(img.size) > max_side:
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        resized = True
+
+    original_bytes = len(raw) if raw is not None else 0
+    data = b""
+    while True:
+        for quality in _QUALITY_STEPS:
+            data = _encode(img, fmt, quality, icc)
+            if len(data) <= max_bytes:
+                break
+        if len(data) <= max_bytes or min(img.size) <= 256:
+            break
+        # 最低质量仍超预算：继续缩小 15%
+        img = img.resize((int(img.width * 0.85), int(img.height * 0.85)), Image.LANCZOS)
+        resized = True
+
+    if raw is not None and not resized and not oriented and len(raw) <= len(data) and len(raw) <= max_bytes:
+        # 原图尺寸已合适、本身更小且不含元数据：直接使用原始字节
+        original_mime = sniff_mime(raw[:32])
+        if original_mime in ("image/png", "image/jpeg", "image/webp") and _metadata_free(raw, original_mime):
+            return PreparedImage(raw, original_mime, img.width, img.height, original_bytes)
+
+    prepared = PreparedImage(data, mime, img.width, img.height, original_bytes or len(data))
+    logger.info(
+        f"参考图预处理: {original_bytes} -> {len(data)} 字节 ({img.width}x{img.height} {mime})"
+    )
+    return prepared
+
+
+def prepare_mask(mask_input: Any, target_size: Tuple[int, int]) -> PreparedImage:
+    """将遮罩转换为带 alpha 的 PNG，并缩放到与参考图一致的尺寸"""
+    raw, mask = _read_input(mask_input)
+    mask = mask.convert("RGBA")
+    if mask.size != tuple(target_size):
+        # 最近邻缩放保持遮罩边界清晰，不引入半透明像素
+        mask = mask.resize(tuple(target_size), Image.NEAREST)
+    buffer = io.BytesIO()
+    mask.save(buffer, format="PNG", optimize=True)
+    data = buffer.getvalue()
+    original_bytes = len(raw) if raw is not None else len(data)
+    logger.info(f"遮罩预处理: {original_bytes} -> {len(data)} 字节 ({mask.width}x{mask.height})")
+    return PreparedImage(data, "image/png", mask.width, mask.height, original_bytes)
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _prepare_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            try:
+                workers = int(os.getenv("IMAGE_PREPARE_WORKERS", 0))
+            except ValueError:
+                workers = 0
+            _executor = ThreadPoolExecutor(
+                max_workers=workers or min(32, (os.cpu_count() or 1) + 4),
+                thread_name_prefix="prepare",
+            )
+        return _executor
+
+
+def map_inputs(fn: Callable[[T], R], items: Sequence[T]) -> List[Union[R, Exception]]:
+    """并发执行 fn(item)，按输入顺序返回结果；单项失败时对应位置为异常对象（由调用方决定跳过还是抛出）
+
+    单个输入直接在当前线程执行；任务在调用方的 contextvars 上下文中运行（指标埋点归属不变）。
+    """
+    if len(items) <= 1:
+        results: List[Union[R, Exception]] = []
+        for item in items:
+            try:
+                results.append(fn(item))
+            except Exception as e:
+                results.append(e)
+        return results
+    pool = _prepare_executor()
+    futures = [pool.submit(contextvars.copy_context().run, fn, item) for item in items]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(e)
+    return results
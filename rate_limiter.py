@@ -0,0 +1,343 @@
+"""
+客户端限流：按 provider / endpoint / deployment 的令牌桶，多进程共享配额
+
+- 每个键可配置两类预算：requests-per-minute（每次请求消耗 1）与 images-per-minute（消耗本次请求的图片数），
+  两个桶同时有足够令牌才会放行，且原子扣减。
+- 调用方在配额不足时排队等待（acquire），而不是撞上 429 后再失败重试；
+  在 budget 预算内排队时，等待不超过剩余时间，取消后不再放行。
+- 后端：
+  FileBackend（默认）：状态存于本地目录下的 JSON 文件，用文件锁在同机多进程间同步；
+  RedisBackend：Lua 脚本原子更新，适合多机共享（与 Node 服务共用同一个 Redis）。
+
+环境变量（未配置的预算不限流）：
+  SEEDREAM4_RPM / SEEDREAM4_IPM
+  AZURE_OPENAI_RPM / AZURE_OPENAI_IPM
+  IMAGE_RATE_LIMIT_BACKEND=file|redis          # 默认 file
+  IMAGE_RATE_LIMIT_DIR=<目录>                   # file 后端状态目录，默认系统临时目录
+  REDIS_HOST / REDIS_PORT / REDIS_PASSWORD / REDIS_DB   # 与 server/ 的 Redis 配置一致
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import budget
+
+logger = logging.getLogger('rate_limiter')
+
+# provider -> 环境变量前缀
+_ENV_PREFIX = {
+    "seedream4": "SEEDREAM4",
+    "azure_openai": "AZURE_OPENAI",
+}
+
+
+@dataclass(frozen=True)
+class Bucket:
+    """令牌桶：capacity 为桶容量，rate 为每秒补充的令牌数"""
+    name: str
+    capacity: float
+    rate: float
+
+    @classmethod
+    def per_minute(cls, name: str, limit: float, burst: Optional[float] = None) -> "Bucket":
+        return cls(name, float(burst if burst is not None else limit), limit / 60.0)
+
+
+def _refill(state: Dict[str, float], bucket: Bucket, now: float) -> float:
+    tokens = state.get("tokens", bucket.capacity)
+    last = state.get("ts", now)
+    return min(bucket.capacity, tokens + max(0.0, now - last) * bucket.rate)
+
+
+def _take(states: Dict[str, Dict[str, float]], demands: List[Tuple[Bucket, float]], now: float) -> float:
+    """在 states 上尝试原子扣减；成功返回 0，否则返回需要等待的秒数（此时不扣减）"""
+    wait = 0.0
+    levels = []
+    for bucket, amount in demands:
+        tokens = _refill(states.get(bucket.name, {}), bucket, now)
+        levels.append(tokens)
+        if tokens < amount:
+            wait = max(wait, (amount - tokens) / bucket.rate if bucket.rate > 0 else float("inf"))
+    if wait > 0:
+        return wait
+    for (bucket, amount), tokens in zip(demands, levels):
+        states[bucket.name] = {"tokens": tokens - amount, "ts": now}
+    return 0.0
+
+
+class FileBackend:
+    """本地文件 + 文件锁后端，同一台机器上的所有进程共享配额"""
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory or os.getenv(
+            "IMAGE_RATE_LIMIT_DIR", os.path.join(tempfile.gettempdir(), "image-rate-limits")
+        )
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, re.sub(r"[^A-Za-z0-9_.-]", "_", key) + ".json")
+
+    @staticmethod
+    def _lock(f) -> None:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    return
+                except OSError:
+                    continue
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    @staticmethod
+    def _unlock(f) -> None:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            return
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def take(self, key: str, demands: List[Tuple[Bucket, float]]) -> float:
+        with open(self._path(key), "a+b") as f:
+            self._lock(f)
+            try:
+                f.seek(0)
+                raw = f.read()
+                try:
+                    states = json.loads(raw) if raw else {}
+                except ValueError:
+                    states = {}
+                wait = _take(states, demands, time.time())
+                if wait == 0:
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(states).encode("utf-8"))
+                    f.flush()
+                return wait
+            finally:
+                self._unlock(f)
+
+
+_REDIS_SCRIPT = """
+local now = tonumber(ARGV[1])
+local n = #KEYS
+local wait = 0
+local levels = {}
+for i = 1, n do
+  local capacity = tonumber(ARGV[2 + (i - 1) * 3])
+  local rate = tonumber(ARGV[3 + (i - 1) * 3])
+  local amount = tonumber(ARGV[4 + (i - 1) * 3])
+  local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+  local tokens = tonumber(state[1]) or capacity
+  local ts = tonumber(state[2]) or now
+  tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+  levels[i] = tokens
+  if tokens < amount then
+    local w = (amount - tokens) / rate
+    if w > wait then wait = w end
+  end
+end
+if wait > 0 then return tostring(wait) end
+for i = 1, n do
+  local capacity = tonumber(ARGV[2 + (i - 1) * 3])
+  local rate = tonumber(ARGV[3 + (i - 1) * 3])
+  local amount = tonumber(ARGV[4 + (i - 1) * 3])
+  redis.call('HSET', KEYS[i], 'tokens', levels[i] - amount, 'ts', now)
+  redis.call('EXPIRE', KEYS[i], math.ceil(capacity / rate) + 60)
+end
+return '0'
+"""
+
+
+class RedisBackend:
+    """Redis 后端：多机共享配额（需要安装 redis 包）"""
+
+    def __init__(self, client=None, prefix: str = "image-rate-limit:"):
+        if client is None:
+            try:
+                import redis
+            except ImportError as e:
+                raise RuntimeError("RedisBackend 需要安装 redis 包: pip install redis") from e
+            client = redis.Redis(
+                host=os.getenv("REDIS_HOST", "localhost"),
+                port=int(os.getenv("REDIS_PORT", 6379)),
+                password=os.getenv("REDIS_PASSWORD") or None,
+                db=int(os.getenv("REDIS_DB", 0)),
+            )
+        self.client = client
+        self.prefix = prefix
+        self._script = client.register_script(_REDIS_SCRIPT)
+
+    def take(self, key: str, demands: List[Tuple[Bucket, float]]) -> float:
+        keys = [f"{self.prefix}{key}:{bucket.name}" for bucket, _ in demands]
+        args: List[float] = [time.time()]
+        for bucket, amount in demands:
+            args.extend([bucket.capacity, bucket.rate, amount])
+        return float(self._script(keys=keys, args=args))
+
+
+class RateLimiter:
+    """单个 provider/endpoint/deployment 的限流器"""
+
+    def __init__(
+        self,
+        provider: str,
+        endpoint: str,
+        deployment: str = "",
+        *,
+        rpm: Optional[float] = None,
+        ipm: Optional[float] = None,
+        backend=None,
+    ):
+        self.key = f"{provider}:{endpoint}:{deployment}"
+        self.backend = backend or FileBackend()
+        self.buckets: Dict[str, Bucket] = {}
+        if rpm:
+            self.buckets["requests"] = Bucket.per_minute("requests", rpm)
+        if ipm:
+            self.buckets["images"] = Bucket.per_minute("images", ipm)
+
+    def _demands(self, images: int) -> List[Tuple[Bucket, float]]:
+        demands = []
+        if "requests" in self.buckets:
+            demands.append((self.buckets["requests"], 1.0))
+        if "images" in self.buckets:
+            bucket = self.buckets["images"]
+            # 单次请求的图片数超过桶容量时按容量计，否则永远无法放行
+            demands.append((bucket, min(float(images), bucket.capacity)))
+        return demands
+
+    def try_acquire(self, images: int = 1) -> float:
+        """尝试立即取得配额：成功返回 0，否则返回预计需要等待的秒数"""
+        demands = self._demands(images)
+        if not demands:
+            return 0.0
+        return self.backend.take(self.key, demands)
+
+    def acquire(self, images: int = 1, timeout: Optional[float] = None) -> float:
+        """排队等待配额，返回实际等待的秒数；超过 timeout 仍未取得时抛出 TimeoutError
+
+        在 budget 预算内排队时，取消或超时后立即抛出 Cancelled / DeadlineExceeded，不再等到下一次检查。
+        """
+        started = time.monotonic()
+        token = budget.cancel_token()
+        while True:
+            budget.check("throttle")
+            wait = self.try_acquire(images)
+            if wait == 0:
+                waited = time.monotonic() - started
+                if waited > 0.05:
+                    logger.info(f"{self.key} 限流排队 {waited:.2f}s")
+                return waited
+            if timeout is not None and time.monotonic() - started + wait > timeout:
+                raise TimeoutError(f"{self.key} 等待配额超时")
+            # 多进程竞争同一配额，醒来后重新检查；取消时令牌置位，立即醒来
+            if token is not None:
+                token.wait(min(wait, 5.0))
+            else:
+                time.sleep(min(wait, 5.0))
+
+
+_limiters: Dict[str, Optional[RateLimiter]] = {}
+_limiters_lock = threading.Lock()
+_backend = None
+
+
+def _default_backend():
+    global _backend
+    if _backend is None:
+        kind = os.getenv("IMAGE_RATE_LIMIT_BACKEND", "file").lower()
+        _backend = RedisBackend() if kind == "redis" else FileBackend()
+    return _backend
+
+
+def _env_float(name: str) -> Optional[float]:
+    value = os.getenv(name)
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def register_limiter(limiter: RateLimiter) -> None:
+    """以代码方式注册（或覆盖）某个键的限流器"""
+    with _limiters_lock:
+        _limiters[limiter.key] = limiter
+
+
+def get_limiter(provider: str, endpoint: str, deployment: str = "") -> Optional[RateLimiter]:
+    """取得限流器；该 provider 未配置任何预算时返回 None"""
+    key = f"{provider}:{endpoint}:{deployment}"
+    with _limiters_lock:
+        if key in _limiters:
+            return _limiters[key]
+        prefix = _ENV_PREFIX.get(provider, provider.upper())
+        rpm = _env_float(f"{prefix}_RPM")
+        ipm = _env_float(f"{prefix}_IPM")
+        limiter = None
+        if rpm or ipm:
+            limiter = RateLimiter(provider, endpoint, deployment, rpm=rpm, ipm=ipm, backend=_default_backend())
+        _limiters[key] = limiter
+        return limiter
+
+
+def throttle(provider: str, endpoint: str, deployment: str = "", images: int = 1) -> float:
+    """发起请求前调用：有配置时排队等待配额，返回等待秒数；未配置时立即返回 0"""
+    limiter = get_limiter(provider, endpoint, deployment)
+    if limiter is None:
+        budget.check("throttle")
+        return 0.0
+    try:
+        waited = limiter.acquire(images, timeout=budget.remaining())
+    except TimeoutError:
+        raise budget.DeadlineExceeded(f"{limiter.key} 等待配额超出整体时限") from None
+    # 排队期间可能已被取消，此时不再发出请求
+    budget.check("throttle")
+    return waited
+
+
+async def athrottle(provider: str, endpoint: str, deployment: str = "", images: int = 1) -> float:
+    """throttle 的异步版本：等待期间不阻塞事件循环；取消令牌置位时立即停止排队"""
+    import asyncio
+
+    limiter = get_limiter(provider, endpoint, deployment)
+    if limiter is None:
+        budget.check("throttle")
+        return 0.0
+    started = time.monotonic()
+    token = budget.cancel_token()
+    while True:
+        budget.check("throttle")
+        # 文件锁 / Redis 调用很短，但仍放到线程中避免阻塞事件循环
+        wait = await asyncio.to_thread(limiter.try_acquire, images)
+        if wait == 0:
+            # 排队期间可能已被取消，此时不再发出请求
+            budget.check("throttle")
+            return time.monotonic() - started
+        left = budget.remaining()
+        if left is not None and wait > left:
+            raise budget.DeadlineExceeded(f"{limiter.key} 等待配额超出整体时限")
+        if token is None:
+            await asyncio.sleep(min(wait, 5.0))
+            continue
+        woken = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        unlink = token.on_cancel(lambda: loop.call_soon_threadsafe(woken.set))
+        try:
+            await asyncio.wait_for(woken.wait(), min(wait, 5.0))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            unlink()
@@ -0,0 +1,229 @@
+"""
+局部编辑：遮罩只覆盖一小块区域时，只上传该区域的裁剪图，返回的补丁在本地羽化合成回原图
+
+- 遮罩中的可编辑区域：带透明度的遮罩取 alpha < 128 的像素（与 images/edits 约定一致），
+  不带透明度的黑白遮罩取黑色（亮度 < 128）像素；外接框用 NumPy 向量化求出；
+- 外接框向外扩展 margin 像素后，按 gpt-image-1 支持的尺寸（1024x1024 / 1536x1024 / 1024x1536）
+  选取面积最小、能装下该区域的同比例裁剪框，裁剪框超出该尺寸时缩小到该尺寸再上传；
+- 裁剪框占原图面积超过 max_area_ratio，或任何比例都放不进原图时返回 None，由调用方按整图上传；
+- 合成：补丁缩放回裁剪框大小，可编辑区域内完全取补丁，向外 feather 像素内渐变到原图，
+  裁剪框内侧边缘（不与原图边缘重合的边）同样渐变，原图其余像素保持不变。
+
+用法:
+    crop = region_edit.crop_to_region("photo.jpg", "mask.png", margin=64)
+    if crop is not None:
+        patches = upload(crop.image.data, crop.mask.data, size=crop.size)
+        full_images = [crop.composite(patch) for patch in patches]
+"""
+from __future__ import annotations
+
+import io
+import logging
+from dataclasses import dataclass
+from typing import Any, Optional, Sequence, Tuple
+
+from lazy import lazy_import
+from preprocess import PreparedImage, prepare_image, prepare_mask
+
+np = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+ImageFilter = lazy_import("PIL.ImageFilter")
+ImageOps = lazy_import("PIL.ImageOps")
+
+logger = logging.getLogger('region_edit')
+
+# gpt-image-1 images/edits 支持的输出尺寸
+SUPPORTED_SIZES: Tuple[Tuple[int, int], ...] = ((1024, 1024), (1536, 1024), (1024, 1536))
+DEFAULT_MARGIN = 64
+DEFAULT_FEATHER = 24
+DEFAULT_MAX_AREA_RATIO = 0.6
+
+Box = Tuple[int, int, int, int]
+
+# EXIF Orientation -> Image.transpose 的方法（与 ImageOps.exif_transpose 一致）
+_EXIF_TRANSPOSE = {2: 0, 3: 3, 4: 1, 5: 5, 6: 4, 7: 6, 8: 2}
+
+
+def editable_mask(mask) -> "np.ndarray":
+    """返回可编辑区域的布尔数组 (H, W)"""
+    if mask.mode in ("RGBA", "LA", "PA") or (mask.mode == "P" and "transparency" in mask.info):
+        alpha = np.asarray(mask.convert("RGBA").getchannel("A"))
+        if (alpha < 255).any():
+            return alpha < 128
+    return np.asarray(mask.convert("L")) < 128
+
+
+def bounding_box(editable: "np.ndarray") -> Optional[Box]:
+    """可编辑区域的外接框 (left, top, right, bottom)；没有可编辑像素时返回 None"""
+    rows = np.flatnonzero(editable.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(editable.any(axis=0))
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+
+def plan_crop(
+    image_size: Tuple[int, int],
+    bbox: Box,
+    *,
+    margin: int = DEFAULT_MARGIN,
+    sizes: Sequence[Tuple[int, int]] = SUPPORTED_SIZES,
+) -> Optional[Tuple[Box, Tuple[int, int]]]:
+    """为外接框选取裁剪框与上传尺寸，返回 (裁剪框, (宽, 高))；任何比例都放不进原图时返回 None"""
+    width, height = image_size
+    left, top = max(0, bbox[0] - margin), max(0, bbox[1] - margin)
+    right, bottom = min(width, bbox[2] + margin), min(height, bbox[3] + margin)
+    need_w, need_h = right - left, bottom - top
+    best = None
+    for size_w, size_h in sizes:
+        # 同比例放大到能装下所需区域
+        scale = max(need_w / size_w, need_h / size_h)
+        crop_w, crop_h = round(size_w * scale), round(size_h * scale)
+        if crop_w > width or crop_h > height:
+            continue
+        if best is None or crop_w * crop_h < best[0][0] * best[0][1]:
+            best = ((crop_w, crop_h), (size_w, size_h))
+    if best is None:
+        return None
+    (crop_w, crop_h), target = best
+    # 以所需区域为中心放置裁剪框，越界时贴边
+    x = min(max(0, (left + right - crop_w) // 2), width - crop_w)
+    y = min(max(0, (top + bottom - crop_h) // 2), height - crop_h)
+    return (x, y, x + crop_w, y + crop_h), target
+
+
+def _blend_weights(editable: "np.ndarray", box: Box, image_size: Tuple[int, int], feather: int) -> "np.ndarray":
+    """合成权重 (H, W)：可编辑区域为 1，向外 feather 像素内渐变到 0；裁剪框内侧边缘同样渐变"""
+    weights = editable.astype(np.float32)
+    if feather > 0:
+        # 模糊后放大一倍：区域边缘（约 0.5）及以内取 1，向外约 feather 像素内降到 0
+        blurred = Image.fromarray(editable.astype(np.uint8) * 255, "L").filter(ImageFilter.GaussianBlur(feather / 2))
+        weights = np.maximum(weights, np.clip(np.asarray(blurred, dtype=np.float32) / 127.5, 0.0, 1.0))
+        height, width = editable.shape
+        inf = np.float32(np.inf)
+        xs = np.arange(width, dtype=np.float32)
+        ys = np.arange(height, dtype=np.float32)
+        # 与原图边缘重合的边不需要过渡
+        left = xs + 0.5 if box[0] > 0 else np.full(width, inf)
+        right = width - xs - 0.5 if box[2] < image_size[0] else np.full(width, inf)
+        top = ys + 0.5 if box[1] > 0 else np.full(height, inf)
+        bottom = height - ys - 0.5 if box[3] < image_size[1] else np.full(height, inf)
+        ramp = np.minimum.outer(np.minimum(top, bottom), np.minimum(left, right)) / feather
+        weights *= np.clip(ramp, 0.0, 1.0)
+    return weights
+
+
+@dataclass
+class RegionCrop:
+    """裁剪后的上传内容及合成所需信息"""
+    image: PreparedImage
+    mask: PreparedImage
+    box: Box
+    size: str
+    original: Any
+    weights: Any
+    original_bytes: int
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.original_bytes - len(self.image.data) - len(self.mask.data)
+
+    def composite(self, patch: bytes) -> bytes:
+        """把返回的补丁羽化合成回原图，返回整图 PNG 字节"""
+        crop_size = (self.box[2] - self.box[0], self.box[3] - self.box[1])
+        with Image.open(io.BytesIO(patch)) as opened:
+            patch_img = opened.convert(self.original.mode)
+        if patch_img.size != crop_size:
+            patch_img = patch_img.resize(crop_size, Image.LANCZOS)
+        base = np.asarray(self.original.crop(self.box), dtype=np.float32)
+        edited = np.asarray(patch_img, dtype=np.float32)
+        weights = self.weights[..., None] if base.ndim == 3 else self.weights
+        blended = base + (edited - base) * weights
+        result = self.original.copy()
+        result.paste(Image.fromarray(np.clip(blended + 0.5, 0, 255).astype(np.uint8), self.original.mode), self.box[:2])
+        buffer = io.BytesIO()
+        result.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+
+def _orient_mask(mask, orientation: int, raw_size: Tuple[int, int], size: Tuple[int, int]):
+    """把遮罩转到与原图相同的方向，返回已载入像素的新图
+
+    遮罩自带 EXIF 方向时按其转正；遮罩仍是原图转正前的尺寸（按原始像素方向绘制）时，
+    按原图的 EXIF 方向同样旋转，再由调用方缩放，避免编辑区域落到错误的位置。
+    """
+    mask = ImageOps.exif_transpose(mask)
+    method = _EXIF_TRANSPOSE.get(orientation)
+    if method is not None and mask.size != size and mask.size == raw_size:
+        mask = mask.transpose(Image.Transpose(method))
+    mask.load()
+    return mask
+
+
+def crop_to_region(
+    image_input: Any,
+    mask_input: Any,
+    *,
+    margin: int = DEFAULT_MARGIN,
+    feather: int = DEFAULT_FEATHER,
+    max_area_ratio: float = DEFAULT_MAX_AREA_RATIO,
+) -> Optional[RegionCrop]:
+    """计算遮罩区域并裁剪原图与遮罩（文件路径或字节）；区域过大或无法按支持的比例裁剪时返回 None（应整图上传）"""
+    if isinstance(image_input, (bytes, bytearray, memoryview)):
+        raw = bytes(image_input)
+    else:
+        with open(image_input, "rb") as f:
+            raw = f.read()
+    with Image.open(io.BytesIO(raw)) as opened:
+        raw_size = opened.size
+        orientation = opened.getexif().get(0x0112, 1)
+        original = ImageOps.exif_transpose(opened)
+        original.load()
+    has_alpha = original.mode in ("RGBA", "LA", "PA") or "transparency" in original.info
+    original = original.convert("RGBA" if has_alpha else "RGB")
+
+    if isinstance(mask_input, Image.Image):
+        mask_img = _orient_mask(mask_input, orientation, raw_size, original.size)
+    else:
+        with Image.open(mask_input) as opened:
+            mask_img = _orient_mask(opened, orientation, raw_size, original.size)
+    if mask_img.size != original.size:
+        # 与 prepare_mask 一致：最近邻缩放，不引入半透明像素
+        mask_img = mask_img.resize(original.size, Image.NEAREST)
+    editable = editable_mask(mask_img)
+    bbox = bounding_box(editable)
+    if bbox is None:
+        raise ValueError("遮罩中没有可编辑区域")
+
+    # 羽化过渡必须落在裁剪边距之内
+    feather = max(0, min(feather, margin))
+    planned = plan_crop(original.size, bbox, margin=margin)
+    if planned is None:
+        logger.info("遮罩区域无法按支持的尺寸比例裁剪，改为整图上传")
+        return None
+    box, (size_w, size_h) = planned
+    area_ratio = (box[2] - box[0]) * (box[3] - box[1]) / (original.width * original.height)
+    if area_ratio > max_area_ratio:
+        logger.info(f"裁剪框占原图 {area_ratio:.0%}，超过 {max_area_ratio:.0%}，改为整图上传")
+        return None
+
+    crop_editable = editable[box[1]:box[3], box[0]:box[2]]
+    # 上传的遮罩统一为 images/edits 约定：可编辑区域透明，其余不透明
+    crop_mask = Image.new("RGBA", (box[2] - box[0], box[3] - box[1]), (0, 0, 0, 255))
+    crop_mask.putalpha(Image.fromarray(np.where(crop_editable, 0, 255).astype(np.uint8), "L"))
+    image = prepare_image(original.crop(box), f"{size_w}x{size_h}")
+    mask = prepare_mask(crop_mask, (image.width, image.height))
+    crop = RegionCrop(
+        image=image,
+        mask=mask,
+        box=box,
+        size=f"{size_w}x{size_h}",
+        original=original,
+        weights=_blend_weights(crop_editable, box, original.size, feather),
+        original_bytes=len(raw),
+    )
+    logger.info(
+        f"局部编辑: 遮罩区域 {bbox}，裁剪 {box} -> {image.width}x{image.height}，"
+        f"上传 {len(image.data) + len(mask.data)} 字节（原图 {len(raw)} 字节）"
+    )
+    return crop
@@ -0,0 +1,434 @@
+"""
+重试、退避与对冲请求：SeeDream 与 gpt_image_1 共用的容错层
+
+- 指数退避 + 全抖动（full jitter），优先遵循服务端的 Retry-After / retry-after-ms。
+- classify_error() 把 requests / httpx / openai SDK 的异常与状态码统一归类为可重试或不可重试：
+  超时、连接中断、408/409/425/429/5xx 可重试；其余 4xx（参数错误、鉴权失败、内容审核）直接失败。
+- 对冲请求（可选）：单次尝试超过该端点近期延迟的 p95（或固定阈值）仍未返回时，再发起一次相同请求，
+  先成功者胜出，另一个尝试被标记取消，其结果被丢弃、连接在返回后立即释放。
+  阈值从尝试真正开始执行时计时；对冲线程池默认大小可用 IMAGE_HEDGE_WORKERS 配置，reserve() 按并发数扩容。
+  注意：对冲会产生额外的付费调用，默认关闭。
+- 在 budget 预算内执行时：每次尝试前检查剩余时间，退避等待超出剩余时间时不再重试，
+  取消或超时时立即返回调用方（见 budget）；DeadlineExceeded / Cancelled 不会被重试。
+- aexecute() 是 execute() 的异步版本，供 httpx / AsyncAzureOpenAI 客户端使用：策略、错误归类与延迟统计相同，
+  对冲时落败的尝试直接取消任务。
+
+用法:
+    policy = RetryPolicy(max_attempts=4, hedge_percentile=0.95)
+    result = execute(lambda cancel: do_request(), policy, key="seedream4:generations")
+    result = await aexecute(lambda: do_request_async(), policy, key="seedream4:generations")
+"""
+from __future__ import annotations
+
+import contextvars
+import email.utils
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, List, Optional, Tuple, TypeVar
+
+import budget
+import metrics
+from lazy import lazy_import
+
+asyncio = lazy_import("asyncio")
+
+logger = logging.getLogger('resilience')
+
+T = TypeVar("T")
+
+RETRYABLE_STATUSES: FrozenSet[int] = frozenset({408, 409, 425, 429, 500, 502, 503, 504})
+
+
+class RetryableError(Exception):
+    """可重试的上游错误（如 429/5xx），携带状态码与服务端建议的等待时间"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None,
+                 response: Any = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.response = response
+
+
+class AttemptCancelled(Exception):
+    """对冲请求中落败的尝试被取消"""
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """重试与对冲策略
+
+    - max_attempts: 总尝试次数（含首次）
+    - base_delay / max_delay / multiplier: 退避时间为 min(max_delay, base_delay * multiplier**(n-1)) 内的随机值
+    - max_retry_after: 服务端 Retry-After 超过该值时不再等待，直接失败
+    - hedge_after: 固定对冲阈值（秒）；hedge_percentile: 按近期延迟分位数对冲（如 0.95），二者均为 None 时不对冲
+    - hedge_min_samples: 使用分位数对冲前至少需要的延迟样本数
+    """
+    max_attempts: int = 4
+    base_delay: float = 1.0
+    max_delay: float = 30.0
+    multiplier: float = 2.0
+    max_retry_after: float = 120.0
+    retry_statuses: FrozenSet[int] = RETRYABLE_STATUSES
+    hedge_after: Optional[float] = None
+    hedge_percentile: Optional[float] = None
+    hedge_min_samples: int = 20
+
+
+DEFAULT_POLICY = RetryPolicy()
+NO_RETRY = RetryPolicy(max_attempts=1)
+
+
+def parse_retry_after(headers: Any) -> Optional[float]:
+    """解析 retry-after-ms / Retry-After（秒数或 HTTP 日期），返回等待秒数"""
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(float(value) / 1000.0, 0.0)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(when.timestamp() - time.time(), 0.0)
+
+
+def _error_names(exc: BaseException) -> Tuple[str, ...]:
+    return tuple(cls.__name__ for cls in type(exc).__mro__)
+
+
+def classify_error(exc: BaseException, policy: RetryPolicy = DEFAULT_POLICY) -> Tuple[bool, Optional[float]]:
+    """判断异常是否可重试，返回 (可重试, 服务端建议等待秒数)"""
+    if isinstance(exc, RetryableError):
+        return True, exc.retry_after
+    if isinstance(exc, (AttemptCancelled, budget.DeadlineExceeded, budget.Cancelled)):
+        return False, None
+
+    # 带响应的 HTTP 错误：requests.HTTPError / httpx.HTTPStatusError / openai.APIStatusError
+    response = getattr(exc, "response", None)
+    status = getattr(exc, "status_code", None) or getattr(response, "status_code", None)
+    if status is not None:
+        retry_after = parse_retry_after(getattr(response, "headers", None))
+        return int(status) in policy.retry_statuses, retry_after
+
+    # 无响应的传输层错误：超时、连接失败、读取中断
+    names = _error_names(exc)
+    transient = (
+        "Timeout", "ConnectionError", "ChunkedEncodingError",        # requests
+        "TimeoutException", "TransportError",                         # httpx
+        "APITimeoutError", "APIConnectionError",                      # openai
+    )
+    if any(name in names for name in transient):
+        return True, None
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return True, None
+    return False, None
+
+
+def check_response(response: Any, policy: RetryPolicy = DEFAULT_POLICY) -> Any:
+    """状态码属于可重试集合时关闭响应并抛出 RetryableError，否则原样返回"""
+    status = getattr(response, "status_code", None)
+    if status in policy.retry_statuses:
+        retry_after = parse_retry_after(response.headers)
+        text = ""
+        try:
+            text = response.text[:500]
+        except Exception:
+            pass
+        if not getattr(response, "is_closed", False):
+            # httpx 的非流式响应读取后已关闭（异步响应也不能同步关闭），requests 的响应需显式关闭
+            response.close()
+        raise RetryableError(f"上游返回 {status}: {text}", status_code=status,
+                             retry_after=retry_after, response=response)
+    return response
+
+
+def backoff_delay(policy: RetryPolicy, attempt: int, retry_after: Optional[float] = None) -> float:
+    """第 attempt 次失败后的等待时间（全抖动）；服务端给出 Retry-After 时以其为下限"""
+    ceiling = min(policy.max_delay, policy.base_delay * policy.multiplier ** (attempt - 1))
+    delay = random.uniform(0, ceiling)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+class LatencyTracker:
+    """滑动窗口延迟统计，用于计算对冲阈值"""
+
+    def __init__(self, window: int = 200):
+        self._samples: deque = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if not self._samples:
+                return None
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+        return ordered[index]
+
+
+_trackers: Dict[str, LatencyTracker] = {}
+_trackers_lock = threading.Lock()
+
+
+def tracker(key: str) -> LatencyTracker:
+    """按端点取得延迟统计（进程内共享）"""
+    with _trackers_lock:
+        found = _trackers.get(key)
+        if found is None:
+            found = _trackers[key] = LatencyTracker()
+        return found
+
+
+def _hedge_threshold(policy: RetryPolicy, latency: LatencyTracker) -> Optional[float]:
+    if policy.hedge_after is not None:
+        return policy.hedge_after
+    if policy.hedge_percentile is not None and len(latency) >= policy.hedge_min_samples:
+        return latency.percentile(policy.hedge_percentile)
+    return None
+
+
+_hedge_pool: Optional[ThreadPoolExecutor] = None
+_hedge_workers = 0
+_hedge_lock = threading.Lock()
+
+
+def _default_hedge_workers() -> int:
+    try:
+        configured = int(os.getenv("IMAGE_HEDGE_WORKERS", 0))
+    except ValueError:
+        configured = 0
+    return configured or max(64, 16 * (os.cpu_count() or 1))
+
+
+def _hedge_executor(min_workers: int = 0) -> ThreadPoolExecutor:
+    """对冲尝试使用的线程池；容量不足 min_workers 时换成更大的线程池（旧池中的尝试照常执行完）"""
+    global _hedge_pool, _hedge_workers
+    with _hedge_lock:
+        if _hedge_pool is None or _hedge_workers < min_workers:
+            workers = max(min_workers, _hedge_workers or _default_hedge_workers())
+            previous = _hedge_pool
+            _hedge_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hedge")
+            _hedge_workers = workers
+            if previous is not None:
+                previous.shutdown(wait=False)
+        return _hedge_pool
+
+
+def reserve(concurrency: int) -> None:
+    """声明同时进行的对冲调用数（如守护进程的并发上限）
+
+    每次对冲调用至多占用两个线程，线程池至少扩到 concurrency 的两倍；默认容量可用 IMAGE_HEDGE_WORKERS 配置。
+    """
+    _hedge_executor(2 * max(1, concurrency))
+
+
+def _close_result(result: Any) -> None:
+    """释放未被采用的尝试结果（如 stream=True 的响应占用的连接）"""
+    close = getattr(result, "close", None)
+    if close is not None:
+        try:
+            close()
+        except Exception as e:
+            logger.debug(f"释放对冲结果失败: {e}")
+
+
+def hedged_call(
+    fn: Callable[[threading.Event], T],
+    hedge_after: float,
+    parent: Optional[budget.CancelToken] = None,
+    discard: Optional[Callable[[T], None]] = None,
+) -> T:
+    """执行 fn；第一次尝试开始执行后超过 hedge_after 秒仍未返回时并发发起第二次尝试，返回先成功的结果。
+
+    fn 接收一个 threading.Event，被取消时该事件置位：fn 应在阻塞调用返回后检查它，
+    及时关闭响应并抛出 AttemptCancelled。parent 被取消时全部尝试一并取消。
+    落败的尝试如果也已成功，其结果交给 discard 释放（默认调用结果的 close()）。
+    """
+    discard = discard or _close_result
+    unlinks: List[Callable[[], None]] = []
+
+    def start() -> Tuple[Future, threading.Event, threading.Event]:
+        cancel = budget.CancelToken()
+        if parent is not None:
+            unlinks.append(parent.on_cancel(cancel.set))
+        running = threading.Event()
+        context = contextvars.copy_context()
+
+        def run() -> T:
+            running.set()
+            # 每次尝试在调用方上下文的副本中执行，分阶段埋点仍记入当前调用
+            return context.run(fn, cancel)
+
+        return _hedge_executor().submit(run), cancel, running
+
+    first, first_cancel, first_running = start()
+    futures: Dict[Future, threading.Event] = {first: first_cancel}
+    # 在线程池中排队的时间不计入对冲阈值，否则线程池繁忙时会发起多余的对冲
+    while not first_running.wait(0.05) and not first.done():
+        if parent is not None and parent.is_set():
+            break
+    done, _ = wait(futures, timeout=hedge_after)
+    if not done and (parent is None or not parent.is_set()):
+        logger.info(f"尝试超过 {hedge_after:.1f}s 未返回，发起对冲请求")
+        future, cancel, _ = start()
+        futures[future] = cancel
+
+    winner: Optional[Future] = None
+    try:
+        pending = set(futures)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                exc = future.exception()
+                if exc is None:
+                    winner = future
+                    return future.result()
+                error = exc
+        raise error
+    finally:
+        for future, cancel in futures.items():
+            if future is winner:
+                continue
+            # 取消仍在进行的尝试；它在取消前已经成功时释放其结果
+            cancel.set()
+            future.add_done_callback(
+                lambda f: discard(f.result()) if not f.cancelled() and f.exception() is None else None
+            )
+        for unlink in unlinks:
+            unlink()
+
+
+def execute(
+    fn: Callable[[threading.Event], T],
+    policy: Optional[RetryPolicy] = None,
+    *,
+    key: str = "default",
+    discard: Optional[Callable[[T], None]] = None,
+) -> T:
+    """按策略执行 fn（带重试，可选对冲），key 用于区分各端点的延迟统计；discard 用于释放对冲中未被采用的结果"""
+    policy = policy or DEFAULT_POLICY
+    latency = tracker(key)
+    attempt = 0
+    while True:
+        attempt += 1
+        started = time.monotonic()
+        try:
+            threshold = _hedge_threshold(policy, latency)
+            budget.check()
+            # 在预算内执行时，取消或超时立即返回调用方，进行中的尝试随即被标记取消
+            if threshold is not None:
+                result = budget.interruptible(lambda cancel: hedged_call(fn, threshold, cancel, discard))
+            else:
+                result = budget.interruptible(fn)
+            latency.record(time.monotonic() - started)
+            return result
+        except Exception as e:
+            retryable, retry_after = classify_error(e, policy)
+            if not retryable or attempt >= policy.max_attempts:
+                raise
+            if retry_after is not None and retry_after > policy.max_retry_after:
+                raise
+            delay = backoff_delay(policy, attempt, retry_after)
+            metrics.add_retry()
+            logger.warning(f"{key} 第 {attempt}/{policy.max_attempts} 次尝试失败，{delay:.1f}s 后重试: {e}")
+            budget.sleep(delay)
+
+
+async def ahedged_call(
+    fn: Callable[[], Awaitable[T]],
+    hedge_after: float,
+    discard: Optional[Callable[[T], Awaitable[None]]] = None,
+) -> T:
+    """hedged_call 的异步版本：落败的尝试直接取消；已经成功但未被采用的结果交给 discard 释放（如关闭响应）"""
+    # ensure_future 复制当前上下文，分阶段埋点仍记入当前调用
+    tasks = [asyncio.ensure_future(fn())]
+    done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+    if not done:
+        logger.info(f"尝试超过 {hedge_after:.1f}s 未返回，发起对冲请求")
+        tasks.append(asyncio.ensure_future(fn()))
+
+    winner: Optional["asyncio.Future"] = None
+    error: Optional[BaseException] = None
+    pending = set(tasks)
+    try:
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if winner is None:
+                        winner = task
+                else:
+                    error = task.exception()
+        if winner is None:
+            raise error
+        return winner.result()
+    finally:
+        for task in tasks:
+            if task is winner:
+                continue
+            if not task.done():
+                task.cancel()
+            elif discard is not None and not task.cancelled() and task.exception() is None:
+                await discard(task.result())
+
+
+async def aexecute(
+    fn: Callable[[], Awaitable[T]],
+    policy: Optional[RetryPolicy] = None,
+    *,
+    key: str = "default",
+    discard: Optional[Callable[[T], Awaitable[None]]] = None,
+) -> T:
+    """execute 的异步版本：fn() 每次返回一个新的协程（一次尝试）；discard 用于释放对冲中未被采用的结果"""
+    policy = policy or DEFAULT_POLICY
+    latency = tracker(key)
+    attempt = 0
+    while True:
+        attempt += 1
+        started = time.monotonic()
+        try:
+            threshold = _hedge_threshold(policy, latency)
+            budget.check()
+            # 预算的取消与超时由外层 budget.bound 取消整个任务，这里不需要再包装
+            if threshold is not None:
+                result = await ahedged_call(fn, threshold, discard)
+            else:
+                result = await fn()
+            latency.record(time.monotonic() - started)
+            return result
+        except Exception as e:
+            retryable, retry_after = classify_error(e, policy)
+            if not retryable or attempt >= policy.max_attempts:
+                raise
+            if retry_after is not None and retry_after > policy.max_retry_after:
+                raise
+            delay = backoff_delay(policy, attempt, retry_after)
+            metrics.add_retry()
+            logger.warning(f"{key} 第 {attempt}/{policy.max_attempts} 次尝试失败，{delay:.1f}s 后重试: {e}")
+            await budget.asleep(delay)
@@ -0,0 +1,295 @@
+"""
+生成结果缓存：按请求内容寻址，结果字节存本地磁盘
+
+- 键：request_key() 对 provider、model、prompt、size、数量、quality、watermark 以及
+  参考图/遮罩的内容摘要做稳定哈希，参数顺序与输入形式（路径/字节/PIL）不影响结果。
+- 淘汰：超过 max_bytes 或 max_entries 时按最近最少使用（LRU）淘汰；ttl 过期的条目视为未命中。
+- 统计：stats() 返回 hits / misses / evictions / entries / bytes。
+- 多进程共享同一目录时，其他进程写入的条目在首次查询时加入本进程索引。
+
+默认目录可通过环境变量 IMAGE_RESULT_CACHE_DIR 配置。缓存为可选功能，
+在 generate_image_with_seedream4(cache=...) 与 gpt_image_1.generate_image(cache=...) 中传入即可启用。
+"""
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import encoding_cache
+
+logger = logging.getLogger('result_cache')
+
+DEFAULT_CACHE_DIR = os.path.join(".cache", "image_results")
+_META_FILE = "meta.json"
+
+
+def input_digest(image_input: Any) -> str:
+    """计算参考图/遮罩输入的内容摘要（sha256）。
+
+    支持文件路径、http(s) URL（对 URL 文本本身取摘要）、data URL、字节、文件对象与 PIL Image。
+    """
+    h = hashlib.sha256()
+    if isinstance(image_input, str):
+        if not image_input.startswith(("http://", "https://", "data:")):
+            # 文件路径：复用编码缓存中按 (路径, mtime, size) 记忆的摘要
+            return encoding_cache.file_digest(image_input)
+        h.update(image_input.encode("utf-8"))
+    elif isinstance(image_input, (bytes, bytearray, memoryview)):
+        h.update(image_input)
+    elif hasattr(image_input, "read"):
+        pos = image_input.tell() if hasattr(image_input, "tell") else None
+        for chunk in iter(lambda: image_input.read(1024 * 1024), b""):
+            h.update(chunk)
+        if pos is not None and hasattr(image_input, "seek"):
+            image_input.seek(pos)
+    elif hasattr(image_input, "tobytes") and hasattr(image_input, "mode"):
+        # PIL Image：对像素数据与模式/尺寸取摘要，无需重新编码
+        h.update(f"{image_input.mode}:{image_input.size}".encode("utf-8"))
+        h.update(image_input.tobytes())
+    else:
+        raise ValueError(f"不支持的图片输入类型: {type(image_input)}")
+    return h.hexdigest()
+
+
+def _digests(references: List[Any]) -> List[str]:
+    """多张参考图的摘要并发计算（文件读取与 sha256 期间释放 GIL）"""
+    if len(references) <= 1:
+        return [input_digest(ref) for ref in references]
+    from preprocess import map_inputs
+
+    digests = map_inputs(input_digest, references)
+    for digest in digests:
+        if isinstance(digest, Exception):
+            raise digest
+    return digests
+
+
+def request_key(
+    provider: str,
+    *,
+    model: str,
+    prompt: str,
+    size: str,
+    count: int,
+    quality: Optional[str] = None,
+    watermark: Optional[bool] = None,
+    references: Sequence[Any] = (),
+    mask: Any = None,
+) -> str:
+    """生成请求的规范化哈希键。"""
+    canonical = {
+        "provider": provider,
+        "model": model,
+        "prompt": prompt,
+        "size": size,
+        "count": int(count),
+        "quality": quality,
+        "watermark": watermark,
+        "references": _digests(list(references or ())),
+        "mask": input_digest(mask) if mask is not None else None,
+    }
+    text = json.dumps(canonical, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def try_request_key(provider: str, **kwargs: Any) -> Optional[str]:
+    """同 request_key，但参考图/遮罩无法读取（路径不存在、类型不支持等）时返回 None。
+
+    调用方据此跳过缓存与请求合并，照常发起请求，由参考图处理逻辑决定跳过还是报错。
+    """
+    try:
+        return request_key(provider, **kwargs)
+    except Exception as e:
+        logger.warning(f"无法计算请求摘要，跳过缓存与请求合并: {e}")
+        return None
+
+
+@dataclass
+class CacheEntry:
+    """命中的缓存条目：files 为缓存目录中的结果文件路径（按生成顺序）"""
+    key: str
+    files: List[str]
+    meta: Dict[str, Any] = field(default_factory=dict)
+
+    def read_all(self) -> List[bytes]:
+        images = []
+        for path in self.files:
+            with open(path, "rb") as f:
+                images.append(f.read())
+        return images
+
+
+class ResultCache:
+    """内容寻址的生成结果磁盘缓存（线程安全）"""
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        *,
+        max_bytes: int = 2 * 1024 ** 3,
+        max_entries: int = 1000,
+        ttl: Optional[float] = None,
+    ):
+        self.directory = directory or os.getenv("IMAGE_RESULT_CACHE_DIR", DEFAULT_CACHE_DIR)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (字节数, 创建时间)，顺序即 LRU 顺序（末尾为最近使用）
+        self._index: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_index()
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _load_index(self) -> None:
+        """启动时扫描磁盘重建索引，按元数据文件的访问时间恢复 LRU 顺序"""
+        found = []
+        for shard in os.listdir(self.directory):
+            shard_dir = os.path.join(self.directory, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for key in os.listdir(shard_dir):
+                if ".tmp-" in key:
+                    continue
+                meta_path = os.path.join(shard_dir, key, _META_FILE)
+                try:
+                    with open(meta_path, "r", encoding="utf-8") as f:
+                        meta = json.load(f)
+                    last_used = os.path.getmtime(meta_path)
+                except (OSError, ValueError):
+                    continue
+                found.append((last_used, key, int(meta.get("bytes", 0)), float(meta.get("created", last_used))))
+        for _, key, size, created in sorted(found):
+            self._index[key] = (size, created)
+            self._bytes += size
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _remove(self, key: str) -> None:
+        size, _ = self._index.pop(key)
+        self._bytes -= size
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def _adopt(self, key: str) -> Optional[tuple]:
+        """索引中没有但磁盘上存在的条目（其他进程写入）加入索引"""
+        meta_path = os.path.join(self._entry_dir(key), _META_FILE)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        record = (int(meta.get("bytes", 0)), float(meta.get("created", time.time())))
+        self._index[key] = record
+        self._bytes += record[0]
+        return record
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        """查询缓存；命中时刷新 LRU 位置并返回条目，未命中或已过期返回 None"""
+        with self._lock:
+            record = self._index.get(key)
+            if record is None:
+                record = self._adopt(key)
+            if record is None or self._expired(record[1]):
+                if record is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            entry_dir = self._entry_dir(key)
+            meta_path = os.path.join(entry_dir, _META_FILE)
+            try:
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                os.utime(meta_path)
+            except (OSError, ValueError):
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            self.hits += 1
+        files = [os.path.join(entry_dir, name) for name in meta.get("files", [])]
+        return CacheEntry(key=key, files=files, meta=meta.get("extra", {}))
+
+    def put(self, key: str, images: Iterable[bytes], meta: Optional[Dict[str, Any]] = None) -> None:
+        """写入结果字节"""
+        self._store(key, [io.BytesIO(data) for data in images], meta)
+
+    def put_files(self, key: str, paths: Sequence[str], meta: Optional[Dict[str, Any]] = None) -> None:
+        """从本地文件写入结果（流式复制，不整体读入内存）"""
+        handles = [open(path, "rb") for path in paths]
+        try:
+            self._store(key, handles, meta)
+        finally:
+            for handle in handles:
+                handle.close()
+
+    def _store(self, key: str, sources: Sequence[Any], meta: Optional[Dict[str, Any]]) -> None:
+        entry_dir = self._entry_dir(key)
+        # 先写入临时目录再整体重命名，读者不会看到写了一半的条目
+        tmp_dir = f"{entry_dir}.tmp-{uuid.uuid4().hex}"
+        os.makedirs(tmp_dir)
+        try:
+            names = []
+            total = 0
+            for idx, source in enumerate(sources):
+                name = f"{idx}.bin"
+                with open(os.path.join(tmp_dir, name), "wb") as f:
+                    shutil.copyfileobj(source, f, 1024 * 1024)
+                    total += f.tell()
+                names.append(name)
+            created = time.time()
+            with open(os.path.join(tmp_dir, _META_FILE), "w", encoding="utf-8") as f:
+                json.dump({"files": names, "bytes": total, "created": created, "extra": meta or {}},
+                          f, ensure_ascii=False)
+
+            with self._lock:
+                if key in self._index:
+                    self._remove(key)
+                try:
+                    os.replace(tmp_dir, entry_dir)
+                except OSError:
+                    # 其他进程已写入同一键，保留其结果
+                    return
+                self._index[key] = (total, created)
+                self._bytes += total
+                self._evict()
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _evict(self) -> None:
+        while self._index and (len(self._index) > self.max_entries or self._bytes > self.max_bytes):
+            key = next(iter(self._index))
+            self._remove(key)
+            self.evictions += 1
+            logger.info(f"缓存淘汰: {key}")
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in list(self._index):
+                self._remove(key)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._index),
+                "bytes": self._bytes,
+            }
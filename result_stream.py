@@ -0,0 +1,170 @@
+"""
+惰性结果解码：从 JSON 响应字节流中逐个提取 b64_json 并增量解码
+
+images 接口的响应形如 {"data": [{"b64_json": "..."}, ...]}，n 较大时整份 JSON 文本与
+解码后的字节会同时驻留内存。这里直接在响应字节流上扫描 "b64_json" 字段：
+- ImageStream 迭代时每次只解码并产出一张图片；
+- ImageStream.save() 将 base64 边读边解码写入输出文件（经 output_writer 原子落盘），内存只占一个网络块。
+"""
+from __future__ import annotations
+
+import base64
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from output_writer import AtomicFile, OutputWriter
+
+_KEY = b'"b64_json"'
+_WS = b" \t\r\n"
+
+# 扫描事件
+_START, _DATA, _END = 0, 1, 2
+
+
+def _scan_b64_fields(chunks: Iterable[bytes]) -> Iterator[Tuple[int, bytes]]:
+    """在 JSON 字节流中定位 "b64_json": "..." 字段，产出 (_START|_DATA|_END, 数据)"""
+    state = "key"
+    tail = b""
+    escaped = False
+    for chunk in chunks:
+        if not chunk:
+            continue
+        data = tail + chunk if state == "key" else chunk
+        tail = b""
+        pos = 0
+        while pos < len(data):
+            if state == "key":
+                idx = data.find(_KEY, pos)
+                if idx < 0:
+                    # 保留末尾可能被截断的键名前缀
+                    tail = data[max(pos, len(data) - len(_KEY) + 1):]
+                    break
+                pos = idx + len(_KEY)
+                state = "colon"
+            elif state in ("colon", "quote"):
+                byte = data[pos:pos + 1]
+                pos += 1
+                if byte in _WS:
+                    continue
+                if state == "colon" and byte == b":":
+                    state = "quote"
+                elif state == "quote" and byte == b'"':
+                    state = "value"
+                    yield _START, b""
+                else:
+                    # 不是字符串值（例如 null），继续寻找下一个键
+                    state = "key"
+            else:
+                if escaped:
+                    # base64 中唯一可能出现的转义是 \/
+                    yield _DATA, data[pos:pos + 1]
+                    pos += 1
+                    escaped = False
+                    continue
+                quote = data.find(b'"', pos)
+                backslash = data.find(b"\\", pos, quote if quote >= 0 else len(data))
+                if backslash >= 0:
+                    if backslash > pos:
+                        yield _DATA, data[pos:backslash]
+                    pos = backslash + 1
+                    escaped = True
+                elif quote >= 0:
+                    if quote > pos:
+                        yield _DATA, data[pos:quote]
+                    yield _END, b""
+                    pos = quote + 1
+                    state = "key"
+                else:
+                    yield _DATA, data[pos:]
+                    pos = len(data)
+
+
+class _B64Decoder:
+    """增量 base64 解码：按 4 字符对齐解码，余下部分留到下一块"""
+
+    def __init__(self):
+        self._carry = b""
+
+    def feed(self, text: bytes) -> bytes:
+        text = self._carry + text
+        aligned = len(text) - len(text) % 4
+        self._carry = text[aligned:]
+        return base64.b64decode(text[:aligned]) if aligned else b""
+
+    def finish(self) -> bytes:
+        carry, self._carry = self._carry, b""
+        if not carry:
+            return b""
+        return base64.b64decode(carry + b"=" * (-len(carry) % 4))
+
+
+class ImageStream:
+    """惰性的生成结果：只能迭代（或保存）一次，用完后自动关闭底层响应
+
+    用法:
+        for png in text_to_image(prompt, n=10, lazy=True): ...
+        save_images(text_to_image(prompt, n=10, lazy=True))   # 直接流式解码到文件
+    """
+
+    def __init__(self, chunks: Iterable[bytes], close: Optional[Callable[[], None]] = None):
+        self._chunks = chunks
+        self._close = close
+        self._consumed = False
+
+    def _take(self) -> Iterable[bytes]:
+        if self._consumed:
+            raise RuntimeError("ImageStream 只能消费一次")
+        self._consumed = True
+        return self._chunks
+
+    def __iter__(self) -> Iterator[bytes]:
+        try:
+            buffer = bytearray()
+            decoder = _B64Decoder()
+            for kind, data in _scan_b64_fields(self._take()):
+                if kind == _DATA:
+                    buffer += decoder.feed(data)
+                elif kind == _END:
+                    buffer += decoder.finish()
+                    yield bytes(buffer)
+                    buffer = bytearray()
+        finally:
+            self.close()
+
+    def save(
+        self,
+        output_dir: str = "outputs",
+        prefix: str = "gpt_image_1",
+        writer: Optional[OutputWriter] = None,
+    ) -> List[str]:
+        """边解码边写入临时文件，完成后按内容哈希原子重命名，返回保存路径列表"""
+        writer = writer or OutputWriter(output_dir)
+        saved: List[str] = []
+        pending: Optional[AtomicFile] = None
+        decoder = _B64Decoder()
+        try:
+            for kind, data in _scan_b64_fields(self._take()):
+                if kind == _START:
+                    pending = writer.open()
+                elif kind == _DATA:
+                    pending.write(decoder.feed(data))
+                else:
+                    pending.write(decoder.finish())
+                    saved.append(writer.commit(pending, prefix))
+                    pending = None
+        finally:
+            if pending is not None:
+                pending.discard()
+            self.close()
+        writer.finish(saved)
+        return saved
+
+    def close(self) -> None:
+        if self._close is not None:
+            close, self._close = self._close, None
+            close()
+
+    def __enter__(self) -> "ImageStream":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -0,0 +1,338 @@
+"""
+多 provider 路由：统一的 generate() 接口，按实时延迟/错误率、尺寸支持与成本选择 provider，失败自动切换
+
+- 结果统一为 GenerationResult：本地文件路径列表 + provider / 延迟 / 预估成本；
+- 每个 provider 维护延迟与错误率的 EWMA（指数加权移动平均），进程内共享；
+- 尺寸：SeeDream 4.0 支持 "1K"/"2K"/"4K" 与像素范围内的 "WxH"；gpt-image-1 仅支持固定尺寸；
+- 成本：每张图的单价表，可用环境变量 IMAGE_COST_SEEDREAM4 / IMAGE_COST_GPT_IMAGE_1 覆盖（美元）；
+- 429 / 配额不足时该 provider 冷却一段时间（优先遵循 Retry-After），期间流量转到其他 provider；
+  错误率偏高的 provider 降低优先级但仍作为兜底。
+
+用法:
+    result = router.generate("一只小猫", size="1024x1024", n=2, strategy="cost")
+    print(result.provider, result.paths)
+"""
+from __future__ import annotations
+
+import logging
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import resilience
+
+logger = logging.getLogger('router')
+
+STRATEGIES = ("balanced", "latency", "cost")
+
+# 每张图的默认单价（美元），仅用于排序，不代表实际账单
+DEFAULT_COSTS = {
+    "seedream4": 0.03,
+    "gpt_image_1": 0.17,
+}
+
+# 路由层自己负责切换 provider，单个 provider 内不再长时间重试
+FAILOVER_POLICY = resilience.RetryPolicy(max_attempts=2, max_delay=5.0, max_retry_after=10.0)
+
+_GPT_IMAGE_1_SIZES = frozenset({"1024x1024", "1536x1024", "1024x1536", "auto"})
+_SEEDREAM4_PRESETS = frozenset({"1K", "2K", "4K"})
+_SEEDREAM4_MIN_PIXELS = 1280 * 720
+_SEEDREAM4_MAX_PIXELS = 4096 * 4096
+
+
+class RoutingError(RuntimeError):
+    """没有可用的 provider，或所有候选 provider 均失败"""
+
+    def __init__(self, message: str, errors: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.errors = errors or {}
+
+
+@dataclass
+class GenerationRequest:
+    prompt: str
+    size: str = "1024x1024"
+    n: int = 1
+    quality: str = "high"
+    images: Sequence[Any] = ()
+    mask: Optional[str] = None
+    output_dir: str = "outputs"
+
+
+@dataclass
+class GenerationResult:
+    """与 provider 无关的生成结果"""
+    provider: str
+    paths: List[str]
+    latency: float
+    cost: float
+    urls: List[Optional[str]] = field(default_factory=list)
+    cached: bool = False
+    attempts: List[Tuple[str, str]] = field(default_factory=list)
+
+    def read_all(self) -> List[bytes]:
+        images = []
+        for path in self.paths:
+            with open(path, "rb") as f:
+                images.append(f.read())
+        return images
+
+
+class ProviderStats:
+    """延迟与错误率的 EWMA，以及 429 冷却时间"""
+
+    def __init__(self, alpha: float = 0.2, initial_latency: float = 20.0):
+        self.alpha = alpha
+        self.latency = initial_latency
+        self.error_rate = 0.0
+        self.samples = 0
+        self.cooldown_until = 0.0
+        self._lock = threading.Lock()
+
+    def record_success(self, latency: float) -> None:
+        with self._lock:
+            if self.samples == 0:
+                self.latency = latency
+            else:
+                self.latency += self.alpha * (latency - self.latency)
+            self.error_rate *= 1 - self.alpha
+            self.samples += 1
+
+    def record_failure(self, cooldown: Optional[float] = None) -> None:
+        with self._lock:
+            self.error_rate += self.alpha * (1.0 - self.error_rate)
+            self.samples += 1
+            if cooldown:
+                self.cooldown_until = max(self.cooldown_until, time.monotonic() + cooldown)
+
+    def cooling_down(self) -> bool:
+        return time.monotonic() < self.cooldown_until
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "latency": round(self.latency, 3),
+                "error_rate": round(self.error_rate, 3),
+                "samples": self.samples,
+                "cooldown": round(max(0.0, self.cooldown_until - time.monotonic()), 1),
+            }
+
+
+def _parse_size(size: str) -> Optional[Tuple[int, int]]:
+    match = re.fullmatch(r"(\d+)[xX*](\d+)", size or "")
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+class _ProviderFailed(Exception):
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class SeeDream4Provider:
+    name = "seedream4"
+
+    def supports(self, request: GenerationRequest) -> bool:
+        if request.mask:
+            return False
+        if request.size in _SEEDREAM4_PRESETS:
+            return True
+        dims = _parse_size(request.size)
+        return dims is not None and _SEEDREAM4_MIN_PIXELS <= dims[0] * dims[1] <= _SEEDREAM4_MAX_PIXELS
+
+    def run(self, request: GenerationRequest, retry_policy: resilience.RetryPolicy) -> GenerationResult:
+        from seedream import generate_image_with_seedream4
+
+        started = time.perf_counter()
+        result = generate_image_with_seedream4(
+            prompt=request.prompt,
+            images=list(request.images) or None,
+            max_images=request.n,
+            size=request.size,
+            retry_policy=retry_policy,
+            output_dir=request.output_dir,
+        )
+        if not result["success"]:
+            raise _ProviderFailed(result.get("error", "SeeDream 4.0 生成失败"), result.get("status_code"))
+        images = result["images"]
+        if not images or not all(img["local_path"] for img in images):
+            raise _ProviderFailed("SeeDream 4.0 结果下载失败")
+        return GenerationResult(
+            provider=self.name,
+            paths=[img["local_path"] for img in images],
+            urls=[img.get("url") for img in images],
+            latency=time.perf_counter() - started,
+            cost=0.0,
+            cached=bool(result.get("cached")),
+        )
+
+
+class GptImage1Provider:
+    name = "gpt_image_1"
+
+    def supports(self, request: GenerationRequest) -> bool:
+        if request.size not in _GPT_IMAGE_1_SIZES:
+            return False
+        # 图生图接口接受至多 16 张本地参考图（以 image[] 重复字段上传）
+        if len(request.images) > 16:
+            return False
+        return all(isinstance(image, str) and os.path.isfile(image) for image in request.images)
+
+    def run(self, request: GenerationRequest, retry_policy: resilience.RetryPolicy) -> GenerationResult:
+        import gpt_image_1
+
+        started = time.perf_counter()
+        try:
+            images = gpt_image_1.generate_image(
+                request.prompt,
+                list(request.images) or None,
+                size=request.size,
+                n=request.n,
+                quality=request.quality,
+                mask_path=request.mask,
+                retry_policy=retry_policy,
+            )
+        except Exception as e:
+            _, retry_after = resilience.classify_error(e, retry_policy)
+            status = getattr(e, "status_code", None) or getattr(getattr(e, "response", None), "status_code", None)
+            raise _ProviderFailed(str(e), status, retry_after) from e
+        if not images:
+            raise _ProviderFailed("gpt-image-1 未返回图像")
+        paths = gpt_image_1.save_images(images, request.output_dir)
+        return GenerationResult(
+            provider=self.name,
+            paths=paths,
+            urls=[None] * len(paths),
+            latency=time.perf_counter() - started,
+            cost=0.0,
+        )
+
+
+def _cost_table() -> Dict[str, float]:
+    costs = dict(DEFAULT_COSTS)
+    for name in costs:
+        value = os.getenv(f"IMAGE_COST_{name.upper()}")
+        if value:
+            try:
+                costs[name] = float(value)
+            except ValueError:
+                logger.warning(f"IMAGE_COST_{name.upper()} 不是数字，忽略")
+    return costs
+
+
+class Router:
+    """按策略为请求选择 provider，失败时依次切换"""
+
+    def __init__(
+        self,
+        providers: Optional[Sequence[Any]] = None,
+        *,
+        costs: Optional[Dict[str, float]] = None,
+        retry_policy: resilience.RetryPolicy = FAILOVER_POLICY,
+        quota_cooldown: float = 30.0,
+        degraded_error_rate: float = 0.5,
+    ):
+        self.providers = list(providers or (SeeDream4Provider(), GptImage1Provider()))
+        self.costs = costs or _cost_table()
+        self.retry_policy = retry_policy
+        self.quota_cooldown = quota_cooldown
+        self.degraded_error_rate = degraded_error_rate
+        self.stats: Dict[str, ProviderStats] = {p.name: ProviderStats() for p in self.providers}
+
+    def _score(self, provider: Any, request: GenerationRequest, strategy: str) -> float:
+        stats = self.stats[provider.name]
+        cost = self.costs.get(provider.name, 0.0) * request.n
+        # 期望延迟：失败后还要切换到下一个 provider，按错误率放大
+        latency = stats.latency / max(0.05, 1.0 - stats.error_rate)
+        if strategy == "latency":
+            return latency
+        if strategy == "cost":
+            return cost + 1e-3 * latency
+        # balanced：把成本折算为秒（1 美元约等于 100 秒等待）
+        return latency + 100.0 * cost
+
+    def rank(self, request: GenerationRequest, strategy: str = "balanced",
+             only: Optional[Sequence[str]] = None) -> List[Any]:
+        """返回可用 provider 的尝试顺序：健康的按得分排序，冷却中或错误率偏高的排在最后"""
+        if strategy not in STRATEGIES:
+            raise ValueError(f"strategy 仅支持 {STRATEGIES}")
+        candidates = [
+            p for p in self.providers
+            if (only is None or p.name in only) and p.supports(request)
+        ]
+
+        def key(provider):
+            stats = self.stats[provider.name]
+            degraded = stats.cooling_down() or stats.error_rate >= self.degraded_error_rate
+            return degraded, self._score(provider, request, strategy)
+
+        return sorted(candidates, key=key)
+
+    def generate(
+        self,
+        prompt: str,
+        *,
+        size: str = "1024x1024",
+        n: int = 1,
+        quality: str = "high",
+        images: Sequence[Any] = (),
+        mask: Optional[str] = None,
+        output_dir: str = "outputs",
+        strategy: str = "balanced",
+        providers: Optional[Sequence[str]] = None,
+    ) -> GenerationResult:
+        """生成图像并返回统一结果；所有候选均失败时抛出 RoutingError"""
+        if not prompt or not prompt.strip():
+            raise ValueError("prompt 不能为空")
+        request = GenerationRequest(prompt, size, int(n), quality, tuple(images or ()), mask, output_dir)
+        ranked = self.rank(request, strategy, providers)
+        if not ranked:
+            raise RoutingError(f"没有支持该请求的 provider（size={size}, 参考图 {len(request.images)} 张）")
+
+        errors: Dict[str, str] = {}
+        attempts: List[Tuple[str, str]] = []
+        for provider in ranked:
+            stats = self.stats[provider.name]
+            try:
+                result = provider.run(request, self.retry_policy)
+            except Exception as e:
+                status = getattr(e, "status_code", None)
+                cooldown = None
+                if status == 429:
+                    cooldown = getattr(e, "retry_after", None) or self.quota_cooldown
+                stats.record_failure(cooldown)
+                errors[provider.name] = str(e)
+                attempts.append((provider.name, "error"))
+                logger.warning(f"provider {provider.name} 失败，尝试下一个: {e}")
+                continue
+            if not result.cached:
+                stats.record_success(result.latency)
+            result.cost = 0.0 if result.cached else self.costs.get(provider.name, 0.0) * len(result.paths)
+            attempts.append((provider.name, "ok"))
+            result.attempts = attempts
+            return result
+        raise RoutingError("所有 provider 均失败: " + "; ".join(f"{k}: {v}" for k, v in errors.items()), errors)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        return {name: stats.snapshot() for name, stats in self.stats.items()}
+
+
+_default_router: Optional[Router] = None
+_default_lock = threading.Lock()
+
+
+def default_router() -> Router:
+    global _default_router
+    with _default_lock:
+        if _default_router is None:
+            _default_router = Router()
+        return _default_router
+
+
+def generate(prompt: str, **kwargs) -> GenerationResult:
+    """使用进程内共享的默认 Router 生成图像，参数同 Router.generate"""
+    return default_router().generate(prompt, **kwargs)
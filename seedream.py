@@ -1,29 +1,123 @@
+from __future__ import annotations
+
 import os
 import json
-import requests
-import base64
-import uuid
 import time
+import queue
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 import logging
-from PIL import Image
-import io
-from dotenv import load_dotenv, find_dotenv
+
+import budget
+import downloader
+import encoding_cache
+import fanout
+import http_pool
+import metrics
+import rate_limiter
+from output_writer import unique_filename
+import postprocess
+import preprocess as preprocess_module
+import resilience
+import singleflight
+from lazy import lazy_import, load_env
+from result_cache import CacheEntry, ResultCache, try_request_key
+
+# 重量级依赖延迟导入，import seedream 只需几毫秒；首次发起请求时才真正加载
+asyncio = lazy_import("asyncio")
+httpx = lazy_import("httpx")
+requests = lazy_import("requests")
 
 # 配置日志
 logger = logging.getLogger('seedream4.0')
 
-# 加载 .env
-load_dotenv(find_dotenv(), override=False)
+SEEDREAM4_MODEL = "doubao-seedream-4-0-250828"
+SEEDREAM4_DEFAULT_URL = "https://ark.cn-beijing.volces.com/api/v3/images/generations"
+
+
+def _build_request_data(
+    prompt: str,
+    images: Optional[List],
+    sequential_generation: str,
+    max_images: int,
+    response_format: str,
+    size: str,
+    stream: bool,
+    watermark: bool
+) -> Dict[str, Any]:
+    """构建 images/generations 请求体（同步与异步客户端共用）"""
+    data = {
+        "model": SEEDREAM4_MODEL,
+        "prompt": prompt,
+        "sequential_image_generation": sequential_generation,
+        "sequential_image_generation_options": {
+            "max_images": max_images
+        },
+        "response_format": response_format,
+        "size": size,
+        "stream": stream,
+        "watermark": watermark
+    }
+    
+    # 如果提供了参考图像，添加到请求中
+    if images:
+        data["image"] = images
+    return data
+
+
+_SSE_DONE = object()
+
+
+def _parse_sse_line(line_text: str):
+    """解析一行 SSE 文本：返回事件 dict、结束标记 _SSE_DONE，或 None（忽略该行）"""
+    if not line_text.startswith('data: '):
+        return None
+    data_text = line_text[6:]  # 移除 'data: ' 前缀
+    if data_text.strip() == '[DONE]':
+        return _SSE_DONE
+    try:
+        return json.loads(data_text)
+    except json.JSONDecodeError:
+        return None
+
+
+def _budget_failure(e: Exception) -> Dict[str, Any]:
+    """超出整体时限或被取消时的失败结果"""
+    cancelled = isinstance(e, budget.Cancelled)
+    error_msg = f"SeeDream 4.0 {'已取消' if cancelled else '超出整体时限'}: {str(e)}"
+    logger.warning(error_msg)
+    return {"success": False, "error": error_msg, "cancelled": cancelled}
+
+
+def _default_filename() -> str:
+    # 时间戳便于排序，UUID 保证并发任务（含多进程）共享 outputs/ 时不会互相覆盖
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    return unique_filename(f"seedream4_result_{timestamp}")
+
+
+def _discard_file(path: str) -> None:
+    """删除调用方已放弃的结果文件"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
 
 class SeeDream4API:
     """SeeDream 4.0 API 客户端"""
     
-    def __init__(self, api_key: str = None, base_url: str = None):
-        # 从环境变量读取，支持传参覆盖
+    def __init__(
+        self,
+        api_key: str = None,
+        base_url: str = None,
+        retry_policy: Optional[resilience.RetryPolicy] = None
+    ):
+        # 从环境变量读取（首次创建客户端时加载 .env），支持传参覆盖
+        load_env()
         env_key = os.getenv("SEEDREAM4_API_KEY")
-        env_url = os.getenv("SEEDREAM4_BASE_URL", "https://ark.cn-beijing.volces.com/api/v3/images/generations")
+        env_url = os.getenv("SEEDREAM4_BASE_URL", SEEDREAM4_DEFAULT_URL)
         self.api_key = api_key or env_key
         self.base_url = base_url or env_url
         if not self.api_key:
@@ -32,7 +126,34 @@ class SeeDream4API:
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"
         }
+        # 同一主机的请求共享保活连接池，避免每次生成都重新握手
+        self.session = http_pool.get_session(self.base_url)
+        # 429/5xx 与网络错误的重试、退避与可选对冲策略
+        self.retry_policy = retry_policy or resilience.DEFAULT_POLICY
+
+    def _post(self, data: Dict[str, Any], max_images: int, stream: bool = False):
+        """发送生成请求；可重试的错误按 retry_policy 退避重试，最终失败时抛出异常"""
+        def attempt(cancel) -> requests.Response:
+            # 多进程共享的配额：不足时排队等待，而不是撞上 429
+            rate_limiter.throttle("seedream4", "images/generations", data["model"], max_images)
+            with metrics.phase("request"):
+                response = self.session.post(
+                    self.base_url,
+                    headers=self.headers,
+                    json=data,
+                    timeout=http_pool.timeout(60),
+                    stream=stream
+                )
+            metrics.add_bytes(sent=len(response.request.body or b""))
+            if cancel.is_set():
+                # 对冲请求中落败的一方：丢弃结果，释放连接
+                response.close()
+                raise resilience.AttemptCancelled()
+            return resilience.check_response(response, self.retry_policy)
+        
+        return resilience.execute(attempt, self.retry_policy, key="seedream4:generations")
 
+    @budget.bounded
     def generate_image(
         self,
         prompt: str,
@@ -56,38 +177,42 @@ class SeeDream4API:
             size: 图像尺寸 ("1K", "2K", "4K")
             stream: 是否流式响应
             watermark: 是否添加水印
+            deadline / cancel: 整体时限（秒）与 budget.CancelToken，超时或取消时返回 success=False
             
         Returns:
             API响应结果
         """
+        with metrics.call("seedream4", "images/generations", size):
+            result = self._generate_image(
+                prompt, images, sequential_generation, max_images,
+                response_format, size, stream, watermark
+            )
+            if not result["success"]:
+                metrics.set_status("error")
+            return result
+
+    def _generate_image(
+        self,
+        prompt: str,
+        images: Optional[List],
+        sequential_generation: str,
+        max_images: int,
+        response_format: str,
+        size: str,
+        stream: bool,
+        watermark: bool
+    ) -> Dict[str, Any]:
         try:
             # 构建请求数据
-            data = {
-                "model": "doubao-seedream-4-0-250828",
-                "prompt": prompt,
-                "sequential_image_generation": sequential_generation,
-                "sequential_image_generation_options": {
-                    "max_images": max_images
-                },
-                "response_format": response_format,
-                "size": size,
-                "stream": stream,
-                "watermark": watermark
-            }
-            
-            # 如果提供了参考图像，添加到请求中
-            if images:
-                data["image"] = images
+            data = _build_request_data(
+                prompt, images, sequential_generation, max_images,
+                response_format, size, stream, watermark
+            )
             
             logger.info(f"SeeDream 4.0 API 请求: {prompt[:50]}...")
             
-            # 发送请求
-            response = requests.post(
-                self.base_url,
-                headers=self.headers,
-                json=data,
-                timeout=60
-            )
+            # 发送请求（429/5xx 自动重试）
+            response = self._post(data, max_images)
             
             # 检查响应状态
             if response.status_code != 200:
@@ -103,13 +228,27 @@ class SeeDream4API:
             if stream:
                 return self._handle_stream_response(response)
             else:
-                result = response.json()
+                with metrics.phase("response"):
+                    result = response.json()
+                metrics.add_bytes(received=len(response.content))
                 logger.info("SeeDream 4.0 图像生成成功")
                 return {
                     "success": True,
                     "data": result
                 }
                 
+        except resilience.RetryableError as e:
+            error_msg = f"API请求失败（已重试 {self.retry_policy.max_attempts} 次）: {str(e)}"
+            logger.error(error_msg)
+            return {
+                "success": False,
+                "error": error_msg,
+                "status_code": e.status_code
+            }
+            
+        except (budget.DeadlineExceeded, budget.Cancelled) as e:
+            return _budget_failure(e)
+            
         except requests.exceptions.Timeout:
             error_msg = "请求超时"
             logger.error(error_msg)
@@ -129,53 +268,131 @@ class SeeDream4API:
         """处理流式响应"""
         try:
             results = []
-            for line in response.iter_lines():
-                if line:
-                    line_text = line.decode('utf-8')
-                    if line_text.startswith('data: '):
-                        data_text = line_text[6:]  # 移除 'data: ' 前缀
-                        if data_text.strip() == '[DONE]':
+            received = 0
+            with metrics.phase("stream_parse"):
+                # 超时或取消时在下一行处关闭连接
+                for line in budget.guard(response.iter_lines(), response.close):
+                    received += len(line) + 1
+                    if line:
+                        event = _parse_sse_line(line.decode('utf-8'))
+                        if event is _SSE_DONE:
                             break
-                        try:
-                            data = json.loads(data_text)
-                            results.append(data)
-                        except json.JSONDecodeError:
-                            continue
+                        if event is not None:
+                            results.append(event)
+            metrics.add_bytes(received=received)
             
             return {
                 "success": True,
                 "data": results
             }
             
+        except (budget.DeadlineExceeded, budget.Cancelled) as e:
+            return _budget_failure(e)
         except Exception as e:
             error_msg = f"流式响应处理错误: {str(e)}"
             logger.error(error_msg)
             return {"success": False, "error": error_msg}
 
-    def save_image_from_url(self, image_url: str, filename: str = None) -> str:
-        """从URL保存图像到本地"""
+    @budget.bounded
+    def iter_generate_image(
+        self,
+        prompt: str,
+        images: List = None,
+        sequential_generation: str = "auto",
+        max_images: int = 3,
+        response_format: str = "url",
+        size: str = "2K",
+        watermark: bool = False
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        流式生成图像：每解析到一行 data: 事件就立即产出，不等待整批结束
+        
+        参数同 generate_image（固定 stream=True）。产出 SSE 事件 dict，例如
+        {"type": "image_generation.partial_succeeded", "image_index": 0, "url": ...}；
+        请求或解析失败时产出 {"type": "error", "error": ..., "status_code": ...} 后结束；
+        传入 deadline / cancel 时，超时或取消后关闭连接并产出 {"type": "error", "cancelled": ...}。
+        """
+        data = _build_request_data(
+            prompt, images, sequential_generation, max_images,
+            response_format, size, True, watermark
+        )
+        logger.info(f"SeeDream 4.0 API 流式请求: {prompt[:50]}...")
+        # 生成器跨 yield 不能持有上下文变量：已有外层调用时记入外层，否则单独记录并在结束时上报
+        trace = metrics.current()
+        own_trace = trace is None
+        if own_trace:
+            trace = metrics.CallTrace("seedream4", "images/generations", size)
+        started = time.perf_counter()
+        response = None
+        try:
+            with metrics.activate(trace):
+                response = self._post(data, max_images, stream=True)
+            if response.status_code != 200:
+                error_msg = f"API请求失败: {response.status_code} - {response.text}"
+                logger.error(error_msg)
+                trace.status = "error"
+                yield {"type": "error", "error": error_msg, "status_code": response.status_code}
+                return
+            
+            for line in budget.guard(response.iter_lines(), response.close):
+                line_started = time.perf_counter()
+                trace.add_bytes(received=len(line) + 1)
+                if line:
+                    event = _parse_sse_line(line.decode('utf-8'))
+                    trace.add_phase("stream_parse", time.perf_counter() - line_started)
+                    if event is _SSE_DONE:
+                        break
+                    if event is not None:
+                        yield event
+                        
+        except resilience.RetryableError as e:
+            error_msg = f"API请求失败（已重试 {self.retry_policy.max_attempts} 次）: {str(e)}"
+            logger.error(error_msg)
+            trace.status = "error"
+            yield {"type": "error", "error": error_msg, "status_code": e.status_code}
+        except requests.exceptions.RequestException as e:
+            error_msg = f"网络请求错误: {str(e)}"
+            logger.error(error_msg)
+            trace.status = "error"
+            yield {"type": "error", "error": error_msg}
+        except (budget.DeadlineExceeded, budget.Cancelled) as e:
+            failure = _budget_failure(e)
+            trace.status = "error"
+            yield {"type": "error", "error": failure["error"], "cancelled": failure["cancelled"]}
+        except Exception as e:
+            error_msg = f"未知错误: {str(e)}"
+            logger.error(error_msg)
+            trace.status = "error"
+            yield {"type": "error", "error": error_msg}
+        finally:
+            # 提前结束迭代时也要关闭响应，连接才能回到连接池
+            if response is not None:
+                response.close()
+            if own_trace:
+                metrics.finish(trace, time.perf_counter() - started)
+
+    @budget.bounded
+    def save_image_from_url(self, image_url: str, filename: str = None, output_dir: str = "outputs") -> str:
+        """从URL保存图像到 output_dir；超时或取消时删除未完成的文件并抛出 budget.DeadlineExceeded / Cancelled"""
         try:
             if not filename:
-                timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-                filename = f"seedream4_result_{timestamp}.png"
+                filename = _default_filename()
             
             # 确保输出目录存在
-            output_dir = "outputs"
             os.makedirs(output_dir, exist_ok=True)
             
             filepath = os.path.join(output_dir, filename)
             
-            # 下载图像
-            response = requests.get(image_url, timeout=30)
-            response.raise_for_status()
-            
-            # 保存到文件
-            with open(filepath, 'wb') as f:
-                f.write(response.content)
+            # 分块流式下载到临时文件，完成后原子重命名；中断时按 Range 续传
+            with metrics.phase("download"):
+                downloader.download_file(image_url, filepath, timeout=30)
+            metrics.add_bytes(received=os.path.getsize(filepath))
             
             logger.info(f"图像已保存到: {filepath}")
             return filepath
             
+        except (budget.DeadlineExceeded, budget.Cancelled):
+            raise
         except Exception as e:
             error_msg = f"保存图像失败: {str(e)}"
             logger.error(error_msg)
@@ -193,29 +410,9 @@ def convert_image_to_base64(image_input) -> str:
         base64编码的图片字符串
     """
     try:
-        if isinstance(image_input, str):
-            # 如果是文件路径
-            with open(image_input, 'rb') as f:
-                image_data = f.read()
-        elif hasattr(image_input, 'read'):
-            # 如果是文件对象
-            image_data = image_input.read()
-            if hasattr(image_input, 'seek'):
-                image_input.seek(0)  # 重置文件指针
-        elif isinstance(image_input, bytes):
-            # 如果是字节数据
-            image_data = image_input
-        elif isinstance(image_input, Image.Image):
-            # 如果是PIL Image对象
-            buffer = io.BytesIO()
-            image_input.save(buffer, format='PNG')
-            image_data = buffer.getvalue()
-        else:
-            raise ValueError(f"不支持的图片输入类型: {type(image_input)}")
-        
-        # 转换为base64
-        base64_string = base64.b64encode(image_data).decode('utf-8')
-        return f"data:image/png;base64,{base64_string}"
+        # 按内容摘要记忆编码结果，同一参考图重复使用时跳过读取、PNG 编码与 base64；
+        # MIME 由文件头嗅探（JPEG 不再被标为 image/png）
+        return encoding_cache.encode_image(image_input)
         
     except Exception as e:
         error_msg = f"图片转换base64失败: {str(e)}"
@@ -223,11 +420,106 @@ def convert_image_to_base64(image_input) -> str:
         raise Exception(error_msg)
 
 
+def _prepare_images(
+    images: Optional[List],
+    size: Optional[str] = None,
+    preprocess: bool = False,
+    report: Optional[Dict[str, int]] = None
+) -> Optional[List[str]]:
+    """
+    将参考图像统一为 URL 或 base64 data URL，转换失败的图像会被跳过
+    
+    preprocess=True 时先按 size 缩放、压缩并去除元数据（见 preprocess 模块），
+    节省的上传字节数累加到 report["bytes_saved"]。
+    """
+    if not images:
+        return None
+
+    def prepare(img) -> Tuple[str, int]:
+        if isinstance(img, str) and (img.startswith('http://') or img.startswith('https://')):
+            # 如果是URL，直接使用
+            return img, 0
+        # 如果是文件或其他格式，转换为base64
+        if preprocess:
+            prepared = preprocess_module.prepare_image(img, size)
+            return prepared.data_url(), prepared.bytes_saved
+        return convert_image_to_base64(img), 0
+
+    # 多张参考图并发读取、校验与编码，总耗时接近单张
+    processed_images = []
+    bytes_saved = 0
+    for outcome in preprocess_module.map_inputs(prepare, list(images)):
+        if isinstance(outcome, Exception):
+            logger.warning(f"图片转换失败，跳过: {outcome}")
+            continue
+        processed_images.append(outcome[0])
+        bytes_saved += outcome[1]
+    if preprocess:
+        logger.info(f"参考图预处理共节省 {bytes_saved} 字节")
+        if report is not None:
+            report["bytes_saved"] = report.get("bytes_saved", 0) + bytes_saved
+    return processed_images
+
+
+def _result_urls(data: Dict[str, Any]) -> List[str]:
+    """从非流式响应中提取结果图像 URL"""
+    urls = []
+    if "data" in data and isinstance(data["data"], list):
+        for item in data["data"]:
+            if "url" in item:
+                urls.append(item["url"])
+    return urls
+
+
+def _result_from_cache(entry: CacheEntry, output_dir: str = "outputs") -> Dict[str, Any]:
+    """将缓存条目复制到输出目录，返回与实时生成一致的结果结构"""
+    os.makedirs(output_dir, exist_ok=True)
+    urls = entry.meta.get("urls", [])
+    generated_images = []
+    for i, cached_path in enumerate(entry.files, 1):
+        filepath = os.path.join(output_dir, _default_filename())
+        shutil.copyfile(cached_path, filepath)
+        generated_images.append({
+            "url": urls[i - 1] if i - 1 < len(urls) else None,
+            "local_path": filepath
+        })
+    return {
+        "success": True,
+        "message": "SeeDream 4.0 图像生成成功（缓存）",
+        "images": generated_images,
+        "raw_response": entry.meta.get("raw_response"),
+        "cached": True
+    }
+
+
+def _attach_variants(result: Dict[str, Any], variants: Optional[List[postprocess.Variant]]) -> Dict[str, Any]:
+    """为成功结果中的每张图生成缩略图/分发格式变体；返回新字典，不修改可能被合并请求共享的原结果"""
+    if not variants or not result.get("success"):
+        return result
+    paths = [img["local_path"] for img in result["images"] if img.get("local_path")]
+    mapping = postprocess.process_paths(paths, variants)
+    return {
+        **result,
+        "images": [{**img, "variants": mapping.get(img.get("local_path"), [])} for img in result["images"]],
+    }
+
+
 def generate_image_with_seedream4(
     prompt: str,
     images: List = None,
     max_images: int = 1,
-    size: str = "2K"
+    size: str = "2K",
+    download_workers: int = 4,
+    cache: Optional[ResultCache] = None,
+    preprocess: bool = False,
+    retry_policy: Optional[resilience.RetryPolicy] = None,
+    coalesce: bool = False,
+    output_dir: str = "outputs",
+    variants: Any = None,
+    shard_size: Optional[int] = None,
+    shard_concurrency: int = 4,
+    deadline: Optional[float] = None,
+    cancel: Optional[budget.CancelToken] = None
 ) -> Dict[str, Any]:
     """
     使用SeeDream 4.0生成图像的便捷函数
@@ -237,63 +529,693 @@ def generate_image_with_seedream4(
         images: 参考图像列表，可以是URL字符串、文件路径、PIL Image对象或文件对象
         max_images: 最大生成图像数量
         size: 图像尺寸
+        download_workers: 并行下载结果图像的线程数
+        cache: 可选 ResultCache；相同 prompt/参数/参考图的请求直接复用缓存的图像
+        preprocess: 上传前按 size 缩放、压缩参考图并去除元数据，结果中附带 upload_bytes_saved
+        retry_policy: 可选重试/对冲策略，默认 resilience.DEFAULT_POLICY
+        coalesce: 默认关闭；开启后相同 prompt/参数/参考图的请求正在进行时，挂在其结果上而不重复请求上游
+                  （生成结果不确定，合并的调用方会拿到同一批图片）；参考图无法读取时不合并
+        output_dir: 结果图像保存目录
+        variants: 可选后处理变体（True 为默认缩略图 + WebP，或如 ["jpeg@300", "avif@1024"]），
+                  每张图附带 variants 列表（路径、字节数、尺寸），见 postprocess
+        shard_size: max_images 大于该值时拆成每份至多 shard_size 张的子请求并行生成（见 fanout），
+                    参考图只编码一次；注意拆分后各分片之间不保证组图的一致性。
+                    部分分片失败时仍返回成功分片的图片，并标记 partial 与 failed_shards（不写入缓存）
+        shard_concurrency: 拆分后同时进行的子请求数
+        deadline: 整体时限（秒），编码、排队、上传、等待上游、下载各阶段共用剩余时间
+        cancel: budget.CancelToken，调用方放弃等待时取消，关闭进行中的连接并删除未完成的下载；
+                超时或取消时返回 success=False（cancelled 标明是否为取消），带任一参数的调用不参与 coalesce
         
     Returns:
         生成结果
     """
     try:
-        api = SeeDream4API()
+        with budget.scope(deadline, cancel):
+            # 带时限或取消令牌的调用不与他人共享上游请求
+            coalesce = coalesce and budget.current() is None
+            variant_list = postprocess.parse_variants(variants) if variants else None
+            cache_key = None
+            if cache is not None or coalesce:
+                cache_key = try_request_key(
+                    "seedream4",
+                    model=SEEDREAM4_MODEL,
+                    prompt=prompt,
+                    size=size,
+                    count=max_images,
+                    watermark=False,
+                    references=images or ()
+                )
+                if cache_key is None:
+                    # 参考图无法读取：不缓存也不合并，由 _prepare_images 按原逻辑跳过该图
+                    cache, coalesce = None, False
+            if cache is not None:
+                entry = cache.get(cache_key)
+                if entry is not None:
+                    logger.info("SeeDream 4.0 命中结果缓存")
+                    return _attach_variants(_result_from_cache(entry, output_dir), variant_list)
+        
+            def generate(processed_images: Optional[List[str]], preprocess_report: Dict[str, int],
+                         count: int, store: bool = True) -> Dict[str, Any]:
+                api = SeeDream4API(retry_policy=retry_policy)
+        
+                # 调用API生成图像
+                result = api.generate_image(
+                    prompt=prompt,
+                    images=processed_images,
+                    max_images=count,
+                    size=size,
+                    stream=False  # 简化处理，不使用流式响应
+                )
         
-        # 处理图片参数，将上传的图片转换为base64
-        processed_images = None
-        if images:
-            processed_images = []
-            for img in images:
-                if isinstance(img, str) and (img.startswith('http://') or img.startswith('https://')):
-                    # 如果是URL，直接使用
-                    processed_images.append(img)
-                else:
-                    # 如果是文件或其他格式，转换为base64
+                if not result["success"]:
+                    return result
+        
+                # 处理生成的图像
+                generated_images = []
+                data = result["data"]
+        
+                urls = _result_urls(data)
+                targets = [
+                    (url, os.path.join(output_dir, _default_filename()))
+                    for url in urls
+                ]
+                # 整批结果并行下载，耗时取决于最慢的一张
+                with metrics.phase("download"):
+                    saved = downloader.download_all(targets, workers=download_workers)
+                # 调用方已放弃时不再返回结果（未完成的下载已删除）
+                budget.check("download")
+                metrics.add_bytes(received=sum(
+                    os.path.getsize(path) for path in saved if not isinstance(path, Exception)
+                ))
+                for url, filepath in zip(urls, saved):
+                    if isinstance(filepath, Exception):
+                        logger.warning(f"保存图像失败: {filepath}")
+                        filepath = None
+                    else:
+                        logger.info(f"图像已保存到: {filepath}")
+                    generated_images.append({
+                        "url": url,
+                        "local_path": filepath
+                    })
+        
+                paths = [img["local_path"] for img in generated_images]
+                if store and cache is not None and paths and all(paths):
                     try:
-                        base64_img = convert_image_to_base64(img)
-                        processed_images.append(base64_img)
-                        logger.info("图片已转换为base64格式")
+                        cache.put_files(cache_key, paths, meta={"urls": urls, "raw_response": data})
                     except Exception as e:
-                        logger.warning(f"图片转换失败，跳过: {e}")
-                        continue
+                        logger.warning(f"写入结果缓存失败: {e}")
         
-        # 调用API生成图像
-        result = api.generate_image(
+                response = {
+                    "success": True,
+                    "message": "SeeDream 4.0 图像生成成功",
+                    "images": generated_images,
+                    "raw_response": data
+                }
+                if preprocess:
+                    response["upload_bytes_saved"] = preprocess_report.get("bytes_saved", 0)
+                return response
+        
+            def generate_sharded(processed_images: Optional[List[str]], preprocess_report: Dict[str, int]) -> Dict[str, Any]:
+                def shard(count: int, index: int) -> List[Dict[str, Any]]:
+                    result = generate(processed_images, preprocess_report, count, store=False)
+                    if not result["success"]:
+                        error = result.get("error") or "SeeDream 4.0 分片生成失败"
+                        # 保留状态码，fanout 只重试 429/5xx 等可重试的失败
+                        status = result.get("status_code")
+                        if status in resilience.RETRYABLE_STATUSES:
+                            raise resilience.RetryableError(error, status)
+                        raise RuntimeError(error)
+                    return [result]
+        
+                outcome = fanout.run_shards(shard, max_images, shard_size=shard_size, concurrency=shard_concurrency)
+                if not outcome.items:
+                    raise outcome.failed[0].error
+                generated_images = [img for part in outcome.items for img in part["images"]]
+                raw_responses = [part["raw_response"] for part in outcome.items]
+                response = {
+                    "success": True,
+                    "message": "SeeDream 4.0 图像生成成功",
+                    "images": generated_images,
+                    "raw_response": raw_responses
+                }
+                if preprocess:
+                    response["upload_bytes_saved"] = preprocess_report.get("bytes_saved", 0)
+                if outcome.failed:
+                    metrics.set_status("partial")
+                    response["message"] = f"SeeDream 4.0 部分生成成功（{len(generated_images)}/{max_images} 张）"
+                    response["partial"] = True
+                    response["failed_shards"] = [failure.as_dict() for failure in outcome.failed]
+                    return response
+                paths = [img["local_path"] for img in generated_images]
+                if cache is not None and paths and all(paths):
+                    try:
+                        cache.put_files(cache_key, paths, meta={
+                            "urls": [img["url"] for img in generated_images],
+                            "raw_response": raw_responses
+                        })
+                    except Exception as e:
+                        logger.warning(f"写入结果缓存失败: {e}")
+                return response
+        
+            def run() -> Dict[str, Any]:
+                with metrics.call("seedream4", "images/generations", size):
+                    # 处理图片参数，将上传的图片转换为base64（拆分时各分片共用）
+                    preprocess_report: Dict[str, int] = {}
+                    with metrics.phase("encode"):
+                        processed_images = _prepare_images(images, size, preprocess, preprocess_report)
+                    if shard_size and max_images > shard_size:
+                        result = generate_sharded(processed_images, preprocess_report)
+                    else:
+                        result = generate(processed_images, preprocess_report, max_images)
+                    if not result["success"]:
+                        metrics.set_status("error")
+                    return result
+        
+            if coalesce:
+                # 相同请求正在进行时直接等待其结果，不重复调用上游；结果是保存目录中的文件路径，
+                # 保存目录不同的请求不能共享
+                result = singleflight.default_group.do(f"{cache_key}:{os.path.abspath(output_dir)}", run)
+            else:
+                result = run()
+            return _attach_variants(result, variant_list)
+        
+    except (budget.DeadlineExceeded, budget.Cancelled) as e:
+        return _budget_failure(e)
+    except Exception as e:
+        error_msg = f"SeeDream 4.0 生成失败: {str(e)}"
+        logger.error(error_msg)
+        return {
+            "success": False,
+            "error": error_msg
+        }
+
+
+@budget.bounded
+def generate_image_with_seedream4_stream(
+    prompt: str,
+    images: List = None,
+    max_images: int = 3,
+    size: str = "2K",
+    download_workers: int = 4
+) -> Iterator[Dict[str, Any]]:
+    """
+    generate_image_with_seedream4 的流式版本：组图模式下逐张产出结果
+    
+    每个 partial_succeeded 事件一被解析就立即提交下载，下载完成即产出，
+    首张图的等待时间约等于单张生成时间，而非整批时间。
+    
+    产出事件:
+        {"type": "image", "image_index": i, "url": ..., "local_path": ...}
+        {"type": "image_failed", "image_index": i, "error": ...}
+        {"type": "completed", "usage": ...}
+        {"type": "error", "error": ...}
+    
+    传入 deadline / cancel 时，超时或取消后关闭 SSE 连接、中断进行中的下载（删除未完成的文件），
+    产出 {"type": "error", "cancelled": ...} 后结束。
+    调用方提前停止迭代（break / close()）时同样关闭 SSE 连接、取消排队与进行中的下载，
+    并删除已下载但尚未产出的文件。
+    """
+    trace = metrics.CallTrace("seedream4", "images/generations", size)
+    # 后台线程不继承调用方的上下文，预算需显式传递
+    current_budget = budget.current()
+    started = time.perf_counter()
+    try:
+        api = SeeDream4API()
+        with metrics.activate(trace), metrics.phase("encode"):
+            processed_images = _prepare_images(images)
+    except Exception as e:
+        error_msg = f"SeeDream 4.0 生成失败: {str(e)}"
+        logger.error(error_msg)
+        trace.status = "error"
+        metrics.finish(trace, time.perf_counter() - started)
+        yield {"type": "error", "error": error_msg}
+        return
+    
+    # SSE 读取放在后台线程，下载完成与新事件都汇入同一个队列，谁先到先产出
+    events: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+    stop = threading.Event()
+    # 调用方停止迭代时取消：关闭 SSE 连接、中断下载；与调用方的预算合并后供后台线程使用
+    abandon = budget.CancelToken()
+    # 入队与停止互斥：停止后完成的下载不再入队，而是直接删除
+    delivering = threading.Lock()
+    
+    def _emit(event: Dict[str, Any]) -> None:
+        with delivering:
+            if not stop.is_set():
+                events.put(event)
+                return
+        if event.get("local_path"):
+            _discard_file(event["local_path"])
+    
+    def _download(index: int, url: str) -> None:
+        try:
+            # 并行下载各自计时，download 阶段为各张下载耗时之和
+            with metrics.activate(trace), budget.activate(current_budget), budget.scope(cancel=abandon):
+                filepath = api.save_image_from_url(url, _default_filename())
+            _emit({"type": "image", "image_index": index, "url": url, "local_path": filepath})
+        except Exception as e:
+            _emit({"type": "image_failed", "image_index": index, "url": url, "error": str(e),
+                   "cancelled": isinstance(e, budget.Cancelled)})
+    
+    pool = ThreadPoolExecutor(max_workers=max(1, download_workers))
+    
+    def _read_stream() -> None:
+        # 读取线程独占自己的上下文，整个生命周期启用 trace，请求与解析耗时记入同一次调用
+        with metrics.activate(trace), budget.activate(current_budget), budget.scope(cancel=abandon):
+            _consume_stream()
+    
+    def _consume_stream() -> None:
+        downloads = []
+        stream = api.iter_generate_image(
+            prompt=prompt,
+            images=processed_images,
+            max_images=max_images,
+            size=size
+        )
+        try:
+            for event in stream:
+                if stop.is_set():
+                    break
+                event_type = event.get("type", "")
+                index = event.get("image_index", 0)
+                if event_type == "image_generation.partial_succeeded" and event.get("url"):
+                    try:
+                        downloads.append(pool.submit(_download, index, event["url"]))
+                    except RuntimeError:
+                        # 下载线程池已随调用方停止迭代而关闭
+                        break
+                elif event_type == "image_generation.partial_failed":
+                    _emit({"type": "image_failed", "image_index": index, "error": event.get("error")})
+                elif event_type == "image_generation.completed":
+                    _emit({"type": "completed", "usage": event.get("usage")})
+                elif event_type == "error":
+                    trace.status = "error"
+                    _emit(event)
+        except Exception as e:
+            # 读取线程中的任何异常都要以 error 事件告知调用方，不能只留下一个空的流
+            error_msg = f"SeeDream 4.0 流式读取失败: {str(e)}"
+            logger.error(error_msg)
+            trace.status = "error"
+            _emit({"type": "error", "error": error_msg})
+        finally:
+            stream.close()
+            # 已提交的下载全部写入队列后再发送结束标记（被取消的排队下载直接跳过）
+            for future in downloads:
+                if not future.cancelled():
+                    future.exception()
+            events.put(None)
+    
+    reader = threading.Thread(target=_read_stream, name="seedream4-sse", daemon=True)
+    reader.start()
+    try:
+        while True:
+            item = events.get()
+            if item is None:
+                break
+            yield item
+    finally:
+        # 调用方提前停止迭代时，不再等待剩余的流与下载：取消排队的下载，关闭 SSE 连接与进行中的下载
+        with delivering:
+            stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+        abandon.cancel("调用方已停止迭代")
+        # 已下载完成但未产出的文件无人跟踪，直接删除
+        while True:
+            try:
+                item = events.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None and item.get("local_path"):
+                _discard_file(item["local_path"])
+        metrics.finish(trace, time.perf_counter() - started)
+
+
+class AsyncSeeDream4API:
+    """SeeDream 4.0 API 异步客户端
+
+    基于 httpx.AsyncClient，返回结构与 SeeDream4API 一致。
+    max_concurrency 限制本客户端同时在途的请求数（生成与下载共用），
+    单个事件循环即可并发维持大量生成任务。
+    """
+    
+    def __init__(
+        self,
+        api_key: str = None,
+        base_url: str = None,
+        max_concurrency: int = 64,
+        retry_policy: Optional[resilience.RetryPolicy] = None
+    ):
+        load_env()
+        env_key = os.getenv("SEEDREAM4_API_KEY")
+        env_url = os.getenv("SEEDREAM4_BASE_URL", SEEDREAM4_DEFAULT_URL)
+        self.api_key = api_key or env_key
+        self.base_url = base_url or env_url
+        if not self.api_key:
+            raise RuntimeError("缺少 SEEDREAM4_API_KEY，请在 .env 或系统环境中配置")
+        self.headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.client = http_pool.new_async_client(max_connections=max_concurrency)
+        # 与同步客户端共用 resilience 的重试、退避与对冲策略
+        self.retry_policy = retry_policy or resilience.DEFAULT_POLICY
+
+    async def _post(self, data: Dict[str, Any], max_images: int) -> httpx.Response:
+        """发送生成请求并返回流式响应（SeeDream4API._post 的异步版本）
+
+        可重试的错误按 retry_policy 退避重试；成功时占用一个并发名额，调用方处理完响应后
+        须调用 _release(response) 关闭响应并归还名额。
+        """
+        async def attempt() -> httpx.Response:
+            await self._semaphore.acquire()
+            try:
+                await rate_limiter.athrottle("seedream4", "images/generations", data["model"], max_images)
+                request = self.client.build_request(
+                    "POST",
+                    self.base_url,
+                    headers=self.headers,
+                    json=data,
+                    timeout=http_pool.httpx_timeout(60)
+                )
+                with metrics.phase("request"):
+                    response = await self.client.send(request, stream=True)
+                metrics.add_bytes(sent=len(request.content))
+                if response.status_code in self.retry_policy.retry_statuses:
+                    body = (await response.aread()).decode('utf-8', errors='replace')
+                    await response.aclose()
+                    raise resilience.RetryableError(
+                        f"上游返回 {response.status_code}: {body[:500]}",
+                        status_code=response.status_code,
+                        retry_after=resilience.parse_retry_after(response.headers),
+                        response=response
+                    )
+                return response
+            except BaseException:
+                self._semaphore.release()
+                raise
+
+        return await resilience.aexecute(
+            attempt, self.retry_policy, key="seedream4:generations", discard=self._release
+        )
+
+    async def _release(self, response: httpx.Response) -> None:
+        await response.aclose()
+        self._semaphore.release()
+
+    async def __aenter__(self) -> "AsyncSeeDream4API":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+    @budget.bounded
+    async def generate_image(
+        self,
+        prompt: str,
+        images: List = None,
+        sequential_generation: str = "auto",
+        max_images: int = 3,
+        response_format: str = "url",
+        size: str = "2K",
+        stream: bool = True,
+        watermark: bool = False
+    ) -> Dict[str, Any]:
+        """生成图像（异步），参数与返回值同 SeeDream4API.generate_image（超时或取消时抛出 budget 异常）"""
+        with metrics.call("seedream4", "images/generations", size):
+            result = await self._generate_image(
+                prompt, images, sequential_generation, max_images,
+                response_format, size, stream, watermark
+            )
+            if not result["success"]:
+                metrics.set_status("error")
+            return result
+
+    async def _generate_image(
+        self,
+        prompt: str,
+        images: Optional[List],
+        sequential_generation: str,
+        max_images: int,
+        response_format: str,
+        size: str,
+        stream: bool,
+        watermark: bool
+    ) -> Dict[str, Any]:
+        data = _build_request_data(
+            prompt, images, sequential_generation, max_images,
+            response_format, size, stream, watermark
+        )
+        logger.info(f"SeeDream 4.0 API 异步请求: {prompt[:50]}...")
+        try:
+            # 发送请求（429/5xx 自动重试）
+            response = await self._post(data, max_images)
+            try:
+                if response.status_code != 200:
+                    body = (await response.aread()).decode('utf-8', errors='replace')
+                    error_msg = f"API请求失败: {response.status_code} - {body}"
+                    logger.error(error_msg)
+                    return {
+                        "success": False,
+                        "error": error_msg,
+                        "status_code": response.status_code
+                    }
+                
+                if stream:
+                    return await self._handle_stream_response(response)
+                with metrics.phase("response"):
+                    body = await response.aread()
+                    result = json.loads(body)
+                metrics.add_bytes(received=len(body))
+                logger.info("SeeDream 4.0 图像生成成功")
+                return {
+                    "success": True,
+                    "data": result
+                }
+            finally:
+                await self._release(response)
+                    
+        except resilience.RetryableError as e:
+            error_msg = f"API请求失败（已重试 {self.retry_policy.max_attempts} 次）: {str(e)}"
+            logger.error(error_msg)
+            return {
+                "success": False,
+                "error": error_msg,
+                "status_code": e.status_code
+            }
+            
+        except httpx.TimeoutException:
+            error_msg = "请求超时"
+            logger.error(error_msg)
+            return {"success": False, "error": error_msg}
+            
+        except (budget.DeadlineExceeded, budget.Cancelled) as e:
+            return _budget_failure(e)
+            
+        except httpx.HTTPError as e:
+            error_msg = f"网络请求错误: {str(e)}"
+            logger.error(error_msg)
+            return {"success": False, "error": error_msg}
+            
+        except Exception as e:
+            error_msg = f"未知错误: {str(e)}"
+            logger.error(error_msg)
+            return {"success": False, "error": error_msg}
+
+    async def _handle_stream_response(self, response: httpx.Response) -> Dict[str, Any]:
+        """处理流式响应（异步）"""
+        try:
+            results = []
+            with metrics.phase("stream_parse"):
+                async for line_text in response.aiter_lines():
+                    if line_text:
+                        event = _parse_sse_line(line_text)
+                        if event is _SSE_DONE:
+                            break
+                        if event is not None:
+                            results.append(event)
+            metrics.add_bytes(received=response.num_bytes_downloaded)
+            
+            return {
+                "success": True,
+                "data": results
+            }
+            
+        except Exception as e:
+            error_msg = f"流式响应处理错误: {str(e)}"
+            logger.error(error_msg)
+            return {"success": False, "error": error_msg}
+
+    @budget.bounded
+    async def save_image_from_url(self, image_url: str, filename: str = None, output_dir: str = "outputs") -> str:
+        """从URL保存图像到 output_dir（异步分块下载到 .part 文件，中断时按 Range 续传，落盘在线程中执行）"""
+        try:
+            if not filename:
+                filename = _default_filename()
+            
+            os.makedirs(output_dir, exist_ok=True)
+            filepath = os.path.join(output_dir, filename)
+            
+            async with self._semaphore:
+                with metrics.phase("download"):
+                    await downloader.adownload_file(self.client, image_url, filepath, timeout=30)
+            metrics.add_bytes(received=os.path.getsize(filepath))
+            logger.info(f"图像已保存到: {filepath}")
+            return filepath
+            
+        except (budget.DeadlineExceeded, budget.Cancelled):
+            raise
+        except Exception as e:
+            error_msg = f"保存图像失败: {str(e)}"
+            logger.error(error_msg)
+            raise Exception(error_msg)
+
+
+async def generate_image_with_seedream4_async(
+    prompt: str,
+    images: List = None,
+    max_images: int = 1,
+    size: str = "2K",
+    api: Optional[AsyncSeeDream4API] = None,
+    coalesce: bool = False,
+    variants: Any = None,
+    deadline: Optional[float] = None,
+    cancel: Optional[budget.CancelToken] = None,
+    output_dir: str = "outputs"
+) -> Dict[str, Any]:
+    """
+    generate_image_with_seedream4 的异步版本，返回结构一致
+    
+    Args:
+        api: 可选，复用已有的 AsyncSeeDream4API（共享连接池与并发上限）；
+             不传则临时创建并在结束时关闭
+        coalesce: 默认关闭；开启后同一事件循环内相同请求（含相同 output_dir 与上游地址）正在进行时，
+                  挂在其结果上而不重复请求上游
+        output_dir: 图片保存目录
+        variants: 可选后处理变体，同 generate_image_with_seedream4（在进程池中执行，不阻塞事件循环）
+        deadline / cancel: 同 generate_image_with_seedream4；取消时直接取消任务，httpx 随之关闭连接
+    """
+    try:
+        variant_list = postprocess.parse_variants(variants) if variants else None
+    except ValueError as e:
+        return {
+            "success": False,
+            "error": f"SeeDream 4.0 生成失败: {str(e)}"
+        }
+    if deadline is None and cancel is None:
+        return await _seedream4_async_with_variants(prompt, images, max_images, size, api, coalesce, variant_list, output_dir)
+    try:
+        with budget.scope(deadline, cancel):
+            # 带时限或取消令牌的调用不与他人共享上游请求
+            return await budget.bound(
+                _seedream4_async_with_variants(prompt, images, max_images, size, api, False, variant_list, output_dir)
+            )
+    except (budget.DeadlineExceeded, budget.Cancelled) as e:
+        return _budget_failure(e)
+
+
+async def _seedream4_async_with_variants(
+    prompt: str,
+    images: Optional[List],
+    max_images: int,
+    size: str,
+    api: Optional[AsyncSeeDream4API],
+    coalesce: bool,
+    variant_list: Optional[List[postprocess.Variant]],
+    output_dir: str
+) -> Dict[str, Any]:
+    if not coalesce:
+        result = await _generate_with_seedream4_async(prompt, images, max_images, size, api, output_dir)
+        return await asyncio.to_thread(_attach_variants, result, variant_list)
+    key = await asyncio.to_thread(
+        try_request_key,
+        "seedream4",
+        model=SEEDREAM4_MODEL,
+        prompt=prompt,
+        size=size,
+        count=max_images,
+        watermark=False,
+        references=images or ()
+    )
+    if key is None:
+        result = await _generate_with_seedream4_async(prompt, images, max_images, size, api, output_dir)
+    else:
+        # 落盘目录与上游地址不同的调用不能共享结果
+        base_url = api.base_url if api is not None else os.getenv("SEEDREAM4_BASE_URL", SEEDREAM4_DEFAULT_URL)
+        result = await singleflight.default_group.ado(
+            f"{key}:{os.path.abspath(output_dir)}:{base_url}",
+            lambda: _generate_with_seedream4_async(prompt, images, max_images, size, api, output_dir)
+        )
+    return await asyncio.to_thread(_attach_variants, result, variant_list)
+
+
+async def _generate_with_seedream4_async(
+    prompt: str,
+    images: Optional[List],
+    max_images: int,
+    size: str,
+    api: Optional[AsyncSeeDream4API],
+    output_dir: str
+) -> Dict[str, Any]:
+    with metrics.call("seedream4", "images/generations", size):
+        result = await _run_seedream4_async(prompt, images, max_images, size, api, output_dir)
+        if not result["success"]:
+            metrics.set_status("error")
+        return result
+
+
+async def _run_seedream4_async(
+    prompt: str,
+    images: Optional[List],
+    max_images: int,
+    size: str,
+    api: Optional[AsyncSeeDream4API],
+    output_dir: str
+) -> Dict[str, Any]:
+    own_api = api is None
+    try:
+        if own_api:
+            api = AsyncSeeDream4API()
+        
+        # base64 转换是 CPU/磁盘密集操作，放到线程中避免阻塞事件循环
+        with metrics.phase("encode"):
+            processed_images = await asyncio.to_thread(_prepare_images, images)
+        
+        result = await api.generate_image(
             prompt=prompt,
             images=processed_images,
             max_images=max_images,
             size=size,
-            stream=False  # 简化处理，不使用流式响应
+            stream=False
         )
         
         if not result["success"]:
             return result
         
-        # 处理生成的图像
-        generated_images = []
         data = result["data"]
-        
-        if "data" in data and isinstance(data["data"], list):
-            for item in data["data"]:
-                if "url" in item:
-                    # 保存图像到本地
-                    try:
-                        filepath = api.save_image_from_url(item["url"])
-                        generated_images.append({
-                            "url": item["url"],
-                            "local_path": filepath
-                        })
-                    except Exception as e:
-                        logger.warning(f"保存图像失败: {e}")
-                        generated_images.append({
-                            "url": item["url"],
-                            "local_path": None
-                        })
+        urls = _result_urls(data)
+        with metrics.phase("download"):
+            saved = await asyncio.gather(
+                *(
+                    api.save_image_from_url(url, _default_filename(), output_dir)
+                    for url in urls
+                ),
+                return_exceptions=True
+            )
+        budget.check("download")
+        generated_images = []
+        for url, filepath in zip(urls, saved):
+            if isinstance(filepath, BaseException):
+                logger.warning(f"保存图像失败: {filepath}")
+                filepath = None
+            generated_images.append({
+                "url": url,
+                "local_path": filepath
+            })
         
         return {
             "success": True,
@@ -302,6 +1224,8 @@ def generate_image_with_seedream4(
             "raw_response": data
         }
         
+    except (budget.DeadlineExceeded, budget.Cancelled) as e:
+        return _budget_failure(e)
     except Exception as e:
         error_msg = f"SeeDream 4.0 生成失败: {str(e)}"
         logger.error(error_msg)
@@ -309,6 +1233,9 @@ def generate_image_with_seedream4(
             "success": False,
             "error": error_msg
         }
+    finally:
+        if own_api and api is not None:
+            await api.aclose()
 
 
 if __name__ == "__main__":
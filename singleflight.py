@@ -0,0 +1,119 @@
+"""
+在途请求合并（single-flight）：相同请求同时只向上游发起一次
+
+- 键与结果缓存相同，使用 result_cache.request_key() 对 prompt、参数与输入图摘要的规范化哈希；
+- 首个调用者（leader）真正执行请求，之后到达的相同请求挂在其结果上等待，拿到同一份结果
+  （list/dict 做浅拷贝，调用方修改自己的结果不会影响其他人）；leader 抛出的异常同样传给所有等待者；
+- do() 用于线程，ado() 用于 asyncio 任务（按事件循环分别合并）；
+- 只合并"同时在途"的请求，结束后立即移除，不做缓存。需要复用已完成的结果请配合 ResultCache。
+"""
+from __future__ import annotations
+
+import copy
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Dict, Tuple, TypeVar
+
+from lazy import lazy_import
+
+# 仅 ado() 需要 asyncio，同步调用方不必为其付出导入开销
+asyncio = lazy_import("asyncio")
+
+logger = logging.getLogger('singleflight')
+
+T = TypeVar("T")
+
+
+def _share(result: Any) -> Any:
+    if isinstance(result, (list, dict)):
+        return copy.copy(result)
+    return result
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: BaseException = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """按键合并同时在途的相同调用"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._async_calls: Dict[Tuple[int, str], asyncio.Future] = {}
+        self.coalesced = 0
+
+    def do(self, key: str, fn: Callable[[], T]) -> T:
+        """执行 fn；相同 key 已在执行时等待其结果而不重复执行"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+
+        if not leader:
+            logger.info(f"合并相同的在途请求: {key[:16]}")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return _share(call.result)
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """do() 的异步版本：fn 返回协程，同一事件循环内相同 key 的任务共享结果"""
+        loop = asyncio.get_running_loop()
+        flight_key = (id(loop), key)
+        with self._lock:
+            future = self._async_calls.get(flight_key)
+            leader = future is None
+            if leader:
+                future = self._async_calls[flight_key] = loop.create_future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            logger.info(f"合并相同的在途请求: {key[:16]}")
+            # shield：某个等待者被取消不影响 leader 与其他等待者
+            return _share(await asyncio.shield(future))
+
+        try:
+            result = await fn()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # 没有等待者时避免 "exception was never retrieved" 警告
+                future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._async_calls.pop(flight_key, None)
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls) + len(self._async_calls)
+
+
+# 进程内共享的默认实例
+default_group = SingleFlight()
@@ -0,0 +1,180 @@
+"""
+流式请求体：文件内容边读边编码边发送，不在内存中拼出完整请求
+
+- json_body(fields, files)：JSON 请求体，图片字段以 base64 / data URL 逐块写出；
+- multipart_body(fields, files)：multipart/form-data 请求体，文件内容逐块写出。
+
+两者都返回 StreamingBody：可迭代、已知长度（requests 据此设置 Content-Length，不使用 chunked 编码），
+每次迭代都重新打开文件，因此失败重试时可以再次发送；文件句柄在迭代结束或中止时立即关闭。
+单个请求的峰值内存只与块大小有关，与图片尺寸无关。
+httpx.AsyncClient 使用 body.aiter()（content=body.aiter()），文件读取与编码在线程中执行。
+"""
+from __future__ import annotations
+
+import base64
+import json
+import os
+import uuid
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Iterator, List, Mapping, Optional, Tuple, Union
+
+# 必须是 3 的倍数，保证分块 base64 编码后直接拼接即为整体编码结果
+_B64_READ_SIZE = 3 * 16 * 1024
+_RAW_READ_SIZE = 64 * 1024
+
+
+@dataclass
+class FileSource:
+    """请求体中的一段文件内容：path 为本地路径，data 为内存字节，二者取其一"""
+    path: Optional[str] = None
+    data: Optional[bytes] = None
+    base64: bool = False
+
+    def raw_size(self) -> int:
+        return len(self.data) if self.data is not None else os.path.getsize(self.path)
+
+    def __len__(self) -> int:
+        size = self.raw_size()
+        return 4 * ((size + 2) // 3) if self.base64 else size
+
+    def __iter__(self) -> Iterator[bytes]:
+        block = _B64_READ_SIZE if self.base64 else _RAW_READ_SIZE
+        if self.data is not None:
+            view = memoryview(self.data)
+            for start in range(0, len(view), block):
+                chunk = view[start:start + block]
+                yield base64.b64encode(chunk) if self.base64 else bytes(chunk)
+            return
+        with open(self.path, "rb") as f:
+            while True:
+                chunk = f.read(block)
+                if not chunk:
+                    break
+                yield base64.b64encode(chunk) if self.base64 else chunk
+
+
+Part = Union[bytes, FileSource]
+
+
+class StreamingBody:
+    """由若干字节段与文件段组成的可重复迭代请求体"""
+
+    def __init__(self, parts: List[Part], content_type: str):
+        self.parts = parts
+        self.content_type = content_type
+
+    def __len__(self) -> int:
+        return sum(len(part) for part in self.parts)
+
+    def __iter__(self) -> Iterator[bytes]:
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+            else:
+                yield from part
+
+    async def aiter(self) -> AsyncIterator[bytes]:
+        """异步迭代（供 httpx.AsyncClient 使用）：文件段逐块在线程中读取与编码，不阻塞事件循环"""
+        import asyncio
+
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            chunks = iter(part)
+            try:
+                while True:
+                    chunk = await asyncio.to_thread(next, chunks, None)
+                    if chunk is None:
+                        break
+                    yield chunk
+            finally:
+                try:
+                    chunks.close()
+                except ValueError:
+                    # 取消时读取线程仍在执行该块，句柄随生成器回收关闭
+                    pass
+
+
+def _source(value: Union[str, bytes], as_base64: bool) -> FileSource:
+    if isinstance(value, bytes):
+        return FileSource(data=value, base64=as_base64)
+    return FileSource(path=value, base64=as_base64)
+
+
+JsonFile = Tuple[Union[str, bytes], Optional[str]]
+MultipartFile = Tuple[str, Union[str, bytes], str]
+
+
+def json_body(
+    fields: Mapping[str, Any],
+    files: Mapping[str, Union[JsonFile, List[JsonFile]]],
+) -> StreamingBody:
+    """构建 JSON 请求体。
+
+    参数:
+      - fields: 普通字段，按 json.dumps 序列化
+      - files: {字段名: (文件路径或字节, MIME)}；MIME 不为 None 时输出 data URL，否则输出纯 base64。
+        值为列表时输出为字符串数组（多张参考图）
+    """
+    parts: List[Part] = [b"{"]
+    first = True
+    for name, value in fields.items():
+        parts.append(("" if first else ",").encode() + json.dumps(name).encode() + b":" +
+                     json.dumps(value, ensure_ascii=False).encode("utf-8"))
+        first = False
+    for name, value in files.items():
+        parts.append(("" if first else ",").encode() + json.dumps(name).encode() + b":")
+        entries = value if isinstance(value, list) else [value]
+        if isinstance(value, list):
+            parts.append(b"[")
+        for index, (source, mime) in enumerate(entries):
+            # base64 与 data URL 前缀只含 JSON 安全字符，无需转义
+            prefix = f"data:{mime};base64," if mime else ""
+            parts.append((b"," if index else b"") + b'"' + prefix.encode())
+            parts.append(_source(source, True))
+            parts.append(b'"')
+        if isinstance(value, list):
+            parts.append(b"]")
+        first = False
+    parts.append(b"}")
+    return StreamingBody(parts, "application/json")
+
+
+def multipart_body(
+    fields: Mapping[str, Any],
+    files: Mapping[str, Union[MultipartFile, List[MultipartFile]]],
+) -> StreamingBody:
+    """构建 multipart/form-data 请求体。
+
+    参数:
+      - fields: 普通表单字段
+      - files: {字段名: (文件名, 文件路径或字节, MIME)}；值为列表时同名字段重复出现（如多张 image[]）
+    """
+    boundary = uuid.uuid4().hex
+    dash = f"--{boundary}\r\n".encode()
+    parts: List[Part] = []
+    for name, value in fields.items():
+        parts.append(dash)
+        parts.append(
+            f'Content-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8")
+        )
+    for name, value in files.items():
+        for filename, source, mime in (value if isinstance(value, list) else [value]):
+            parts.append(dash)
+            parts.append(
+                (f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                 f"Content-Type: {mime}\r\n\r\n").encode("utf-8")
+            )
+            parts.append(_source(source, False))
+            parts.append(b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return StreamingBody(parts, f"multipart/form-data; boundary={boundary}")
+
+
+def headers_for(body: StreamingBody, headers: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """返回附带 Content-Type 与 Content-Length 的请求头"""
+    merged = dict(headers or {})
+    merged["Content-Type"] = body.content_type
+    merged["Content-Length"] = str(len(body))
+    return merged
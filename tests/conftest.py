@@ -0,0 +1,62 @@
+"""
+测试公共夹具：本地模拟 API（mock_image_api.py）与指向它的环境变量
+"""
+from __future__ import annotations
+
+import os
+import sys
+import threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import mock_image_api  # noqa: E402
+
+
+@pytest.fixture(scope="session", autouse=True)
+def mock_api(tmp_path_factory):
+    """启动模拟服务，环境变量指向它，工作目录切到临时目录（结果默认写入 ./outputs）"""
+    server = mock_image_api.make_server(port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    workdir = tmp_path_factory.mktemp("smoke")
+    env = {
+        "SEEDREAM4_API_KEY": "smoke",
+        "SEEDREAM4_BASE_URL": f"{base}/api/v3/images/generations",
+        "AZURE_OPENAI_ENDPOINT": base,
+        "AZURE_OPENAI_API_KEY": "smoke",
+        "AZURE_OPENAI_DEPLOYMENT_NAME": "gpt-image-1",
+        "IMAGE_RATE_LIMIT_DIR": str(workdir / "rate-limits"),
+        "IMAGE_RESULT_CACHE_DIR": str(workdir / "cache"),
+        "IMAGE_JOB_QUEUE_DB": str(workdir / "jobs.db"),
+    }
+    saved = {name: os.environ.get(name) for name in list(env) + ["SEEDREAM4_RPM", "SEEDREAM4_IPM",
+                                                                  "AZURE_OPENAI_RPM", "AZURE_OPENAI_IPM"]}
+    os.environ.update(env)
+    for name in ("SEEDREAM4_RPM", "SEEDREAM4_IPM", "AZURE_OPENAI_RPM", "AZURE_OPENAI_IPM"):
+        os.environ.pop(name, None)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    import gpt_image_1
+
+    gpt_image_1.reload_config()
+    try:
+        yield base
+    finally:
+        os.chdir(cwd)
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def input_image(tmp_path):
+    path = tmp_path / "input.png"
+    path.write_bytes(mock_image_api.load_fixture_image())
+    return str(path)
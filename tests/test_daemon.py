@@ -0,0 +1,65 @@
+"""守护进程：访问控制与输入路径限制"""
+from __future__ import annotations
+
+import http.client
+import json
+import threading
+
+import pytest
+
+import daemon
+
+
+@pytest.fixture
+def tcp_daemon(tmp_path):
+    server = daemon.make_server(
+        daemon.Daemon(output_dir=str(tmp_path / "out"), input_roots=[str(tmp_path / "refs")]),
+        port=0, token="secret",
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _post(port, body, headers):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        conn.request("POST", "/v1/generate", body=body, headers=headers)
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        conn.close()
+
+
+def test_rejects_non_json_content_type(tcp_daemon):
+    status, _ = _post(tcp_daemon, b'{"prompt": "x"}', {"Content-Type": "text/plain", "Authorization": "Bearer secret"})
+    assert status == 415
+
+
+def test_rejects_missing_token_and_foreign_host(tcp_daemon):
+    status, _ = _post(tcp_daemon, b'{"prompt": "x"}', {"Content-Type": "application/json"})
+    assert status == 401
+    status, _ = _post(tcp_daemon, b'{"prompt": "x"}', {
+        "Content-Type": "application/json", "Authorization": "Bearer secret", "Host": "evil.example:8766",
+    })
+    assert status == 403
+
+
+def test_rejects_output_dir_and_paths_outside_roots(tcp_daemon, tmp_path):
+    headers = {"Content-Type": "application/json", "Authorization": "Bearer secret"}
+    for job in (
+        {"prompt": "x", "output_dir": str(tmp_path / "elsewhere")},
+        {"prompt": "x", "provider": "gpt_image_1", "image_path": "/etc/passwd"},
+        {"prompt": "x", "images": [str(tmp_path / "refs" / ".." / "secret.png")]},
+        {"prompt": "x", "provider": "gpt_image_1", "prefix": "../escape"},
+    ):
+        status, payload = _post(tcp_daemon, json.dumps({**job, "stream": False}).encode(), headers)
+        assert status == 400, payload
+    assert not (tmp_path / "elsewhere").exists()
+
+
+def test_client_sends_token(tcp_daemon):
+    assert daemon.DaemonClient(port=tcp_daemon, token="secret").health()["ok"]
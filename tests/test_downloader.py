@@ -0,0 +1,25 @@
+"""结果图下载：续传范围校验"""
+from __future__ import annotations
+
+import downloader
+
+
+def test_write_mode():
+    assert downloader._write_mode(200, 0, {}) == "wb"
+    # 不支持 Range 的服务端返回 200 与完整内容：从头写
+    assert downloader._write_mode(200, 100, {}) == "wb"
+    assert downloader._write_mode(206, 100, {"Content-Range": "bytes 100-199/200"}) == "ab"
+    assert downloader._write_mode(206, 100, {"Content-Range": "bytes 100-199/*"}) == "ab"
+
+
+def test_write_mode_range_mismatch():
+    assert downloader._write_mode(206, 100, {"Content-Range": "bytes 0-199/200"}) is None
+    assert downloader._write_mode(206, 100, {"Content-Range": "bytes 150-199/200"}) is None
+    assert downloader._write_mode(206, 100, {}) is None
+    assert downloader._write_mode(206, 100, {"Content-Range": "garbage"}) is None
+
+
+def test_expected_length():
+    assert downloader._expected_length({"Content-Length": "42"}) == 42
+    assert downloader._expected_length({}) is None
+    assert downloader._expected_length({"Content-Length": "42", "Content-Encoding": "gzip"}) is None
@@ -0,0 +1,72 @@
+"""大批量请求拆分"""
+from __future__ import annotations
+
+import threading
+
+import pytest
+
+import fanout
+
+
+def test_plan():
+    assert fanout.plan(10, 4) == [4, 4, 2]
+    assert fanout.plan(3, 5) == [3]
+    with pytest.raises(ValueError):
+        fanout.plan(0, 2)
+
+
+def test_retries_only_failed_shards():
+    calls = []
+    lock = threading.Lock()
+
+    def shard(count, index):
+        with lock:
+            calls.append(index)
+            first = calls.count(index) == 1
+        if index == 1 and first:
+            raise ConnectionError("reset")
+        return [f"{index}:{i}" for i in range(count)]
+
+    result = fanout.run_shards(shard, 5, shard_size=2, retries=1)
+    assert sorted(calls) == [0, 1, 1, 2]
+    assert result.items == ["0:0", "0:1", "1:0", "1:1", "2:0"]
+    assert result.ok and result.retried == 1
+
+
+def test_reports_shards_that_keep_failing():
+    def shard(count, index):
+        if index == 0:
+            raise ConnectionError("down")
+        return [index] * count
+
+    result = fanout.run_shards(shard, 4, shard_size=2, retries=2)
+    assert result.items == [1, 1]
+    assert result.partial
+    assert [(failure.index, failure.count) for failure in result.failed] == [(0, 2)]
+    assert result.retried == 2
+
+
+class _Rejected(Exception):
+    """带 400 响应的 HTTP 错误（如内容审核拒绝）"""
+
+    def __init__(self):
+        super().__init__("content policy violation")
+        self.status_code = 400
+
+
+def test_does_not_retry_non_retryable_failures():
+    calls = []
+
+    def shard(count, index):
+        calls.append(index)
+        if index == 0:
+            raise _Rejected()
+        if index == 1 and calls.count(1) == 1:
+            raise fanout.resilience.RetryableError("busy", 503)
+        return [index] * count
+
+    result = fanout.run_shards(shard, 6, shard_size=2, retries=2)
+    assert sorted(calls) == [0, 1, 1, 2]
+    assert result.items == [1, 1, 2, 2]
+    assert isinstance(result.failed[0].error, _Rejected)
+    assert result.retried == 1
@@ -0,0 +1,53 @@
+"""持久化任务队列：租约过期"""
+from __future__ import annotations
+
+import time
+
+import pytest
+
+import jobqueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = jobqueue.JobQueue(str(tmp_path / "jobs.db"), lease=0.1, max_attempts=2)
+    try:
+        yield queue
+    finally:
+        queue.close()
+
+
+def test_expired_lease_is_reclaimed(queue):
+    job_id = queue.submit({"prompt": "x"}, provider="gpt_image_1")
+    assert queue.claim("w1").id == job_id
+    # 租约未过期时不能被其他 worker 领取
+    assert queue.claim("w2") is None
+    time.sleep(0.15)
+    job = queue.claim("w2")
+    assert job.id == job_id and job.worker == "w2" and job.attempts == 2
+    # 原 worker 的结果不再被接受
+    assert not queue.complete(job_id, "w1", {"outputs": []})
+    assert queue.complete(job_id, "w2", {"outputs": []})
+    assert queue.status(job_id) == "succeeded"
+
+
+def test_heartbeat_extends_lease(queue):
+    job_id = queue.submit({"prompt": "x"}, provider="gpt_image_1")
+    queue.claim("w1")
+    for _ in range(3):
+        time.sleep(0.05)
+        assert queue.heartbeat(job_id, "w1")
+    assert queue.claim("w2") is None
+
+
+def test_expired_lease_after_max_attempts_fails(queue):
+    job_id = queue.submit({"prompt": "x"}, provider="gpt_image_1")
+    queue.claim("w1")
+    time.sleep(0.15)
+    queue.claim("w2")
+    time.sleep(0.15)
+    assert queue.claim("w3") is None
+    job = queue.get(job_id)
+    assert job.status == "failed" and "租约" in job.error
+    with pytest.raises(jobqueue.JobFailed):
+        queue.result(job_id, timeout=1)
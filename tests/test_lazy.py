@@ -0,0 +1,57 @@
+"""延迟导入与 .env 加载"""
+from __future__ import annotations
+
+import os
+
+import pytest
+
+import lazy
+
+
+@pytest.fixture
+def env_dir(tmp_path, monkeypatch):
+    pytest.importorskip("dotenv")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(lazy, "_env_loaded", False)
+    monkeypatch.setattr(lazy, "_env_values", {})
+    for key in ("LAZY_TEST_KEY", "LAZY_TEST_REMOVED", "LAZY_TEST_REAL"):
+        monkeypatch.delenv(key, raising=False)
+    yield tmp_path
+    for key in list(lazy._env_values):
+        os.environ.pop(key, None)
+
+
+def test_load_env_does_not_override_real_environment(env_dir, monkeypatch):
+    monkeypatch.setenv("LAZY_TEST_REAL", "from-shell")
+    (env_dir / ".env").write_text("LAZY_TEST_KEY=one\nLAZY_TEST_REAL=from-file\n")
+    assert lazy.load_env() == str(env_dir / ".env")
+    assert os.environ["LAZY_TEST_KEY"] == "one"
+    assert os.environ["LAZY_TEST_REAL"] == "from-shell"
+    # 只加载一次
+    assert lazy.load_env() is None
+
+
+def test_force_reload_updates_keys_from_env_file(env_dir, monkeypatch):
+    monkeypatch.setenv("LAZY_TEST_REAL", "from-shell")
+    (env_dir / ".env").write_text("LAZY_TEST_KEY=one\nLAZY_TEST_REMOVED=x\nLAZY_TEST_REAL=from-file\n")
+    lazy.load_env()
+    (env_dir / ".env").write_text("LAZY_TEST_KEY=two\nLAZY_TEST_REAL=rotated\n")
+    lazy.load_env(force=True)
+    # 轮换后的值生效，从 .env 删除的变量随之移除，真实环境变量保持不变
+    assert os.environ["LAZY_TEST_KEY"] == "two"
+    assert "LAZY_TEST_REMOVED" not in os.environ
+    assert os.environ["LAZY_TEST_REAL"] == "from-shell"
+
+
+def test_force_reload_keeps_values_changed_by_code(env_dir):
+    (env_dir / ".env").write_text("LAZY_TEST_KEY=one\n")
+    lazy.load_env()
+    os.environ["LAZY_TEST_KEY"] = "set-by-code"
+    (env_dir / ".env").write_text("LAZY_TEST_KEY=two\n")
+    lazy.load_env(force=True)
+    assert os.environ["LAZY_TEST_KEY"] == "set-by-code"
+
+
+def test_lazy_import_defers_module_load():
+    module = lazy.lazy_import("json")
+    assert module.dumps({"a": 1}) == '{"a": 1}'
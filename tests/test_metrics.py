@@ -0,0 +1,29 @@
+"""指标导出：/metrics 服务默认只监听本机回环地址"""
+from __future__ import annotations
+
+import urllib.request
+
+import metrics
+
+
+def test_http_server_binds_loopback_by_default(monkeypatch):
+    monkeypatch.delenv("IMAGE_METRICS_HOST", raising=False)
+    server = metrics.start_http_server(port=0)
+    try:
+        host, port = server.server_address[:2]
+        assert host == "127.0.0.1"
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as resp:
+            assert resp.status == 200
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_http_server_host_opt_in(monkeypatch):
+    monkeypatch.setenv("IMAGE_METRICS_HOST", "0.0.0.0")
+    server = metrics.start_http_server(port=0)
+    try:
+        assert server.server_address[0] == "0.0.0.0"
+    finally:
+        server.shutdown()
+        server.server_close()
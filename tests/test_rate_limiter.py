@@ -0,0 +1,102 @@
+"""客户端限流：令牌桶计算与文件后端"""
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+import budget
+import rate_limiter
+from rate_limiter import Bucket, FileBackend, RateLimiter
+
+
+def test_per_minute_bucket():
+    bucket = Bucket.per_minute("requests", 60)
+    assert bucket.capacity == 60
+    assert bucket.rate == pytest.approx(1.0)
+    assert Bucket.per_minute("images", 60, burst=10).capacity == 10
+
+
+def test_take_refills_over_time():
+    bucket = Bucket.per_minute("requests", 60)
+    states = {}
+    assert rate_limiter._take(states, [(bucket, 60)], now=100.0) == 0
+    assert states["requests"]["tokens"] == 0
+    # 桶已空：每秒补充 1 个令牌
+    assert rate_limiter._take(states, [(bucket, 1)], now=100.0) == pytest.approx(1.0)
+    assert rate_limiter._take(states, [(bucket, 1)], now=100.5) == pytest.approx(0.5)
+    assert rate_limiter._take(states, [(bucket, 1)], now=101.0) == 0
+    # 补充不超过容量
+    assert rate_limiter._refill(states["requests"], bucket, now=10_000.0) == 60
+
+
+def test_take_is_atomic_across_buckets():
+    requests = Bucket.per_minute("requests", 60)
+    images = Bucket.per_minute("images", 6)
+    states = {}
+    assert rate_limiter._take(states, [(requests, 1), (images, 6)], now=0.0) == 0
+    # 图片桶不足：等待时间取决于图片桶，请求桶也不扣减
+    wait = rate_limiter._take(states, [(requests, 1), (images, 2)], now=0.0)
+    assert wait == pytest.approx(20.0)
+    assert states["requests"]["tokens"] == 59
+
+
+def test_image_demand_capped_at_capacity(tmp_path):
+    limiter = RateLimiter("p", "e", rpm=None, ipm=4, backend=FileBackend(str(tmp_path)))
+    # 单次请求的图片数超过桶容量时按容量计，否则永远无法放行
+    assert limiter.try_acquire(10) == 0
+    assert limiter.try_acquire(1) > 0
+
+
+def test_file_backend_shares_state(tmp_path):
+    first = RateLimiter("p", "e", "d", rpm=2, backend=FileBackend(str(tmp_path)))
+    second = RateLimiter("p", "e", "d", rpm=2, backend=FileBackend(str(tmp_path)))
+    assert first.try_acquire() == 0
+    assert second.try_acquire() == 0
+    assert first.try_acquire() > 0
+
+
+def test_acquire_timeout(tmp_path):
+    limiter = RateLimiter("p", "e", rpm=1, backend=FileBackend(str(tmp_path)))
+    assert limiter.acquire() == pytest.approx(0, abs=0.05)
+    with pytest.raises(TimeoutError):
+        limiter.acquire(timeout=1.0)
+
+
+def _exhausted(tmp_path, monkeypatch):
+    limiter = RateLimiter("test", "cancel", rpm=1, backend=FileBackend(str(tmp_path)))
+    assert limiter.try_acquire() == 0
+    monkeypatch.setitem(rate_limiter._limiters, limiter.key, limiter)
+    return limiter
+
+
+def test_acquire_wakes_on_cancel(tmp_path, monkeypatch):
+    limiter = _exhausted(tmp_path, monkeypatch)
+    token = budget.CancelToken()
+    threading.Timer(0.2, token.cancel).start()
+    started = time.monotonic()
+    with budget.scope(cancel=token), pytest.raises(budget.Cancelled):
+        limiter.acquire()
+    assert time.monotonic() - started < 2.0
+
+
+def test_athrottle_wakes_on_cancel(tmp_path, monkeypatch):
+    _exhausted(tmp_path, monkeypatch)
+    token = budget.CancelToken()
+
+    async def run():
+        with budget.scope(cancel=token):
+            await rate_limiter.athrottle("test", "cancel")
+
+    threading.Timer(0.2, token.cancel).start()
+    started = time.monotonic()
+    with pytest.raises(budget.Cancelled):
+        asyncio.run(run())
+    assert time.monotonic() - started < 2.0
+
+    token = budget.CancelToken()
+    token.cancel()
+    with pytest.raises(budget.Cancelled):
+        asyncio.run(run())
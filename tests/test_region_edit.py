@@ -0,0 +1,82 @@
+"""局部编辑：遮罩方向与外接框"""
+from __future__ import annotations
+
+import io
+
+import pytest
+from PIL import Image
+
+import gpt_image_1
+import region_edit
+
+
+def _edit_region(crop):
+    left, top, right, bottom = region_edit.bounding_box(crop.weights > 0)
+    return left + crop.box[0], top + crop.box[1], right + crop.box[0], bottom + crop.box[1]
+
+
+def _rotated_source(tmp_path):
+    """原始像素 400x200，EXIF 方向 6（显示时顺时针旋转 90°，转正后为 200x400）"""
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    buffer = io.BytesIO()
+    Image.new("RGB", (400, 200), (10, 200, 10)).save(buffer, format="JPEG", exif=exif)
+    return buffer.getvalue()
+
+
+def test_mask_follows_source_orientation(tmp_path):
+    # 遮罩按原始像素方向绘制：左上角 40x40 可编辑，转正后应位于右上角
+    mask = Image.new("L", (400, 200), 255)
+    mask.paste(0, (0, 0, 40, 40))
+    mask_path = tmp_path / "mask.png"
+    mask.save(mask_path)
+    crop = region_edit.crop_to_region(_rotated_source(tmp_path), str(mask_path), margin=0, feather=0,
+                                      max_area_ratio=1.0)
+    assert crop.original.size == (200, 400)
+    assert _edit_region(crop) == (160, 0, 200, 40)
+
+
+def test_mask_in_display_orientation_is_unchanged(tmp_path):
+    mask = Image.new("L", (200, 400), 255)
+    mask.paste(0, (0, 0, 40, 40))
+    crop = region_edit.crop_to_region(_rotated_source(tmp_path), mask, margin=0, feather=0, max_area_ratio=1.0)
+    assert _edit_region(crop) == (0, 0, 40, 40)
+
+
+def test_region_rejects_lazy(tmp_path, input_image):
+    mask_path = tmp_path / "mask.png"
+    Image.new("L", (64, 64), 0).save(mask_path)
+    with pytest.raises(ValueError):
+        gpt_image_1.image_to_image(input_image, "x", mask_path=str(mask_path), region=True, lazy=True)
+
+
+def test_bounding_box():
+    import numpy as np
+
+    editable = np.zeros((50, 80), dtype=bool)
+    assert region_edit.bounding_box(editable) is None
+    editable[10:20, 30:45] = True
+    editable[25, 5] = True
+    assert region_edit.bounding_box(editable) == (5, 10, 45, 26)
+
+
+def test_composite_only_changes_masked_region(tmp_path):
+    import numpy as np
+
+    source = io.BytesIO()
+    Image.new("RGB", (2000, 2000), (0, 0, 255)).save(source, format="PNG")
+    mask = Image.new("L", (2000, 2000), 255)
+    mask.paste(0, (900, 900, 1000, 1000))
+    crop = region_edit.crop_to_region(source.getvalue(), mask, margin=64, feather=16)
+    assert crop is not None and crop.size == "1024x1024"
+    patch = io.BytesIO()
+    Image.new("RGB", (1024, 1024), (255, 0, 0)).save(patch, format="PNG")
+
+    result = np.asarray(Image.open(io.BytesIO(crop.composite(patch.getvalue()))))
+    assert result.shape == (2000, 2000, 3)
+    # 可编辑区域完全取补丁，裁剪框外保持原图，羽化带介于两者之间
+    assert (result[900:1000, 900:1000] == (255, 0, 0)).all()
+    assert (result[:crop.box[1]] == (0, 0, 255)).all()
+    assert (result[:, :crop.box[0]] == (0, 0, 255)).all()
+    edge = result[950, 1000 + 8]
+    assert 0 < edge[0] < 255
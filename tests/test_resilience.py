@@ -0,0 +1,134 @@
+"""容错层：对冲请求"""
+from __future__ import annotations
+
+import threading
+import time
+
+import budget
+import resilience
+
+
+class _Result:
+    def __init__(self, name):
+        self.name = name
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+
+def test_hedge_closes_losing_result_that_also_succeeded():
+    results = []
+    release = threading.Event()
+
+    def attempt(cancel):
+        result = _Result(len(results))
+        results.append(result)
+        if result.name == 0:
+            release.wait(5)
+        return result
+
+    def release_first():
+        time.sleep(0.2)
+        release.set()
+
+    threading.Thread(target=release_first).start()
+    winner = resilience.hedged_call(attempt, 0.05)
+    assert winner is results[1]
+    assert results[0].closed.wait(5)
+    assert not winner.closed.is_set()
+
+
+def test_hedge_unlinks_parent_callbacks():
+    parent = budget.CancelToken()
+    for _ in range(5):
+        resilience.hedged_call(lambda cancel: "ok", 1.0, parent)
+    assert parent._callbacks == []
+
+
+def test_hedge_threshold_excludes_queue_time(monkeypatch):
+    monkeypatch.setattr(resilience, "_hedge_pool", None)
+    monkeypatch.setattr(resilience, "_hedge_workers", 0)
+    monkeypatch.setenv("IMAGE_HEDGE_WORKERS", "1")
+    blocker = threading.Event()
+    pool = resilience._hedge_executor()
+    pool.submit(blocker.wait, 5)
+    calls = []
+
+    def attempt(cancel):
+        calls.append(1)
+        time.sleep(0.05)
+        return "ok"
+
+    threading.Timer(0.3, blocker.set).start()
+    assert resilience.hedged_call(attempt, 0.2) == "ok"
+    # 排队的 0.3s 超过阈值，但尝试开始后 0.05s 即返回，不应发起对冲
+    assert calls == [1]
+
+
+def test_reserve_grows_hedge_pool(monkeypatch):
+    monkeypatch.setattr(resilience, "_hedge_pool", None)
+    monkeypatch.setattr(resilience, "_hedge_workers", 0)
+    monkeypatch.setenv("IMAGE_HEDGE_WORKERS", "4")
+    assert resilience._hedge_executor()._max_workers == 4
+    resilience.reserve(10)
+    assert resilience._hedge_executor()._max_workers == 20
+
+
+class _HTTPError(Exception):
+    def __init__(self, status, headers=None):
+        super().__init__(f"HTTP {status}")
+        self.response = type("Response", (), {"status_code": status, "headers": headers or {}})()
+
+
+def test_classify_error_by_status():
+    assert resilience.classify_error(_HTTPError(429, {"retry-after": "3"})) == (True, 3.0)
+    assert resilience.classify_error(_HTTPError(503, {"retry-after-ms": "1500"})) == (True, 1.5)
+    assert resilience.classify_error(_HTTPError(400)) == (False, None)
+    assert resilience.classify_error(_HTTPError(401))[0] is False
+
+
+def test_classify_error_transport_and_budget():
+    import requests
+
+    assert resilience.classify_error(requests.exceptions.ConnectTimeout()) == (True, None)
+    assert resilience.classify_error(ConnectionResetError()) == (True, None)
+    assert resilience.classify_error(resilience.RetryableError("x", 502, 2.0)) == (True, 2.0)
+    assert resilience.classify_error(budget.Cancelled("x")) == (False, None)
+    assert resilience.classify_error(budget.DeadlineExceeded("x")) == (False, None)
+    assert resilience.classify_error(ValueError("bad prompt")) == (False, None)
+
+
+def test_backoff_delay_bounds():
+    policy = resilience.RetryPolicy(base_delay=1.0, multiplier=2.0, max_delay=5.0)
+    for attempt, ceiling in ((1, 1.0), (2, 2.0), (3, 4.0), (10, 5.0)):
+        delays = [resilience.backoff_delay(policy, attempt) for _ in range(200)]
+        assert all(0 <= delay <= ceiling for delay in delays)
+    # Retry-After 作为下限
+    assert resilience.backoff_delay(policy, 1, retry_after=7.0) == 7.0
+
+
+def test_execute_retries_only_retryable_errors():
+    policy = resilience.RetryPolicy(max_attempts=3, base_delay=0.0)
+    calls = []
+
+    def flaky(cancel):
+        calls.append(1)
+        if len(calls) < 3:
+            raise resilience.RetryableError("busy", 503)
+        return "ok"
+
+    assert resilience.execute(flaky, policy) == "ok"
+    assert len(calls) == 3
+
+    calls.clear()
+
+    def rejected(cancel):
+        calls.append(1)
+        raise _HTTPError(400)
+
+    try:
+        resilience.execute(rejected, policy)
+    except _HTTPError:
+        pass
+    assert len(calls) == 1
@@ -0,0 +1,63 @@
+"""结果缓存：请求键"""
+from __future__ import annotations
+
+import pytest
+
+import result_cache
+
+
+def test_request_key_missing_reference(tmp_path):
+    missing = str(tmp_path / "nonexistent.png")
+    with pytest.raises(FileNotFoundError):
+        result_cache.request_key("seedream4", model="m", prompt="x", size="2K", count=1, references=[missing])
+    assert result_cache.try_request_key(
+        "seedream4", model="m", prompt="x", size="2K", count=1, references=[missing]
+    ) is None
+
+
+def test_request_key_ignores_reference_form(tmp_path):
+    path = tmp_path / "ref.png"
+    path.write_bytes(b"reference")
+    by_path = result_cache.request_key("seedream4", model="m", prompt="x", size="2K", count=1, references=[str(path)])
+    by_bytes = result_cache.request_key("seedream4", model="m", prompt="x", size="2K", count=1, references=[b"reference"])
+    assert by_path == by_bytes
+
+
+def _cache(tmp_path, **kwargs):
+    return result_cache.ResultCache(str(tmp_path / "cache"), **kwargs)
+
+
+def test_lru_eviction_by_entries(tmp_path):
+    cache = _cache(tmp_path, max_entries=2)
+    cache.put("a" * 64, [b"a"])
+    cache.put("b" * 64, [b"b"])
+    # 访问 a 后 b 成为最久未使用
+    assert cache.get("a" * 64) is not None
+    cache.put("c" * 64, [b"c"])
+    assert cache.get("b" * 64) is None
+    assert cache.get("a" * 64).read_all() == [b"a"]
+    assert cache.stats()["evictions"] == 1
+
+
+def test_lru_eviction_by_bytes(tmp_path):
+    cache = _cache(tmp_path, max_bytes=10)
+    cache.put("a" * 64, [b"x" * 6])
+    cache.put("b" * 64, [b"y" * 6])
+    assert cache.get("a" * 64) is None
+    assert cache.stats()["bytes"] == 6
+
+
+def test_ttl_expiry(tmp_path, monkeypatch):
+    cache = _cache(tmp_path, ttl=60)
+    cache.put("a" * 64, [b"a"])
+    assert cache.get("a" * 64) is not None
+    now = result_cache.time.time()
+    monkeypatch.setattr(result_cache.time, "time", lambda: now + 61)
+    assert cache.get("a" * 64) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_index_reloaded_from_disk(tmp_path):
+    _cache(tmp_path).put("a" * 64, [b"a", b"b"])
+    entry = _cache(tmp_path).get("a" * 64)
+    assert entry.read_all() == [b"a", b"b"]
@@ -0,0 +1,53 @@
+"""惰性结果解码：在任意分块边界上扫描 b64_json 字段"""
+from __future__ import annotations
+
+import base64
+import json
+
+import pytest
+
+from result_stream import ImageStream, _scan_b64_fields, _DATA, _END, _START
+
+
+def _fields(chunks):
+    fields, current = [], None
+    for kind, data in _scan_b64_fields(chunks):
+        if kind == _START:
+            current = b""
+        elif kind == _DATA:
+            current += data
+        elif kind == _END:
+            fields.append(current)
+    return fields
+
+
+def _split(raw, size):
+    return [raw[i:i + size] for i in range(0, len(raw), size)]
+
+
+IMAGES = [b"\x89PNG first image \xff\x00", b"second" * 50, b"?>?>" * 7]
+# json.dumps 把 / 转义为 \/ 时（部分服务端如此），base64 中会出现转义
+RAW = json.dumps({
+    "created": 1,
+    "data": [{"b64_json": base64.b64encode(data).decode()} for data in IMAGES] + [{"b64_json": None}],
+}).replace("/", "\\/").encode()
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 11, len(RAW)])
+def test_scan_across_chunk_and_escape_boundaries(size):
+    fields = _fields(_split(RAW, size))
+    assert [base64.b64decode(field) for field in fields] == IMAGES
+
+
+def test_image_stream_decodes_each_image():
+    closed = []
+    stream = ImageStream(_split(RAW, 4), lambda: closed.append(True))
+    assert list(stream) == IMAGES
+    assert closed == [True]
+    with pytest.raises(RuntimeError):
+        list(stream)
+
+
+def test_image_stream_save(tmp_path):
+    paths = ImageStream(_split(RAW, 9)).save(str(tmp_path))
+    assert [open(path, "rb").read() for path in paths] == IMAGES
@@ -0,0 +1,96 @@
+"""SeeDream 4.0 便捷函数：参考图处理与请求合并"""
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+import mock_image_api
+import seedream
+from result_cache import ResultCache
+
+
+def test_missing_reference_is_skipped_when_coalescing(tmp_path):
+    result = seedream.generate_image_with_seedream4(
+        "missing reference", images=[str(tmp_path / "nonexistent.png")],
+        coalesce=True, cache=ResultCache(str(tmp_path / "cache")), output_dir=str(tmp_path),
+    )
+    assert result["success"], result
+    assert len(result["images"]) == 1
+
+
+def test_missing_reference_is_skipped_when_coalescing_async(tmp_path):
+    result = asyncio.run(seedream.generate_image_with_seedream4_async(
+        "missing reference", images=[str(tmp_path / "nonexistent.png")], coalesce=True,
+    ))
+    assert result["success"], result
+    assert len(result["images"]) == 1
+
+
+def _sse_server(monkeypatch, interval):
+    server = mock_image_api.make_server(port=0, config=mock_image_api.MockConfig(sse_interval=interval))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv(
+        "SEEDREAM4_BASE_URL", f"http://127.0.0.1:{server.server_address[1]}/api/v3/images/generations"
+    )
+    return server
+
+
+def test_stream_closes_sse_when_abandoned(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    server = _sse_server(monkeypatch, 3.0)
+    try:
+        stream = seedream.generate_image_with_seedream4_stream("abandon", max_images=2)
+        next(event for event in stream if event["type"] == "image")
+        stream.close()
+        time.sleep(1.0)
+        # 下一个事件 3s 后才到：读取线程应随连接关闭而退出，而不是一直阻塞在 SSE 上
+        assert not any(thread.name == "seedream4-sse" for thread in threading.enumerate())
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_stream_discards_downloads_when_abandoned(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    server = _sse_server(monkeypatch, 0.0)
+
+    def slow_save(self, image_url, filename=None):
+        time.sleep(0.3)
+        os.makedirs("outputs", exist_ok=True)
+        path = os.path.join("outputs", filename)
+        with open(path, "wb") as f:
+            f.write(b"image")
+        return path
+
+    monkeypatch.setattr(seedream.SeeDream4API, "save_image_from_url", slow_save)
+    try:
+        stream = seedream.generate_image_with_seedream4_stream("abandon", max_images=4, download_workers=1)
+        first = next(event for event in stream if event["type"] == "image")
+        stream.close()
+        time.sleep(1.5)
+        # 排队的下载被取消，进行中的下载完成后删除，只留下已产出的一张
+        assert os.listdir(tmp_path / "outputs") == [os.path.basename(first["local_path"])]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_async_output_dir_is_part_of_coalesce_key(tmp_path):
+    async def run():
+        async with seedream.AsyncSeeDream4API() as api:
+            return await asyncio.gather(*(
+                seedream.generate_image_with_seedream4_async(
+                    "same prompt", api=api, coalesce=True, output_dir=str(tmp_path / name)
+                )
+                for name in ("a", "b")
+            ))
+
+    for name, result in zip(("a", "b"), asyncio.run(run())):
+        assert result["success"], result
+        path = result["images"][0]["local_path"]
+        assert os.path.dirname(path) == str(tmp_path / name)
+        assert os.path.exists(path)
@@ -0,0 +1,196 @@
+"""
+冒烟测试：各公开入口对本地模拟 API（mock_image_api.py）各跑一次，确认能走通并返回结果
+
+只验证调用链路是否可用（参数、请求体、响应解析、落盘），不测性能；性能见 bench.py。
+
+运行:
+  python -m pytest -q tests
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+
+PNG_MAGIC = b"\x89PNG"
+
+
+def _assert_files(paths, count):
+    assert len(paths) == count
+    for path in paths:
+        with open(path, "rb") as f:
+            assert f.read(4) == PNG_MAGIC
+
+
+# ---- SeeDream 4.0 ----
+
+def test_seedream_api_generate_image():
+    import seedream
+
+    api = seedream.SeeDream4API()
+    result = api.generate_image("smoke", max_images=2, stream=False)
+    assert result["success"], result
+    assert len(result["data"]["data"]) == 2
+    result = api.generate_image("smoke", max_images=2, stream=True)
+    assert result["success"], result
+
+
+def test_seedream_iter_generate_image():
+    import seedream
+
+    events = list(seedream.SeeDream4API().iter_generate_image("smoke", max_images=2))
+    types = [event.get("type") for event in events]
+    assert types.count("image_generation.partial_succeeded") == 2
+    assert "image_generation.completed" in types
+
+
+def test_generate_image_with_seedream4(tmp_path):
+    import seedream
+
+    result = seedream.generate_image_with_seedream4("smoke", max_images=2, coalesce=False, output_dir=str(tmp_path))
+    assert result["success"], result
+    _assert_files([img["local_path"] for img in result["images"]], 2)
+
+    sharded = seedream.generate_image_with_seedream4(
+        "smoke", max_images=3, coalesce=False, output_dir=str(tmp_path), shard_size=1
+    )
+    assert sharded["success"], sharded
+    _assert_files([img["local_path"] for img in sharded["images"]], 3)
+
+
+def test_generate_image_with_seedream4_stream():
+    import seedream
+
+    events = list(seedream.generate_image_with_seedream4_stream("smoke", max_images=2))
+    images = [event for event in events if event["type"] == "image"]
+    _assert_files([event["local_path"] for event in images], 2)
+    assert any(event["type"] == "completed" for event in events)
+    assert not any(event["type"] in ("error", "image_failed") for event in events)
+
+
+def test_seedream_async():
+    import seedream
+
+    async def run():
+        async with seedream.AsyncSeeDream4API() as api:
+            result = await seedream.generate_image_with_seedream4_async("smoke", max_images=2, api=api, coalesce=False)
+            assert result["success"], result
+            _assert_files([img["local_path"] for img in result["images"]], 2)
+
+    asyncio.run(run())
+
+
+# ---- gpt-image-1 ----
+
+def test_gpt_text_to_image():
+    import gpt_image_1
+
+    assert all(data.startswith(PNG_MAGIC) for data in gpt_image_1.text_to_image("smoke", n=2))
+    stream = gpt_image_1.text_to_image("smoke", n=2, lazy=True)
+    assert len([data for data in stream if data.startswith(PNG_MAGIC)]) == 2
+
+
+def test_gpt_image_to_image(input_image):
+    import gpt_image_1
+
+    assert len(gpt_image_1.image_to_image(input_image, "smoke", n=2)) == 2
+    assert len(gpt_image_1.image_to_image_with_base64(input_image, "smoke", n=1)) == 1
+
+
+def test_gpt_generate_image_and_save(tmp_path, input_image):
+    import gpt_image_1
+
+    images = gpt_image_1.generate_image("smoke", n=2, coalesce=False)
+    _assert_files(gpt_image_1.save_images(images, str(tmp_path)), 2)
+    images = gpt_image_1.generate_image("smoke", input_image, n=1, coalesce=False)
+    assert len(images) == 1
+
+
+def test_gpt_async(input_image):
+    import gpt_image_1
+
+    async def run():
+        async with gpt_image_1.AsyncGptImage1() as client:
+            assert len(await client.generate_image("smoke", n=2, coalesce=False)) == 2
+            assert len(await client.generate_image("smoke", input_image, n=1, coalesce=False)) == 1
+            assert len(await client.generate_image("smoke", input_image, use_base64=True, coalesce=False)) == 1
+
+    asyncio.run(run())
+
+
+# ---- 路由、批处理、任务队列、守护进程 ----
+
+def test_router_generate(tmp_path):
+    import router
+
+    for provider in ("seedream4", "gpt_image_1"):
+        result = router.Router().generate("smoke", size="2K" if provider == "seedream4" else "1024x1024",
+                                          output_dir=str(tmp_path), providers=[provider])
+        assert result.provider == provider
+        _assert_files(result.paths, 1)
+
+
+def test_batch_run_job(tmp_path):
+    import batch
+
+    for job in ({"prompt": "smoke", "max_images": 2}, {"prompt": "smoke", "n": 1}):
+        record = batch.run_job("smoke", job, str(tmp_path))
+        assert record["status"] == "ok", record
+        _assert_files(record["outputs"], job.get("max_images", job.get("n")))
+
+
+def test_jobqueue_work(tmp_path):
+    import jobqueue
+
+    queue = jobqueue.JobQueue(str(tmp_path / "jobs.db"))
+    job_id = queue.submit({"prompt": "smoke", "n": 1}, provider="gpt_image_1")
+    queue.close()
+    assert jobqueue.work(str(tmp_path / "jobs.db"), output_dir=str(tmp_path), drain=True, use_cache=False) == 1
+    queue = jobqueue.JobQueue(str(tmp_path / "jobs.db"))
+    try:
+        _assert_files(queue.result(job_id, timeout=5)["outputs"], 1)
+    finally:
+        queue.close()
+
+
+def test_daemon_roundtrip(tmp_path):
+    import daemon
+
+    socket_path = str(tmp_path / "daemon.sock")
+    server = daemon.make_server(daemon.Daemon(output_dir=str(tmp_path)), socket_path=socket_path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = daemon.DaemonClient(socket_path=socket_path)
+    try:
+        assert client.health()["ok"]
+        result = client.generate({"provider": "seedream4", "prompt": "smoke", "max_images": 2})
+        _assert_files([image["path"] for image in result["images"]], 2)
+        result = client.generate({"provider": "gpt_image_1", "prompt": "smoke", "n": 1, "transfer": "shm"})
+        image = result["images"][0]
+        assert daemon.read_shm(image["shm"], image["bytes"]).startswith(PNG_MAGIC)
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+
+# ---- 下载与预处理 ----
+
+def test_download_file(mock_api, tmp_path):
+    import downloader
+
+    path = downloader.download_file(f"{mock_api}/files/smoke.png", str(tmp_path / "smoke.png"))
+    _assert_files([path], 1)
+    assert not os.path.exists(path + ".part")
+
+
+def test_prepare_image_strips_metadata(tmp_path):
+    from PIL import Image, PngImagePlugin
+
+    import preprocess
+
+    info = PngImagePlugin.PngInfo()
+    info.add_text("location", "secret-location")
+    path = tmp_path / "meta.png"
+    Image.new("RGB", (64, 64), (200, 10, 10)).save(path, pnginfo=info)
+    prepared = preprocess.prepare_image(str(path), "1K")
+    assert b"secret-location" not in prepared.data
@@ -0,0 +1,27 @@
+"""流式请求体：同步与异步迭代输出一致，长度与实际字节数相符"""
+from __future__ import annotations
+
+import asyncio
+
+import streaming_body
+
+
+def _collect(body):
+    async def run():
+        return b"".join([chunk async for chunk in body.aiter()])
+
+    return asyncio.run(run())
+
+
+def test_aiter_matches_iter(tmp_path):
+    path = tmp_path / "image.png"
+    path.write_bytes(bytes(range(256)) * 1000)
+    for body in (
+        streaming_body.multipart_body({"prompt": "p"}, {"image[]": [("image.png", str(path), "image/png")]}),
+        streaming_body.json_body({"prompt": "p"}, {"image": (str(path), "image/png")}),
+    ):
+        data = b"".join(body)
+        assert _collect(body) == data
+        assert len(body) == len(data)
+        # 可重复迭代（重试时再次发送）
+        assert _collect(body) == data